@@ -0,0 +1,192 @@
+"""
+Throughput benchmarks for the functions against a local mock of the api.
+
+Each case runs a function's flexio_handler with a fake flex object against
+tests/mock_intercom.py in its own process, so the peak RSS is the case's
+own, and reports the rows written per second, the requests made, the bytes
+written and the peak RSS, along with how much the peak grew while the
+function ran. For example:
+
+    python bench/benchmark.py
+    python bench/benchmark.py --contacts 50000 --latency 0.1 --case contacts-partitions=4
+    python bench/benchmark.py --function intercom-contacts --param partitions=8 --param format=csv
+
+The mock api's latency is per request, so a higher latency shows the effect
+of prefetching and partitioning; --rate-limit adds the rate limit headers
+and 429s. The ms/page is the mean time from sending a request for a page to
+its response, including any retries and rate limit waits.
+
+A case can also set options that change the function rather than its
+params; contacts-session-per-request creates a new session for every
+request rather than reusing the shared one, which is how the functions
+fetched pages before the shared session. The mock api is plain http, so
+this leaves out the TLS handshake each new connection makes with the api.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from mock_intercom import MockIntercom, FakeFlex, load_function
+
+# the default cases; each is a function, the params to call it with and
+# optionally the options to run it with
+CASES = OrderedDict([
+    ('contacts', ('intercom-contacts', {})),
+    ('contacts-session-per-request', ('intercom-contacts', {}, {'session_per_request': True})),
+    ('contacts-table', ('intercom-contacts', {'format': 'table'})),
+    ('contacts-stream', ('intercom-contacts', {'stream': True})),
+    ('contacts-partitions=4', ('intercom-contacts', {'partitions': 4})),
+    ('contacts-companies', ('intercom-contacts', {'company_properties': 'name,monthly_spend,size'})),
+    ('contacts-filter', ('intercom-contacts', {'filter': 'role=lead'})),
+    ('conversations', ('intercom-conversations', {})),
+    ('conversations-stream', ('intercom-conversations', {'stream': True})),
+    ('conversations-partitions=4', ('intercom-conversations', {'partitions': 4})),
+    ('companies', ('intercom-companies', {})),
+    ('conversation-parts', ('intercom-conversation-parts', {})),
+])
+
+# tabular formats start with a header row that isn't counted as a row
+TABULAR_FORMATS = ('table', 'csv')
+
+MB = 1024 * 1024
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the functions against a local mock of the api')
+    parser.add_argument('--case', action='append', help='a case to run (defaults to all of them): ' + ', '.join(CASES.keys()))
+    parser.add_argument('--function', help='a function to run instead of the cases, e.g. intercom-contacts')
+    parser.add_argument('--param', action='append', default=[], help='a name=value param for --function; repeatable')
+    parser.add_argument('--contacts', type=int, default=20000)
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--companies', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the mock api takes for each request')
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests allowed in each 10 second window')
+    parser.add_argument('--repeat', type=int, default=1, help='times to run each case; the fastest run is reported')
+    parser.add_argument('--json', action='store_true', help='write the results as json lines')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    parser.add_argument('--options', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        return run_case(args.run, args.url, json.loads(args.params), json.loads(args.options))
+
+    if args.function is not None:
+        cases = OrderedDict([(args.function, (args.function, parse_params(args.param)))])
+    else:
+        names = args.case or list(CASES.keys())
+        for name in names:
+            if name not in CASES:
+                parser.error('unknown case: ' + name)
+        cases = OrderedDict((name, CASES[name]) for name in names)
+
+    mock = MockIntercom(contacts=args.contacts, conversations=args.conversations, companies=args.companies,
+                        latency=args.latency, rate_limit=args.rate_limit)
+    with mock:
+        if not args.json:
+            print('%-30s %9s %8s %11s %9s %8s %12s %9s %9s %6s' % ('case', 'rows', 'seconds', 'rows/sec', 'requests', 'ms/page',
+                  'bytes', 'peak MB', 'growth MB', '429s'))
+        for name, case in cases.items():
+            function, params = case[:2]
+            options = case[2] if len(case) > 2 else {}
+            results = []
+            for _ in range(args.repeat):
+                mock.reset_stats()
+                result = spawn_case(function, mock.url, params, options)
+                result['requests'] = mock.stats['requests']
+                result['rate_limited'] = mock.stats['rate_limited']
+                results.append(result)
+            result = min(results, key=lambda result: result['seconds'])
+            result['case'] = name
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print('%-30s %9d %8.2f %11.0f %9d %8.1f %12d %9.1f %9.1f %6d' % (name, result['rows'], result['seconds'],
+                      result['rows'] / max(result['seconds'], 1e-9), result['requests'], result['page_seconds'] * 1000,
+                      result['bytes_written'], result['peak_rss'] / MB, (result['peak_rss'] - result['baseline_rss']) / MB,
+                      result['rate_limited']), flush=True)
+
+def parse_params(values):
+    params = {}
+    for value in values:
+        name, _, value = value.partition('=')
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+def spawn_case(function, url, params, options):
+
+    # run each case in a new process so its peak RSS isn't the largest of
+    # the cases run before it, and so it starts without any cached state
+    command = [sys.executable, os.path.abspath(__file__), '--run', function, '--url', url, '--params', json.dumps(params),
+               '--options', json.dumps(options)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def run_case(function, url, params, options):
+
+    # snapshots, checkpoints, cached responses and the rate limit state are
+    # written to a directory of their own for each run
+    with tempfile.TemporaryDirectory(prefix='intercom-benchmark-') as temp_dir:
+        module = load_function(function, url, temp_dir)
+        if options.get('session_per_request'):
+            module.get_session = module.requests_retry_session
+        page_times = time_requests(module)
+        flex = FakeFlex(params, keep=False)
+        baseline = get_peak_rss()
+        start = time.perf_counter()
+        module.flexio_handler(flex)
+        seconds = time.perf_counter() - start
+
+    rows = flex.output.lines
+    if params.get('format') in TABULAR_FORMATS and rows > 0:
+        rows -= 1
+    page_seconds = sum(page_times) / len(page_times) if len(page_times) > 0 else 0.0
+    print(json.dumps({'function': function, 'params': params, 'options': options, 'rows': rows, 'seconds': seconds,
+                      'page_seconds': page_seconds, 'bytes_written': flex.output.bytes_written,
+                      'baseline_rss': baseline, 'peak_rss': get_peak_rss()}))
+
+def time_requests(module):
+
+    # record how long each call to the function's send_request takes; the
+    # functions look it up as a global each time they send a request
+    times = []
+    send_request = module.send_request
+    def timed_send_request(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send_request(*args, **kwargs)
+        finally:
+            times.append(time.perf_counter() - start)
+    module.send_request = timed_send_request
+    return times
+
+def get_peak_rss():
+
+    # VmHWM is the peak of this process alone; ru_maxrss carries over the
+    # peak of the process that started it on linux, and is in bytes rather
+    # than kilobytes on macos
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Micro-benchmarks of the parts of a function that don't depend on the api.
+
+Each case times one step on synthetic records from tests/mock_intercom.py in
+this process, without any requests, and reports the fastest of the repeats
+for each variant of the step. For example:
+
+    python bench/micro_benchmark.py
+    python bench/micro_benchmark.py --case serializer --repeat 50
+
+The serializer case compares building an ndjson page with to_ndjson()
+against appending each row to the page, which copies the page for every row.
+The codec case times decoding a page of conversations and encoding its rows
+with orjson, when it's installed, and with the stdlib json module, and the
+page case times a whole page with each: decoding it, extracting the rows and
+serializing them. Both use conversations with a large source_body, which is
+where the codec's time shows up the most.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from mock_intercom import API_URL, load_function, make_contact, make_conversation, make_text
+
+# the rows per page for the serializer case: the default page size, the
+# maximum page size and a page larger than the api returns
+SERIALIZER_PAGE_SIZES = (50, 150, 1000)
+
+# the size of the source_body of the conversations for the codec and page
+# cases, which are a page of MAX_PAGE_SIZE conversations
+LARGE_BODY_BYTES = 20000
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the steps of the functions that don\'t depend on the api')
+    parser.add_argument('--case', action='append', help='a case to run (defaults to all of them): ' + ', '.join(CASES.keys()))
+    parser.add_argument('--repeat', type=int, default=20, help='times to run each variant; the fastest run is reported')
+    parser.add_argument('--json', action='store_true', help='write the results as json lines')
+    args = parser.parse_args()
+
+    names = args.case or list(CASES.keys())
+    for name in names:
+        if name not in CASES:
+            parser.error('unknown case: ' + name)
+
+    if not args.json:
+        print('%-14s %-28s %7s %10s %12s' % ('case', 'variant', 'rows', 'ms', 'rows/sec'))
+    with tempfile.TemporaryDirectory(prefix='intercom-benchmark-') as temp_dir:
+        for name in names:
+            for variant, rows, seconds in CASES[name](args.repeat, temp_dir):
+                if args.json:
+                    print(json.dumps({'case': name, 'variant': variant, 'rows': rows, 'seconds': seconds}), flush=True)
+                else:
+                    print('%-14s %-28s %7d %10.3f %12.0f' % (name, variant, rows, seconds * 1000,
+                          rows / max(seconds, 1e-9)), flush=True)
+
+def time_best(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def get_encoders(module):
+    # the orjson encoder when it's installed and the stdlib one
+    encoders = OrderedDict()
+    if module.orjson is not None:
+        encoders['orjson'] = module.get_encoder()
+    orjson, module.orjson = module.orjson, None
+    try:
+        encoders['json'] = module.get_encoder()
+    finally:
+        module.orjson = orjson
+    return encoders
+
+def get_contact_rows(module, count):
+    rng = random.Random(0)
+    items = [make_contact(i, rng, 512, 100) for i in range(count)]
+    get_item_info = module.get_item_extractor(module.get_properties({}))
+    return [get_item_info(item) for item in items]
+
+def get_conversation_page(module):
+    rng = random.Random(0)
+    items = []
+    for i in range(module.MAX_PAGE_SIZE):
+        item = make_conversation(i, rng, 1000)
+        item['source']['body'] = '<p>' + make_text(rng, LARGE_BODY_BYTES) + '</p>'
+        items.append(item)
+    return json.dumps({'type': 'conversation.list', 'conversations': items}).encode('utf-8')
+
+def without_orjson(module, function, *args):
+    orjson, module.orjson = module.orjson, None
+    try:
+        return function(*args)
+    finally:
+        module.orjson = orjson
+
+def encode_rows(rows, encoder):
+    for row in rows:
+        encoder.encode(row)
+
+def process_page(module, body, properties, serializer):
+    content = module.json_loads(body)
+    for rows in module.get_item_pages([content], properties, lambda item: True):
+        serializer(rows)
+
+def to_ndjson_by_appending(rows, to_string):
+    # how the pages were built before to_ndjson()
+    buffer = ''
+    for row in rows:
+        buffer = buffer + json.dumps(row, default=to_string) + "\n"
+    return buffer
+
+def benchmark_serializer(repeat, temp_dir):
+    module = load_function('intercom-contacts', API_URL, temp_dir)
+    encoders = get_encoders(module)
+    for page_size in SERIALIZER_PAGE_SIZES:
+        rows = get_contact_rows(module, page_size)
+        yield 'append json.dumps', page_size, time_best(repeat, to_ndjson_by_appending, rows, module.to_string)
+        for name, encoder in encoders.items():
+            yield 'to_ndjson ' + name, page_size, time_best(repeat, module.to_ndjson, rows, encoder)
+
+def benchmark_codec(repeat, temp_dir):
+    module = load_function('intercom-conversations', API_URL, temp_dir)
+    body = get_conversation_page(module)
+    rows = next(module.get_item_pages([module.json_loads(body)], module.get_properties({}), lambda item: True))
+    if module.orjson is not None:
+        yield 'decode orjson', len(rows), time_best(repeat, module.json_loads, body)
+    yield 'decode json', len(rows), time_best(repeat, without_orjson, module, module.json_loads, body)
+    for name, encoder in get_encoders(module).items():
+        yield 'encode ' + name, len(rows), time_best(repeat, encode_rows, rows, encoder)
+
+def benchmark_page(repeat, temp_dir):
+    module = load_function('intercom-conversations', API_URL, temp_dir)
+    body = get_conversation_page(module)
+    properties = module.get_properties({})
+    for name, encoder in get_encoders(module).items():
+        serializer = module.get_serializer('ndjson', encoder)
+        if name == 'orjson':
+            seconds = time_best(repeat, process_page, module, body, properties, serializer)
+        else:
+            seconds = time_best(repeat, without_orjson, module, process_page, module, body, properties, serializer)
+        yield 'page ' + name, module.MAX_PAGE_SIZE, seconds
+
+CASES = OrderedDict([
+    ('serializer', benchmark_serializer),
+    ('codec', benchmark_codec),
+    ('page', benchmark_page),
+])
+
+if __name__ == '__main__':
+    main()
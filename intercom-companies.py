@@ -12,7 +12,39 @@
 #     required: false
 #   - name: filter
 #     type: string
-#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
+#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter. Values match exactly, including case, except for true and false.
+#     required: false
+#   - name: page_size
+#     type: integer
+#     description: The number of records to request from Intercom per page (defaults to 60, the maximum allowed)
+#     required: false
+#   - name: prefetch
+#     type: integer
+#     description: The number of pages to fetch from Intercom ahead of the page being returned (defaults to 2; 0 fetches each page only after the previous one is returned; up to 16)
+#     required: false
+#   - name: cache_ttl
+#     type: integer
+#     description: The number of seconds to reuse cached responses from Intercom for, such as when a spreadsheet recalculates (defaults to 0, which doesn't use the cache)
+#     required: false
+#   - name: format
+#     type: string
+#     description: The output format; "ndjson" returns an object per record, "table" returns a header row of property names followed by an array of values per record, and "csv" returns the same as comma-separated values (defaults to "ndjson")
+#     required: false
+#   - name: write_rows
+#     type: boolean
+#     description: Whether to write each record as soon as it's serialized rather than a page of records at a time, which keeps memory flat at the cost of more writes (defaults to false)
+#     required: false
+#   - name: resume
+#     type: boolean
+#     description: Whether to save a checkpoint after each page of companies is returned so that if the export fails, running it again with the same params within an hour continues after the last page returned rather than starting over (defaults to false)
+#     required: false
+#   - name: group_by
+#     type: array
+#     description: The properties to group the companies by for the aggregate summaries; date properties can be grouped by day(), week() or month(), e.g. "week(created_at)"
+#     required: false
+#   - name: aggregate
+#     type: array
+#     description: The summaries to return for each group instead of the companies themselves: count, or the count(), sum(), min(), max(), mean(), median() or p1() to p99() of a property, e.g. "count, sum(monthly_spend)" (defaults to count when group_by is given); quantiles are approximate for groups with more than 1024 values
 #     required: false
 # returns:
 #   - name: id
@@ -56,71 +88,679 @@
 #     description: The industry that the company operates in
 # examples:
 #   - '""'
-#   - '"compay_id, name"'
+#   - '"company_id, name"'
 # ---
 
+import io
+import os
+import sys
+import csv
+import zlib
 import json
 import urllib
+import hashlib
+import tempfile
+import time
+import random
+import queue
+import threading
+import functools
+import contextlib
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from datetime import *
+from datetime import date, datetime, timedelta
 from decimal import *
 from collections import OrderedDict
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# maximum number of records the api returns per page
+MAX_PAGE_SIZE = 60
+
+# maximum number of companies the list api returns; workspaces with more are
+# listed with the scroll api
+LIST_MAX_COMPANIES = 10000
+
+# number of pages to fetch ahead of the page being written by default and at
+# most; 0 fetches each page only after the previous one is written
+PREFETCH_DEPTH = 2
+MAX_PREFETCH_DEPTH = 16
+
+# whether to write each record as it's serialized rather than a page at a
+# time when the write_rows param isn't given; writing each record keeps
+# memory flat at the cost of more writes
+WRITE_ROWS = False
+
+# output formats and their content types; the tabular formats write the
+# property names once in a header row instead of repeating them as keys
+# on every record
+OUTPUT_FORMATS = OrderedDict([
+    ('ndjson', 'application/x-ndjson'),
+    ('table', 'application/x-ndjson'),
+    ('csv', 'text/csv')
+])
+
+# aggregate mode groups date properties into DATE_BUCKETS and computes
+# quantiles from a sample of at most QUANTILE_SAMPLE_SIZE values per group
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'min', 'max', 'mean')
+DATE_BUCKETS = ('day', 'week', 'month')
+QUANTILE_SAMPLE_SIZE = 1024
+
+# resumable exports save a checkpoint in CHECKPOINT_DIR with the position of
+# the next page after each page is written; the checkpoint is removed once
+# the export completes, and one older than CHECKPOINT_TTL is ignored since
+# its position may no longer be valid and the records may have changed
+CHECKPOINT_DIR = tempfile.gettempdir()
+CHECKPOINT_TTL = 3600 # seconds
+
+# timestamps are converted with numpy when it's installed and there are at
+# least NUMPY_MIN_VALUES of them to convert; otherwise the formatted date for
+# each day is cached and reused
+NUMPY_MIN_VALUES = 256
+EPOCH = datetime(1970, 1, 1)
+_dates = {}
+
+# per-phase timing and counters are off by default; set INTERCOM_PROFILE=1
+# to write a summary to stderr after each run and INTERCOM_PROFILE_TRACE to
+# a path to also write a chrome trace (chrome://tracing) of the phases
+PROFILE = os.environ.get('INTERCOM_PROFILE', '').strip().lower() in ('1', 'true', 'yes')
+PROFILE_TRACE_PATH = os.environ.get('INTERCOM_PROFILE_TRACE') or None
+
+class Profiler:
+
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+        self.events = [] if trace else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0) + (end - start)
+                if self.events is not None:
+                    self.events.append({
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.started) * 1000000,
+                        "dur": (end - start) * 1000000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident()
+                    })
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        summary = OrderedDict()
+        summary['elapsed'] = round(time.perf_counter() - self.started, 6)
+        summary['phases'] = OrderedDict((k, round(v, 6)) for k, v in self.times.items())
+        summary['counters'] = self.counters
+        return summary
+
+    def write(self, name):
+        sys.stderr.write(json.dumps({name: self.summary()}) + "\n")
+        if self.events is not None and PROFILE_TRACE_PATH is not None:
+            with open(PROFILE_TRACE_PATH, 'w') as f:
+                json.dump({"traceEvents": self.events}, f)
+
+class NullProfiler:
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def count(self, name, value=1):
+        pass
+
+_null_phase = contextlib.nullcontext()
+
+# the profiler for the current run
+profiler = NullProfiler()
+
 # main function entry point
 def flexio_handler(flex):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
-        flex.output.write(data)
+    global profiler
+    profiler = Profiler(trace=PROFILE_TRACE_PATH is not None) if PROFILE else NullProfiler()
+
+    try:
+        flex.output.content_type = OUTPUT_FORMATS[get_output_format(flex.vars)]
+        for data in get_data(flex.vars):
+            with profiler.phase('write'):
+                flex.output.write(data)
+            profiler.count('bytes_written', len(data))
+    finally:
+        if profiler.enabled:
+            profiler.write('intercom-companies')
 
 def get_data(params):
 
     # get the api key from the variable input
     auth_token = dict(params).get('intercom_connection',{}).get('access_token')
 
+    # get the properties to return
+    properties = get_properties(params)
+
+    # in aggregate mode only the properties that are grouped and summarized
+    # are extracted, and summary rows are returned instead of the records
+    aggregation = get_aggregation(params)
+    if aggregation is not None:
+        properties = get_aggregate_properties(*aggregation)
+
+    # get the filter; a single company_id or name is looked up directly with
+    # the api and the rest is applied locally as the records stream through
+    lookup, local_filter = get_filter(params)
+    matches_filter = get_filter_matcher(local_filter)
+
     # see here for more info:
     # https://developers.intercom.com/intercom-api-reference/reference#company-model
     # https://developers.intercom.com/intercom-api-reference/reference#pagination
+    # https://developers.intercom.com/intercom-api-reference/reference#view-a-company
 
     headers = {
         'Accept': 'application/json',
         'Authorization': 'Bearer ' + auth_token,
         'Intercom-Version': '2.0' # api version
     }
+
+    page_size = get_page_size(params)
+    prefetch_depth = get_prefetch_depth(params)
+    cache_ttl = max(to_int(dict(params).get('cache_ttl')) or 0, 0)
+
+    # a resumable export continues from the checkpoint left by a failed run
+    # with the same params; summaries are only written at the end, so there's
+    # nothing to continue from in aggregate mode
+    checkpoint_path, position, rows_written = None, None, 0
+    if to_bool(dict(params).get('resume', False)) and aggregation is None:
+        checkpoint_path = get_checkpoint_path(auth_token, params)
+        position, rows_written = load_checkpoint(checkpoint_path)
+
+    # a single encoder is reused for every record
+    encoder = get_encoder()
+    output_format = get_output_format(params)
+    serialize = get_serializer(output_format, encoder)
+    write_rows = to_bool(dict(params).get('write_rows', WRITE_ROWS))
+
+    pages = get_pages(headers, page_size, lookup, cache_ttl, position)
+    pages = get_item_pages(prefetch(pages, prefetch_depth), properties, matches_filter, checkpoint_path, rows_written)
+
+    if aggregation is not None:
+        groups, aggregates = aggregation
+        pages = get_aggregate_pages(pages, groups, aggregates)
+        properties = [label for label, p, bucket in groups] + [label for label, function, p, quantile in aggregates]
+
+    # the tabular formats start with a header row of the property names,
+    # which a resumed export has already written
+    if output_format != 'ndjson' and position is None:
+        yield serialize([OrderedDict(zip(properties, properties))])
+
+    for rows in pages:
+        if write_rows:
+            for row in rows:
+                with profiler.phase('encode'):
+                    line = serialize([row])
+                yield line
+        else:
+            with profiler.phase('encode'):
+                buffer = serialize(rows)
+            if len(buffer) > 0:
+                yield buffer
+
+    if checkpoint_path is not None:
+        remove_checkpoint(checkpoint_path)
+
+def get_item_pages(pages, properties, matches_filter, checkpoint_path=None, rows_written=0):
+
+    # extract the properties for each page, converting the dates for the
+    # whole page at once
+    get_item_info = get_item_extractor(properties, dates=False)
+    date_properties = [p for p in properties if p in DATE_PROPERTIES]
+
+    for content in pages:
+
+        data = content.get('data',[])
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
+            break
+
+        with profiler.phase('transform'):
+            rows = [get_item_info(item) for item in data if matches_filter(item)]
+            convert_dates(rows, date_properties)
+        profiler.count('rows', len(rows))
+        yield rows
+
+        # the pages ahead of this one may already have been fetched, but
+        # this point is only reached once this page has been written, so
+        # save where to continue from in case the export fails after it
+        if checkpoint_path is not None:
+            rows_written += len(rows)
+            position = get_next_position(content)
+            if position is not None:
+                save_checkpoint(checkpoint_path, position, rows_written)
+
+def get_pages(headers, page_size, lookup=None, cache_ttl=0, position=None):
+
     url = 'https://api.intercom.io/companies'
 
-    page_size = 50
+    # a lookup returns a single company rather than a list; return it as
+    # a page with a single item or an empty page if it doesn't exist
+    if lookup is not None:
+        url_query_str = urllib.parse.urlencode(lookup)
+        response = send_request('GET', url + '?' + url_query_str, headers, cache_ttl)
+        if response.status_code == 404:
+            yield {"data": []}
+            return
+        response.raise_for_status()
+        yield {"data": [decode_response(response)]}
+        return
+
     url_query_params = {"per_page": page_size}
     url_query_str = urllib.parse.urlencode(url_query_params)
     page_url = url + '?' + url_query_str
+    first_page = True
+
+    # a resumed export continues the list from the page it stopped at
+    if position is not None:
+        page_url = position
+        first_page = False
 
     while True:
 
-        response = requests_retry_session().get(page_url, headers=headers)
+        response = send_request('GET', page_url, headers, cache_ttl)
         response.raise_for_status()
-        content = response.json()
-        data = content.get('data',[])
+        content = decode_response(response)
 
-        if len(data) == 0: # sanity check in case there's an issue with cursor
-            break
+        # the list api stops at LIST_MAX_COMPANIES and gets slower the deeper
+        # it pages, so list larger workspaces with the scroll api instead
+        if first_page and (content.get('total_count') or 0) > LIST_MAX_COMPANIES:
+            yield from get_scroll_pages(headers)
+            return
 
-        buffer = ''
-        for item in data:
-            item = get_item_info(item)
-            buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
+        first_page = False
+        yield content
 
-        page_url = content.get('pages',{}).get('next')
+        page_url = get_next_position(content)
         if page_url is None:
             break
 
+def get_scroll_pages(headers):
+
+    # see here for more info:
+    # https://developers.intercom.com/intercom-api-reference/reference#iterating-over-all-companies
+    # note: only one scroll can be open at a time for a workspace; scroll
+    # pages aren't cached since each scroll_param is only valid for a short
+    # time after it's returned
+    url = 'https://api.intercom.io/companies/scroll'
+    scroll_param = None
+
+    while True:
+
+        page_url = url
+        if scroll_param is not None:
+            page_url = url + '?' + urllib.parse.urlencode({"scroll_param": scroll_param})
+
+        response = send_request('GET', page_url, headers)
+        response.raise_for_status()
+        content = decode_response(response)
+
+        # the scroll ends with an empty page
+        if len(content.get('data',[])) == 0:
+            break
+        yield content
+
+        scroll_param = content.get('scroll_param')
+        if scroll_param is None:
+            break
+
+def get_next_position(content):
+    # the list apis return the url of the next page and the contacts and
+    # search apis return a cursor to start the next page after
+    next_page = (content.get('pages') or {}).get('next')
+    if isinstance(next_page, dict):
+        return next_page.get('starting_after')
+    return next_page
+
+def get_checkpoint_path(auth_token, params):
+    # a checkpoint is only used by a run with the same params
+    params = {k: v for k, v in dict(params).items() if k not in ('intercom_connection', 'resume')}
+    key = json.dumps([auth_token, params], sort_keys=True, default=to_string)
+    key = hashlib.sha256(('intercom-companies:' + key).encode('utf-8')).hexdigest()
+    return os.path.join(CHECKPOINT_DIR, 'intercom-companies-checkpoint-' + key[:32] + '.json')
+
+def load_checkpoint(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None, 0
+    if time.time() - (checkpoint.get('saved_at') or 0) > CHECKPOINT_TTL:
+        return None, 0
+    return checkpoint.get('position'), checkpoint.get('rows') or 0
+
+def save_checkpoint(path, position, rows):
+    # write to a temporary file first so a failure never leaves a partially
+    # written checkpoint
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'position': position, 'rows': rows, 'saved_at': time.time()}, f)
+    os.replace(temp_path, path)
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def get_aggregation(params):
+
+    # group_by is a list of properties, where a date property can be grouped
+    # by day(), week() or month(); aggregate is a list of count, sum(), min(),
+    # max(), mean(), median() and p1() to p99() of properties, where count on
+    # its own counts the records in each group; returns None when neither is
+    # given
+    group_by = get_list_param(params, 'group_by')
+    aggregate = get_list_param(params, 'aggregate')
+    if len(group_by) == 0 and len(aggregate) == 0:
+        return None
+
+    groups = []
+    for label in group_by:
+        function, p = parse_aggregate_expression(label)
+        if p is None:
+            function, p = None, function
+        if p not in PROPERTY_TYPES or (function is not None and (function not in DATE_BUCKETS or p not in DATE_PROPERTIES)):
+            raise ValueError('Invalid group_by: ' + label)
+        groups.append((label, p, function))
+
+    aggregates = []
+    for label in aggregate or ['count']:
+        function, p = parse_aggregate_expression(label)
+        quantile = get_quantile(function)
+        if function == 'count' and p is None:
+            pass
+        elif p not in PROPERTY_TYPES or (function not in AGGREGATE_FUNCTIONS and quantile is None):
+            raise ValueError('Invalid aggregate: ' + label)
+        aggregates.append((label, function, p, quantile))
+
+    return groups, aggregates
+
+def get_list_param(params, name):
+    values = dict(params).get(name) or []
+    if isinstance(values, str):
+        values = values.split(',')
+    return [v.strip().lower().replace(' ', '') for v in values if v.strip() != '']
+
+def parse_aggregate_expression(label):
+    # 'function(property)' returns the function and the property and a bare
+    # name returns the name and None
+    if label.endswith(')') and '(' in label:
+        function, p = label[:-1].split('(', 1)
+        return function, p
+    return label, None
+
+def get_quantile(function):
+    if function == 'median':
+        return 0.5
+    if function.startswith('p') and function[1:].isdigit() and 1 <= int(function[1:]) <= 99:
+        return int(function[1:]) / 100
+    return None
+
+def get_aggregate_properties(groups, aggregates):
+    # the properties to extract for the groups and aggregates
+    properties = [p for label, p, bucket in groups] + [p for label, function, p, quantile in aggregates if p is not None]
+    return list(OrderedDict.fromkeys(properties))
+
+def get_aggregate_pages(pages, groups, aggregates):
+
+    # summarize the rows in a single pass as the pages stream through,
+    # keeping a Summary of each aggregated property for each group, and
+    # return the summary rows as a single page once every page is read
+    sampled = set(p for label, function, p, quantile in aggregates if quantile is not None)
+    summarized = list(OrderedDict.fromkeys(p for label, function, p, quantile in aggregates if p is not None))
+    summaries = {}
+
+    for rows in pages:
+        with profiler.phase('aggregate'):
+            for row in rows:
+                key = tuple(to_group_value(row.get(p), bucket) for label, p, bucket in groups)
+                summary = summaries.get(key)
+                if summary is None:
+                    summary = summaries[key] = [0, {p: Summary(p in sampled) for p in summarized}]
+                summary[0] += 1
+                for p, values in summary[1].items():
+                    values.add(row.get(p))
+
+    rows = []
+    for key in sorted(summaries.keys(), key=lambda key: [(v is not None, v) for v in key]):
+        count, values = summaries[key]
+        row = OrderedDict(zip([label for label, p, bucket in groups], key))
+        for label, function, p, quantile in aggregates:
+            row[label] = count if p is None else values[p].get(function, quantile)
+        rows.append(row)
+    yield rows
+
+def to_group_value(value, bucket):
+
+    # dates are grouped by the first day of the day, week or month they're in
+    if value is None or value == '':
+        return None
+    if bucket == 'day':
+        return value[:10]
+    if bucket == 'week':
+        day = date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        return (day - timedelta(days=day.weekday())).isoformat()
+    if bucket == 'month':
+        return value[:7] + '-01'
+    return value
+
+class Summary:
+
+    # the running count, sum, min and max of the values of a property and,
+    # for quantiles, a uniform sample of QUANTILE_SAMPLE_SIZE of its numeric
+    # values (reservoir sampling) so memory stays the same however many
+    # values there are; the sample is seeded so a summary is repeatable
+
+    def __init__(self, sampled=False):
+        self.count = 0
+        self.numeric = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.sample = [] if sampled else None
+        self.random = random.Random(0) if sampled else None
+
+    def add(self, value):
+        if value is None or value == '':
+            return
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        self.numeric += 1
+        self.sum += value
+        if self.sample is None:
+            return
+        if len(self.sample) < QUANTILE_SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            i = self.random.randrange(self.numeric)
+            if i < QUANTILE_SAMPLE_SIZE:
+                self.sample[i] = value
+
+    def get(self, function, quantile=None):
+        if function == 'count':
+            return self.count
+        if function == 'min':
+            return self.min
+        if function == 'max':
+            return self.max
+        if self.numeric == 0:
+            return None
+        if function == 'sum':
+            return self.sum
+        if function == 'mean':
+            return self.sum / self.numeric
+        return self.quantile(quantile)
+
+    def quantile(self, q):
+        # linear interpolation between the closest ranks of the sample
+        values = sorted(self.sample)
+        position = q * (len(values) - 1)
+        i = int(position)
+        if i + 1 >= len(values):
+            return values[i]
+        return values[i] + (values[i + 1] - values[i]) * (position - i)
+
+def get_output_format(params):
+
+    output_format = str(dict(params).get('format') or 'ndjson').strip().lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Invalid format: must be one of ' + ', '.join(OUTPUT_FORMATS.keys()))
+    return output_format
+
+def get_page_size(params):
+
+    page_size = dict(params).get('page_size') or MAX_PAGE_SIZE
+    try:
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page_size: ' + str(page_size))
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ValueError('Invalid page_size: must be between 1 and ' + str(MAX_PAGE_SIZE))
+    return page_size
+
+def get_prefetch_depth(params):
+
+    prefetch_depth = dict(params).get('prefetch')
+    if prefetch_depth is None or prefetch_depth == '':
+        return PREFETCH_DEPTH
+    try:
+        prefetch_depth = int(prefetch_depth)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid prefetch: ' + str(prefetch_depth))
+    if prefetch_depth < 0 or prefetch_depth > MAX_PREFETCH_DEPTH:
+        raise ValueError('Invalid prefetch: must be between 0 and ' + str(MAX_PREFETCH_DEPTH))
+    return prefetch_depth
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+def prefetch(iterable, depth):
+
+    # iterate on a background thread so the next page is fetched while the
+    # current one is transformed and written; at most depth pages are held
+    # ahead of the consumer
+    if depth <= 0:
+        yield from iterable
+        return
+
+    pages = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(value):
+        while not stopped.is_set():
+            try:
+                pages.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in iterable:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            page, error = pages.get()
+            if page is done:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        stopped.set()
+
+# connection pool and retry policy for the shared session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = (500, 502, 503, 504) # 429s are handled by send_request
+REQUEST_TIMEOUT = (10, 60) # connect and read timeouts in seconds
+
+# successful responses are cached in CACHE_DIR when the cache_ttl param is
+# set; once the cache is larger than CACHE_MAX_BYTES, the least recently used
+# responses are evicted until it's down to CACHE_EVICT_TO of the cap, so a
+# full cache isn't scanned again on every write; the size of the cache is
+# kept as a running total that's checked against the directory every
+# CACHE_SCAN_SECONDS to pick up what other processes have cached
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'intercom-cache')
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_EVICT_TO = 0.9
+CACHE_SCAN_SECONDS = 60
+_cache_size = {'bytes': None, 'scanned_at': 0}
+_cache_size_lock = threading.Lock()
+
+# the session is created once per process and reused for every page and
+# every warm invocation so the connection to the api is kept alive
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests_retry_session()
+    return _session
+
 def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(429, 500, 502, 503, 504),
+    retries=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_FORCELIST,
     session=None,
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -130,15 +770,356 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
+# requests are paced using the rate limit headers the api returns; the budget
+# is kept in a state file per access token so concurrent invocations of any
+# of the intercom functions share it; once fewer than RATE_LIMIT_RESERVE
+# requests remain, the remaining requests are spread evenly until the reset
+RATE_LIMIT_DIR = tempfile.gettempdir()
+RATE_LIMIT_RESERVE = 0.2 # fraction of the limit
+RATE_LIMIT_RETRIES = 10 # number of times to wait for the reset after a 429
+RATE_LIMIT_DEFAULT_WAIT = 10 # seconds to wait after a 429 without a reset header
+
+# counters for the requests sent and the time spent waiting on the rate limit
+rate_limit_stats = {
+    'requests': 0,
+    'rate_limited': 0,
+    'throttled': 0,
+    'throttled_seconds': 0.0
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(auth_header):
+    with _rate_limiters_lock:
+        if auth_header not in _rate_limiters:
+            _rate_limiters[auth_header] = RateLimiter(auth_header)
+        return _rate_limiters[auth_header]
+
+class RateLimiter:
+
+    def __init__(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(RATE_LIMIT_DIR, 'intercom-rate-limit-' + digest[:32] + '.json')
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+
+        # the thread lock coordinates threads in this process and the file
+        # lock coordinates other processes
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.load(f)
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+            finally:
+                os.close(fd)
+
+    def acquire(self):
+
+        wait = 0
+        with self.state() as state:
+            now = time.time()
+            limit = state.get('limit')
+            remaining = state.get('remaining')
+            reset = state.get('reset') or 0
+            if remaining is None or limit is None or reset <= now:
+                # nothing is known about the current window until a response
+                # comes back with the rate limit headers
+                state['remaining'] = None
+            elif remaining <= 0:
+                # the budget stays used up until the reset so that every
+                # caller waits for it, not just the first
+                wait = reset - now
+            elif remaining <= limit * RATE_LIMIT_RESERVE:
+                next_at = max(state.get('next_at') or 0, now)
+                wait = next_at - now
+                state['next_at'] = next_at + (reset - next_at) / remaining
+                state['remaining'] = remaining - 1
+            else:
+                state['remaining'] = remaining - 1
+
+        with _rate_limiters_lock:
+            rate_limit_stats['requests'] += 1
+            if wait > 0:
+                rate_limit_stats['throttled'] += 1
+                rate_limit_stats['throttled_seconds'] += wait
+        if wait > 0:
+            with profiler.phase('throttle'):
+                time.sleep(wait)
+
+    def update(self, response):
+
+        limit = to_int(response.headers.get('X-RateLimit-Limit'))
+        remaining = to_int(response.headers.get('X-RateLimit-Remaining'))
+        reset = to_int(response.headers.get('X-RateLimit-Reset'))
+
+        if response.status_code == 429:
+            with _rate_limiters_lock:
+                rate_limit_stats['rate_limited'] += 1
+            remaining = 0
+            if reset is None or reset <= time.time():
+                reset = time.time() + RATE_LIMIT_DEFAULT_WAIT
+
+        if remaining is None or reset is None:
+            return
+
+        with self.state() as state:
+            # responses can arrive out of order, so within the same window
+            # only ever lower the remaining count
+            if reset == state.get('reset') and state.get('remaining') is not None:
+                remaining = min(remaining, state['remaining'])
+            state['limit'] = limit if limit is not None else state.get('limit')
+            state['remaining'] = remaining
+            state['reset'] = reset
+
+def send_request(method, url, headers, cache_ttl=0, **kwargs):
+
+    if cache_ttl > 0:
+        return send_cached_request(method, url, headers, cache_ttl, **kwargs)
+
+    # pace the request against the shared rate limit and, if the api still
+    # returns a 429, wait for the limit to reset and try again rather than
+    # failing the export
+    rate_limiter = get_rate_limiter(headers.get('Authorization', ''))
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        rate_limiter.acquire()
+        with profiler.phase('request'):
+            response = get_session().request(method, url, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs)
+        rate_limiter.update(response)
+        if profiler.enabled:
+            retries = getattr(response.raw, 'retries', None)
+            profiler.count('requests')
+            profiler.count('retries', len(retries.history) if retries is not None else 0)
+            profiler.count('rate_limited', 1 if response.status_code == 429 else 0)
+            profiler.count('bytes_received', len(response.content))
+        if response.status_code != 429:
+            break
+    return response
+
+def send_cached_request(method, url, headers, cache_ttl, **kwargs):
+
+    # successful responses are cached by access token, method, url and body;
+    # concurrent requests for the same key wait on the key's lock so only the
+    # first one calls the api and the rest read what it cached; requests for
+    # other keys don't wait, even while the first one waits on the rate limit
+    key = json.dumps([headers.get('Authorization', ''), method, url, kwargs.get('json')], sort_keys=True)
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    path = os.path.join(CACHE_DIR, key + '.z')
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with cache_lock(path + '.lock'):
+        body = read_cache(path, cache_ttl)
+        if body is not None:
+            profiler.count('cache_hits')
+            return to_cached_response(url, body)
+        response = send_request(method, url, headers, **kwargs)
+        if response.status_code == 200:
+            write_cache(path, response.content)
+        return response
+
+@contextlib.contextmanager
+def cache_lock(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def read_cache(path, cache_ttl):
+
+    # the modified time is when the response was cached and the access time
+    # is when it was last used, which is what eviction goes by
+    try:
+        stat = os.stat(path)
+        if time.time() - stat.st_mtime > cache_ttl:
+            return None
+        with open(path, 'rb') as f:
+            body = zlib.decompress(f.read())
+        os.utime(path, (time.time(), stat.st_mtime))
+        return body
+    except (OSError, zlib.error):
+        return None
+
+def write_cache(path, body):
+
+    body = zlib.compress(body)
+    try:
+        replaced_size = os.stat(path).st_size
+    except OSError:
+        replaced_size = 0
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.replace(temp_path, path)
+
+    # only scan the cache when the running total is over the cap or hasn't
+    # been checked against the directory for a while
+    with _cache_size_lock:
+        if _cache_size['bytes'] is not None:
+            _cache_size['bytes'] += len(body) - replaced_size
+            if _cache_size['bytes'] <= CACHE_MAX_BYTES and time.time() - _cache_size['scanned_at'] < CACHE_SCAN_SECONDS:
+                return
+        _cache_size['bytes'] = evict_cache()
+        _cache_size['scanned_at'] = time.time()
+
+def evict_cache():
+
+    # evict the least recently used responses once the cache is over its cap
+    # and return the size of what's left
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.z'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= CACHE_MAX_BYTES:
+        return total_size
+    for _, size, entry_path in sorted(entries):
+        if total_size <= CACHE_MAX_BYTES * CACHE_EVICT_TO:
+            break
+        for evicted_path in (entry_path, entry_path + '.lock'):
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+        total_size -= size
+    return total_size
+
+def to_cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    response.elapsed = timedelta(0)
+    response._content = body
+    return response
+
+def decode_response(response):
+
+    # decode straight from the response bytes
+    with profiler.phase('decode'):
+        return json_loads(response.content)
+
+# json is decoded and encoded with orjson when it's installed and with the
+# stdlib json module otherwise
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def get_encoder():
+    if orjson is not None:
+        return OrjsonEncoder(default=to_string)
+    # the same output as orjson: no spaces after the separators, and utf-8
+    # rather than escaped unicode
+    return json.JSONEncoder(default=to_string, separators=(',', ':'), ensure_ascii=False)
+
+class OrjsonEncoder:
+
+    # the same encode() interface as json.JSONEncoder; orjson handles dates
+    # and datetimes itself and calls default for anything else (e.g. Decimal)
+    def __init__(self, default=None):
+        self.default = default
+
+    def encode(self, value):
+        return orjson.dumps(value, default=self.default).decode('utf-8')
+
+def to_ndjson(rows, encoder):
+    # join the page once rather than appending each row to it, which copies
+    # the page for every row
+    return ''.join([encoder.encode(row) + "\n" for row in rows])
+
+def to_table(rows, encoder):
+    # rows are built in property order, so only the values need writing
+    return ''.join([encoder.encode(list(row.values())) + "\n" for row in rows])
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows([to_csv_value(value) for value in row.values()] for row in rows)
+    return buffer.getvalue()
+
+def to_csv_value(value):
+    # None is written as an empty field by the csv writer
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=to_string)
+    return value
+
+def get_serializer(output_format, encoder):
+    if output_format == 'table':
+        return lambda rows: to_table(rows, encoder)
+    if output_format == 'csv':
+        return to_csv
+    return lambda rows: to_ndjson(rows, encoder)
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 def to_date(ts):
     if ts is None or ts == '':
         return ''
-    return datetime.utcfromtimestamp(int(ts)/1000).strftime('%Y-%m-%dT%H:%M:%S')
+    # timestamps are in seconds; the date part is formatted once per day
+    days, seconds = divmod(int(ts), 86400)
+    day = _dates.get(days)
+    if day is None:
+        day = (EPOCH + timedelta(days=days)).strftime('%Y-%m-%d')
+        _dates[days] = day
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%sT%02d:%02d:%02d' % (day, hours, minutes, seconds)
+
+def to_dates(values):
+
+    # convert a list of timestamps at once; uses numpy when it's available
+    # and there are enough values to make it worthwhile
+    if np is None or len(values) < NUMPY_MIN_VALUES:
+        return [to_date(v) for v in values]
+    missing = [v is None or v == '' for v in values]
+    timestamps = np.array([0 if m else int(v) for v, m in zip(values, missing)], dtype='int64')
+    dates = np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s').tolist()
+    return ['' if m else d for d, m in zip(dates, missing)]
+
+def convert_dates(rows, properties):
+
+    # convert the timestamps for all the date properties of a page at once
+    if len(rows) == 0 or len(properties) == 0:
+        return rows
+    values = [row[p] for p in properties for row in rows]
+    dates = iter(to_dates(values))
+    for p in properties:
+        for row in rows:
+            row[p] = next(dates)
+    return rows
 
 def to_string(value):
     if isinstance(value, (date, datetime)):
@@ -147,23 +1128,183 @@ def to_string(value):
         return str(value)
     return value
 
-def get_item_info(item):
-
-    # map this function's property names to the API's property names
-    info = OrderedDict()
-
-    info['id'] = item.get('id')
-    info['company_id'] = item.get('company_id')
-    info['name'] = item.get('name')
-    info['created_at'] = to_date(item.get('created_at'))
-    info['remote_created_at'] = to_date(item.get('remote_created_at'))
-    info['updated_at'] = to_date(item.get('updated_at'))
-    info['last_request_at'] = to_date(item.get('last_request_at'))
-    info['session_count'] = item.get('session_count')
-    info['monthly_spend'] = item.get('monthly_spend')
-    info['user_count'] = item.get('user_count')
-    info['size'] = item.get('size')
-    info['website'] = item.get('website')
-    info['industry'] = item.get('industry')
-
-    return info
+# map this function's property names to the API's property names where they
+# differ; nested properties are given as a path (e.g. 'location.country')
+PROPERTY_PATHS = {}
+
+# properties with timestamps that are returned as dates
+DATE_PROPERTIES = (
+    'created_at',
+    'remote_created_at',
+    'updated_at',
+    'last_request_at',
+)
+
+# properties that can be used to look up a single company with the companies
+# api; there's no search api for companies, so other properties are filtered
+# locally
+LOOKUP_FIELDS = ('company_id', 'name')
+
+# the properties in the "returns" list in the header, for when this file
+# can't be read
+RETURNS = (
+    ('id', 'string'),
+    ('company_id', 'string'),
+    ('name', 'string'),
+    ('created_at', 'string'),
+    ('remote_created_at', 'string'),
+    ('updated_at', 'string'),
+    ('last_request_at', 'string'),
+    ('session_count', 'integer'),
+    ('monthly_spend', 'integer'),
+    ('user_count', 'integer'),
+    ('size', 'integer'),
+    ('website', 'string'),
+    ('industry', 'string'),
+)
+
+def get_returns():
+
+    # read the property names and types from the "returns" list in the
+    # header at the top of this file; when the file can't be read, such as
+    # when the runtime runs the code without a __file__, use RETURNS
+    try:
+        f = open(__file__, 'r', encoding='utf-8')
+    except (NameError, OSError):
+        return OrderedDict(RETURNS)
+    returns = OrderedDict()
+    in_returns = False
+    name = None
+    with f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            line = line[1:].rstrip()
+            indent = len(line) - len(line.lstrip())
+            line = line.strip()
+            if line == '---':
+                if in_returns:
+                    break
+                continue
+            if indent <= 1:
+                in_returns = line == 'returns:'
+                continue
+            if not in_returns:
+                continue
+            key, _, value = line.lstrip('- ').partition(':')
+            if line.startswith('- '):
+                name = None
+            if key == 'name':
+                name = value.strip()
+                returns[name] = 'string'
+            elif key == 'type' and name is not None:
+                returns[name] = value.strip()
+    return returns
+
+# the property names and types from the header
+PROPERTY_TYPES = get_returns()
+
+def get_properties(params):
+
+    # properties can be passed as a list or as a comma-delimited string;
+    # an empty list or '*' returns all properties
+    properties = dict(params).get('properties') or '*'
+    if isinstance(properties, str):
+        properties = properties.split(',')
+    properties = [p.strip().lower() for p in properties if p.strip() != '']
+    if len(properties) == 0 or '*' in properties:
+        return list(PROPERTY_TYPES.keys())
+
+    for p in properties:
+        if p not in PROPERTY_TYPES:
+            raise ValueError('Invalid property: ' + p)
+    return properties
+
+@functools.lru_cache(maxsize=32)
+def compile_item_extractor(properties, dates=True):
+
+    # generate a function that returns the given properties for an item;
+    # each nested object a property is read from is looked up once per item
+    # and missing or null objects are treated as empty; timestamps are left
+    # as is when dates is false so they can be converted a page at a time
+    lines = []
+    objects = {(): 'item'}
+
+    def get_object(path):
+        if path not in objects:
+            parent = get_object(path[:-1])
+            objects[path] = 'obj_' + str(len(objects))
+            lines.append('    %s = %s.get(%r) or EMPTY' % (objects[path], parent, path[-1]))
+        return objects[path]
+
+    values = []
+    for p in properties:
+        path = tuple(PROPERTY_PATHS.get(p, p).split('.'))
+        value = '%s.get(%r)' % (get_object(path[:-1]), path[-1])
+        if dates and p in DATE_PROPERTIES:
+            value = 'to_date(%s)' % value
+        values.append('        %r: %s,' % (p, value))
+
+    source = '\n'.join(['def get_item_info(item):'] + lines + ['    return {'] + values + ['    }'])
+    namespace = {'EMPTY': {}, 'to_date': to_date}
+    exec(compile(source, '<get_item_info>', 'exec'), namespace)
+    return namespace['get_item_info']
+
+def get_item_extractor(properties, dates=True):
+    return compile_item_extractor(tuple(properties), dates)
+
+def get_filter(params):
+
+    # the filter is a url query string (e.g. "industry=software&size=10"); keys
+    # are property names and repeated keys match any of the values; returns
+    # a lookup for a single company_id or name, which the companies api can
+    # handle directly, along with the remaining predicates to apply locally
+    filter_values = dict(params).get('filter') or ''
+    if isinstance(filter_values, dict):
+        filter_values = urllib.parse.urlencode(filter_values, doseq=True)
+    filter_values = urllib.parse.parse_qs(filter_values, keep_blank_values=True)
+
+    lookup = None
+    local_filter = OrderedDict()
+    for key, values in filter_values.items():
+        key = key.strip().lower()
+        if key not in PROPERTY_TYPES:
+            raise ValueError('Invalid filter property: ' + key)
+        values = get_filter_values(key, values)
+        if lookup is None and key in LOOKUP_FIELDS and len(values) == 1 and values[0] != '':
+            lookup = {key: values[0]}
+            continue
+        local_filter[key] = set(to_filter_value(v) for v in values)
+    return lookup, local_filter
+
+def get_filter_values(key, values):
+    # surrounding whitespace is ignored, and true and false in any case
+    if PROPERTY_TYPES[key] == 'boolean':
+        return [v.strip().lower() for v in values]
+    return [v.strip() for v in values]
+
+def get_filter_matcher(local_filter):
+
+    # build a matcher that only computes the properties being filtered
+    get_item_info = get_item_extractor(list(local_filter.keys()))
+    predicates = list(local_filter.items())
+    if len(predicates) == 0:
+        return lambda item: True
+
+    def matches_filter(item):
+        info = get_item_info(item)
+        for p, values in predicates:
+            if to_filter_value(info[p]) not in values:
+                return False
+        return True
+
+    return matches_filter
+
+def to_filter_value(value):
+    # values match exactly, as they do with the search api, so a filter
+    # returns the same records whether it's applied by the api or locally
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
@@ -0,0 +1,953 @@
+
+# ---
+# name: intercom-conversation-parts
+# deployed: true
+# config: index
+# title: Intercom Conversation Parts
+# description: Returns the parts (replies, notes, assignments, etc) of conversations from Intercom
+# params:
+#   - name: properties
+#     type: array
+#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     required: false
+#   - name: filter
+#     type: string
+#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter. Values match exactly, including case, except for true and false.
+#     required: false
+#   - name: ordered
+#     type: boolean
+#     description: Whether to return the parts in the same order as the conversations are listed; otherwise parts are returned as soon as they're fetched (defaults to true)
+#     required: false
+#   - name: concurrency
+#     type: integer
+#     description: The number of conversations to fetch at the same time (defaults to 8; up to 256, or up to 15 when aiohttp isn't installed)
+#     required: false
+# returns:
+#   - name: id
+#     type: string
+#     description: The id of the conversation part
+#   - name: conversation_id
+#     type: string
+#     description: The id of the conversation the part belongs to
+#   - name: part_type
+#     type: string
+#     description: The type of conversation part (e.g. comment, note, assignment, close, open)
+#   - name: body
+#     type: string
+#     description: The message body of the conversation part
+#   - name: created_at
+#     type: string
+#     description: The time the conversation part was created
+#   - name: updated_at
+#     type: string
+#     description: The last time the conversation part was updated
+#   - name: notified_at
+#     type: string
+#     description: The time the user was notified of the conversation part
+#   - name: assigned_to_type
+#     type: string
+#     description: The type of the admin or team the conversation was assigned to by the part
+#   - name: assigned_to_id
+#     type: string
+#     description: The id of the admin or team the conversation was assigned to by the part
+#   - name: author_type
+#     type: string
+#     description: The type of author of the conversation part
+#   - name: author_id
+#     type: string
+#     description: The id of the author of the conversation part
+#   - name: author_name
+#     type: string
+#     description: The name of the author of the conversation part
+#   - name: author_email
+#     type: string
+#     description: The email address of the author of the conversation part
+#   - name: external_id
+#     type: string
+#     description: The external id of the conversation part
+#   - name: redacted
+#     type: boolean
+#     description: Whether the conversation part has been redacted
+# examples:
+#   - '""'
+#   - '"conversation_id, part_type, author_name, created_at"'
+# ---
+
+import os
+import sys
+import json
+import urllib
+import hashlib
+import tempfile
+import time
+import asyncio
+import threading
+import functools
+import contextlib
+import collections
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from datetime import date, datetime, timedelta
+from decimal import *
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# maximum number of conversations the api returns per page
+MAX_PAGE_SIZE = 150
+
+# number of conversations to fetch at the same time by default and at most,
+# and the number of fetched conversations held for each one while waiting to
+# be written; all of the requests share the rate limit
+MAX_WORKERS = 8
+MAX_CONCURRENCY = 256
+PENDING_PER_WORKER = 4
+
+# timestamps are converted with numpy when it's installed and there are at
+# least NUMPY_MIN_VALUES of them to convert; otherwise the formatted date for
+# each day is cached and reused
+NUMPY_MIN_VALUES = 256
+EPOCH = datetime(1970, 1, 1)
+_dates = {}
+
+# per-phase timing and counters are off by default; set INTERCOM_PROFILE=1
+# to write a summary to stderr after each run and INTERCOM_PROFILE_TRACE to
+# a path to also write a chrome trace (chrome://tracing) of the phases
+PROFILE = os.environ.get('INTERCOM_PROFILE', '').strip().lower() in ('1', 'true', 'yes')
+PROFILE_TRACE_PATH = os.environ.get('INTERCOM_PROFILE_TRACE') or None
+
+class Profiler:
+
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+        self.events = [] if trace else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0) + (end - start)
+                if self.events is not None:
+                    self.events.append({
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.started) * 1000000,
+                        "dur": (end - start) * 1000000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident()
+                    })
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        summary = OrderedDict()
+        summary['elapsed'] = round(time.perf_counter() - self.started, 6)
+        summary['phases'] = OrderedDict((k, round(v, 6)) for k, v in self.times.items())
+        summary['counters'] = self.counters
+        return summary
+
+    def write(self, name):
+        sys.stderr.write(json.dumps({name: self.summary()}) + "\n")
+        if self.events is not None and PROFILE_TRACE_PATH is not None:
+            with open(PROFILE_TRACE_PATH, 'w') as f:
+                json.dump({"traceEvents": self.events}, f)
+
+class NullProfiler:
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def count(self, name, value=1):
+        pass
+
+_null_phase = contextlib.nullcontext()
+
+# the profiler for the current run
+profiler = NullProfiler()
+
+# main function entry point
+def flexio_handler(flex):
+
+    global profiler
+    profiler = Profiler(trace=PROFILE_TRACE_PATH is not None) if PROFILE else NullProfiler()
+
+    try:
+        flex.output.content_type = 'application/x-ndjson'
+        for data in get_data(flex.vars):
+            with profiler.phase('write'):
+                flex.output.write(data)
+            profiler.count('bytes_written', len(data))
+    finally:
+        if profiler.enabled:
+            profiler.write('intercom-conversation-parts')
+
+def get_data(params):
+
+    # get the api key from the variable input
+    auth_token = dict(params).get('intercom_connection',{}).get('access_token')
+
+    # get the properties to return
+    properties = get_properties(params)
+
+    # get the filter, which is applied to the parts as they stream through
+    local_filter = get_filter(params)
+    matches_filter = get_filter_matcher(local_filter)
+
+    # see here for more info:
+    # https://developers.intercom.com/intercom-api-reference/reference#list-conversations
+    # https://developers.intercom.com/intercom-api-reference/reference#retrieve-a-conversation
+
+    headers = {
+        'Accept': 'application/json',
+        'Authorization': 'Bearer ' + auth_token,
+        'Intercom-Version': '2.0' # api version
+    }
+
+    ordered = to_bool(dict(params).get('ordered', True))
+    concurrency = get_concurrency(params)
+
+    # a single encoder is reused for every record
+    encoder = get_encoder()
+
+    # with aiohttp, the conversations are fetched on an event loop, which
+    # keeps hundreds of requests in flight without a thread for each
+    if aiohttp is not None:
+        for rows in iterate_async(get_parts_async(headers, properties, matches_filter, ordered, concurrency)):
+            yield from to_output(rows, encoder)
+        return
+
+    # get the parts for each conversation as it's listed with a bounded pool
+    # of workers; in ordered mode the parts are written in the order the
+    # conversations are listed and otherwise as soon as they're fetched; the
+    # workers share the session with the listing, so there are no more of
+    # them than it keeps connections for
+    get_parts = functools.partial(get_conversation_parts, headers, properties, matches_filter)
+    conversation_ids = get_conversation_ids(headers)
+    concurrency = min(concurrency, POOL_MAXSIZE - 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        pending = collections.deque() if ordered else set()
+
+        for conversation_id in conversation_ids:
+            if len(pending) >= concurrency * PENDING_PER_WORKER:
+                for rows in get_completed(pending, ordered):
+                    yield from to_output(rows, encoder)
+            future = executor.submit(get_parts, conversation_id)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+
+        while len(pending) > 0:
+            for rows in get_completed(pending, ordered):
+                yield from to_output(rows, encoder)
+
+def get_completed(pending, ordered):
+
+    # in ordered mode wait for the oldest conversation; otherwise wait for
+    # any conversation and return all the ones that are done
+    if ordered:
+        return [pending.popleft().result()]
+    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    pending.difference_update(done)
+    return [future.result() for future in done]
+
+def to_output(rows, encoder):
+    with profiler.phase('encode'):
+        buffer = to_ndjson(rows, encoder)
+    if len(buffer) > 0:
+        yield buffer
+
+def get_conversation_ids(headers):
+
+    url_query_params = {"per_page": MAX_PAGE_SIZE}
+    url_query_str = urllib.parse.urlencode(url_query_params)
+    page_url = 'https://api.intercom.io/conversations' + '?' + url_query_str
+
+    while True:
+
+        response = send_request('GET', page_url, headers)
+        response.raise_for_status()
+        content = decode_response(response)
+        data = content.get('conversations',[])
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
+            break
+
+        for item in data:
+            yield item.get('id')
+
+        page_url = content.get('pages',{}).get('next')
+        if page_url is None:
+            break
+
+def get_conversation_parts(headers, properties, matches_filter, conversation_id):
+
+    # note: the api returns up to the 500 most recent parts of a conversation
+    page_url = 'https://api.intercom.io/conversations/' + urllib.parse.quote(str(conversation_id))
+    response = send_request('GET', page_url, headers)
+    response.raise_for_status()
+    return get_part_rows(decode_response(response), properties, matches_filter, conversation_id)
+
+def get_part_rows(content, properties, matches_filter, conversation_id):
+
+    parts = (content.get('conversation_parts') or {}).get('conversation_parts') or []
+
+    get_item_info = get_item_extractor(properties, dates=False)
+    date_properties = [p for p in properties if p in DATE_PROPERTIES]
+
+    with profiler.phase('transform'):
+        rows = []
+        for part in parts:
+            part['conversation_id'] = conversation_id
+            if matches_filter(part):
+                rows.append(get_item_info(part))
+        convert_dates(rows, date_properties)
+    profiler.count('rows', len(rows))
+    return rows
+
+async def get_parts_async(headers, properties, matches_filter, ordered, concurrency):
+
+    # the same as the thread pool in get_data, but with a task for each
+    # conversation and a connection pool that limits how many are fetched
+    # at the same time
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        get_parts = functools.partial(get_conversation_parts_async, session, headers, properties, matches_filter)
+        pending = collections.deque() if ordered else set()
+
+        try:
+            async for conversation_id in get_conversation_ids_async(session, headers):
+                if len(pending) >= concurrency * PENDING_PER_WORKER:
+                    for rows in await get_completed_async(pending, ordered):
+                        yield rows
+                task = asyncio.ensure_future(get_parts(conversation_id))
+                if ordered:
+                    pending.append(task)
+                else:
+                    pending.add(task)
+
+            while len(pending) > 0:
+                for rows in await get_completed_async(pending, ordered):
+                    yield rows
+        finally:
+            for task in pending:
+                task.cancel()
+
+async def get_completed_async(pending, ordered):
+    if ordered:
+        return [await pending.popleft()]
+    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    pending.difference_update(done)
+    return [task.result() for task in done]
+
+async def get_conversation_ids_async(session, headers):
+
+    url_query_params = {"per_page": MAX_PAGE_SIZE}
+    url_query_str = urllib.parse.urlencode(url_query_params)
+    page_url = 'https://api.intercom.io/conversations' + '?' + url_query_str
+
+    while True:
+
+        response = await send_request_async(session, 'GET', page_url, headers)
+        response.raise_for_status()
+        content = decode_response(response)
+        data = content.get('conversations',[])
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
+            break
+
+        for item in data:
+            yield item.get('id')
+
+        page_url = content.get('pages',{}).get('next')
+        if page_url is None:
+            break
+
+async def get_conversation_parts_async(session, headers, properties, matches_filter, conversation_id):
+    page_url = 'https://api.intercom.io/conversations/' + urllib.parse.quote(str(conversation_id))
+    response = await send_request_async(session, 'GET', page_url, headers)
+    response.raise_for_status()
+    return get_part_rows(decode_response(response), properties, matches_filter, conversation_id)
+
+def iterate_async(iterable):
+
+    # step through an async generator on an event loop of its own so that
+    # each item can be written before the loop continues
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterable.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(iterable.aclose())
+        loop.close()
+
+def get_concurrency(params):
+
+    concurrency = dict(params).get('concurrency') or MAX_WORKERS
+    try:
+        concurrency = int(concurrency)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid concurrency: ' + str(concurrency))
+    if concurrency < 1 or concurrency > MAX_CONCURRENCY:
+        raise ValueError('Invalid concurrency: must be between 1 and ' + str(MAX_CONCURRENCY))
+    return concurrency
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+# connection pool and retry policy for the shared session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = (500, 502, 503, 504) # 429s are handled by send_request
+REQUEST_TIMEOUT = (10, 60) # connect and read timeouts in seconds
+
+# the session is created once per process and reused for every page and
+# every warm invocation so the connection to the api is kept alive
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests_retry_session()
+    return _session
+
+def requests_retry_session(
+    retries=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_FORCELIST,
+    session=None,
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+):
+    session = session or requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# requests are paced using the rate limit headers the api returns; the budget
+# is kept in a state file per access token so concurrent invocations of any
+# of the intercom functions share it; once fewer than RATE_LIMIT_RESERVE
+# requests remain, the remaining requests are spread evenly until the reset
+RATE_LIMIT_DIR = tempfile.gettempdir()
+RATE_LIMIT_RESERVE = 0.2 # fraction of the limit
+RATE_LIMIT_RETRIES = 10 # number of times to wait for the reset after a 429
+RATE_LIMIT_DEFAULT_WAIT = 10 # seconds to wait after a 429 without a reset header
+
+# counters for the requests sent and the time spent waiting on the rate limit
+rate_limit_stats = {
+    'requests': 0,
+    'rate_limited': 0,
+    'throttled': 0,
+    'throttled_seconds': 0.0
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(auth_header):
+    with _rate_limiters_lock:
+        if auth_header not in _rate_limiters:
+            _rate_limiters[auth_header] = RateLimiter(auth_header)
+        return _rate_limiters[auth_header]
+
+class RateLimiter:
+
+    def __init__(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(RATE_LIMIT_DIR, 'intercom-rate-limit-' + digest[:32] + '.json')
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+
+        # the thread lock coordinates threads in this process and the file
+        # lock coordinates other processes
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.load(f)
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+            finally:
+                os.close(fd)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            with profiler.phase('throttle'):
+                time.sleep(wait)
+
+    def reserve(self):
+
+        # take a request from the budget and return how long to wait before
+        # sending it
+        wait = 0
+        with self.state() as state:
+            now = time.time()
+            limit = state.get('limit')
+            remaining = state.get('remaining')
+            reset = state.get('reset') or 0
+            if remaining is None or limit is None or reset <= now:
+                # nothing is known about the current window until a response
+                # comes back with the rate limit headers
+                state['remaining'] = None
+            elif remaining <= 0:
+                # the budget stays used up until the reset so that every
+                # caller waits for it, not just the first
+                wait = reset - now
+            elif remaining <= limit * RATE_LIMIT_RESERVE:
+                next_at = max(state.get('next_at') or 0, now)
+                wait = next_at - now
+                state['next_at'] = next_at + (reset - next_at) / remaining
+                state['remaining'] = remaining - 1
+            else:
+                state['remaining'] = remaining - 1
+
+        with _rate_limiters_lock:
+            rate_limit_stats['requests'] += 1
+            if wait > 0:
+                rate_limit_stats['throttled'] += 1
+                rate_limit_stats['throttled_seconds'] += wait
+        return wait
+
+    def update(self, response):
+
+        limit = to_int(response.headers.get('X-RateLimit-Limit'))
+        remaining = to_int(response.headers.get('X-RateLimit-Remaining'))
+        reset = to_int(response.headers.get('X-RateLimit-Reset'))
+
+        if response.status_code == 429:
+            with _rate_limiters_lock:
+                rate_limit_stats['rate_limited'] += 1
+            remaining = 0
+            if reset is None or reset <= time.time():
+                reset = time.time() + RATE_LIMIT_DEFAULT_WAIT
+
+        if remaining is None or reset is None:
+            return
+
+        with self.state() as state:
+            # responses can arrive out of order, so within the same window
+            # only ever lower the remaining count
+            if reset == state.get('reset') and state.get('remaining') is not None:
+                remaining = min(remaining, state['remaining'])
+            state['limit'] = limit if limit is not None else state.get('limit')
+            state['remaining'] = remaining
+            state['reset'] = reset
+
+def send_request(method, url, headers, **kwargs):
+
+    # pace the request against the shared rate limit and, if the api still
+    # returns a 429, wait for the limit to reset and try again rather than
+    # failing the export
+    rate_limiter = get_rate_limiter(headers.get('Authorization', ''))
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        rate_limiter.acquire()
+        with profiler.phase('request'):
+            response = get_session().request(method, url, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs)
+        rate_limiter.update(response)
+        if profiler.enabled:
+            retries = getattr(response.raw, 'retries', None)
+            profiler.count('requests')
+            profiler.count('retries', len(retries.history) if retries is not None else 0)
+            profiler.count('rate_limited', 1 if response.status_code == 429 else 0)
+            profiler.count('bytes_received', len(response.content))
+        if response.status_code != 429:
+            break
+    return response
+
+async def send_request_async(session, method, url, headers, **kwargs):
+
+    # the same as send_request, but waits without blocking the event loop;
+    # the rate limiter locks and reads its state file, so it's called on the
+    # loop's executor rather than on the loop
+    loop = asyncio.get_event_loop()
+    rate_limiter = get_rate_limiter(headers.get('Authorization', ''))
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        wait = await loop.run_in_executor(None, rate_limiter.reserve)
+        if wait > 0:
+            with profiler.phase('throttle'):
+                await asyncio.sleep(wait)
+        with profiler.phase('request'):
+            response, retries = await request_retry_async(session, method, url, headers, **kwargs)
+        await loop.run_in_executor(None, rate_limiter.update, response)
+        if profiler.enabled:
+            profiler.count('requests')
+            profiler.count('retries', retries)
+            profiler.count('rate_limited', 1 if response.status_code == 429 else 0)
+            profiler.count('bytes_received', len(response.content))
+        if response.status_code != 429:
+            break
+    return response
+
+async def request_retry_async(
+    session,
+    method,
+    url,
+    headers,
+    retries=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_FORCELIST,
+    **kwargs
+):
+
+    # retry connection errors, timeouts and the statuses in status_forcelist
+    # the same way as requests_retry_session: no wait before the first retry,
+    # then backoff_factor doubled for each retry after it, or the time in the
+    # Retry-After header of a 503
+    wait = 0
+    for retry in range(retries + 1):
+        if wait > 0:
+            await asyncio.sleep(wait)
+        wait = backoff_factor * (2 ** retry) if retry > 0 else 0
+        try:
+            async with session.request(method, url, headers=headers, **kwargs) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if retry == retries:
+                raise
+            continue
+        if response.status in status_forcelist and retry < retries:
+            if response.status == 503:
+                wait = to_int(response.headers.get('Retry-After')) or wait
+            continue
+        return to_response(url, response.status, response.headers, body), retry
+
+def to_response(url, status, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    response.headers.update(headers)
+    response.elapsed = timedelta(0)
+    response._content = body
+    return response
+
+def decode_response(response):
+
+    # decode straight from the response bytes
+    with profiler.phase('decode'):
+        return json_loads(response.content)
+
+# json is decoded and encoded with orjson when it's installed and with the
+# stdlib json module otherwise
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def get_encoder():
+    if orjson is not None:
+        return OrjsonEncoder(default=to_string)
+    # the same output as orjson: no spaces after the separators, and utf-8
+    # rather than escaped unicode
+    return json.JSONEncoder(default=to_string, separators=(',', ':'), ensure_ascii=False)
+
+class OrjsonEncoder:
+
+    # the same encode() interface as json.JSONEncoder; orjson handles dates
+    # and datetimes itself and calls default for anything else (e.g. Decimal)
+    def __init__(self, default=None):
+        self.default = default
+
+    def encode(self, value):
+        return orjson.dumps(value, default=self.default).decode('utf-8')
+
+def to_ndjson(rows, encoder):
+    # join the page once rather than appending each row to it, which copies
+    # the page for every row
+    return ''.join([encoder.encode(row) + "\n" for row in rows])
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_date(ts):
+    if ts is None or ts == '':
+        return ''
+    # timestamps are in seconds; the date part is formatted once per day
+    days, seconds = divmod(int(ts), 86400)
+    day = _dates.get(days)
+    if day is None:
+        day = (EPOCH + timedelta(days=days)).strftime('%Y-%m-%d')
+        _dates[days] = day
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%sT%02d:%02d:%02d' % (day, hours, minutes, seconds)
+
+def to_dates(values):
+
+    # convert a list of timestamps at once; uses numpy when it's available
+    # and there are enough values to make it worthwhile
+    if np is None or len(values) < NUMPY_MIN_VALUES:
+        return [to_date(v) for v in values]
+    missing = [v is None or v == '' for v in values]
+    timestamps = np.array([0 if m else int(v) for v, m in zip(values, missing)], dtype='int64')
+    dates = np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s').tolist()
+    return ['' if m else d for d, m in zip(dates, missing)]
+
+def convert_dates(rows, properties):
+
+    # convert the timestamps for all the date properties of a page at once
+    if len(rows) == 0 or len(properties) == 0:
+        return rows
+    values = [row[p] for p in properties for row in rows]
+    dates = iter(to_dates(values))
+    for p in properties:
+        for row in rows:
+            row[p] = next(dates)
+    return rows
+
+def to_string(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (Decimal)):
+        return str(value)
+    return value
+
+# map this function's property names to the API's property names where they
+# differ; nested properties are given as a path (e.g. 'author.name')
+PROPERTY_PATHS = {
+    'assigned_to_type': 'assigned_to.type',
+    'assigned_to_id': 'assigned_to.id',
+    'author_type': 'author.type',
+    'author_id': 'author.id',
+    'author_name': 'author.name',
+    'author_email': 'author.email',
+}
+
+# properties with timestamps that are returned as dates
+DATE_PROPERTIES = (
+    'created_at',
+    'updated_at',
+    'notified_at',
+)
+
+# the properties in the "returns" list in the header, for when this file
+# can't be read
+RETURNS = (
+    ('id', 'string'),
+    ('conversation_id', 'string'),
+    ('part_type', 'string'),
+    ('body', 'string'),
+    ('created_at', 'string'),
+    ('updated_at', 'string'),
+    ('notified_at', 'string'),
+    ('assigned_to_type', 'string'),
+    ('assigned_to_id', 'string'),
+    ('author_type', 'string'),
+    ('author_id', 'string'),
+    ('author_name', 'string'),
+    ('author_email', 'string'),
+    ('external_id', 'string'),
+    ('redacted', 'boolean'),
+)
+
+def get_returns():
+
+    # read the property names and types from the "returns" list in the
+    # header at the top of this file; when the file can't be read, such as
+    # when the runtime runs the code without a __file__, use RETURNS
+    try:
+        f = open(__file__, 'r', encoding='utf-8')
+    except (NameError, OSError):
+        return OrderedDict(RETURNS)
+    returns = OrderedDict()
+    in_returns = False
+    name = None
+    with f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            line = line[1:].rstrip()
+            indent = len(line) - len(line.lstrip())
+            line = line.strip()
+            if line == '---':
+                if in_returns:
+                    break
+                continue
+            if indent <= 1:
+                in_returns = line == 'returns:'
+                continue
+            if not in_returns:
+                continue
+            key, _, value = line.lstrip('- ').partition(':')
+            if line.startswith('- '):
+                name = None
+            if key == 'name':
+                name = value.strip()
+                returns[name] = 'string'
+            elif key == 'type' and name is not None:
+                returns[name] = value.strip()
+    return returns
+
+# the property names and types from the header
+PROPERTY_TYPES = get_returns()
+
+def get_properties(params):
+
+    # properties can be passed as a list or as a comma-delimited string;
+    # an empty list or '*' returns all properties
+    properties = dict(params).get('properties') or '*'
+    if isinstance(properties, str):
+        properties = properties.split(',')
+    properties = [p.strip().lower() for p in properties if p.strip() != '']
+    if len(properties) == 0 or '*' in properties:
+        return list(PROPERTY_TYPES.keys())
+
+    for p in properties:
+        if p not in PROPERTY_TYPES:
+            raise ValueError('Invalid property: ' + p)
+    return properties
+
+@functools.lru_cache(maxsize=32)
+def compile_item_extractor(properties, dates=True):
+
+    # generate a function that returns the given properties for an item;
+    # each nested object a property is read from is looked up once per item
+    # and missing or null objects are treated as empty; timestamps are left
+    # as is when dates is false so they can be converted a page at a time
+    lines = []
+    objects = {(): 'item'}
+
+    def get_object(path):
+        if path not in objects:
+            parent = get_object(path[:-1])
+            objects[path] = 'obj_' + str(len(objects))
+            lines.append('    %s = %s.get(%r) or EMPTY' % (objects[path], parent, path[-1]))
+        return objects[path]
+
+    values = []
+    for p in properties:
+        path = tuple(PROPERTY_PATHS.get(p, p).split('.'))
+        value = '%s.get(%r)' % (get_object(path[:-1]), path[-1])
+        if dates and p in DATE_PROPERTIES:
+            value = 'to_date(%s)' % value
+        values.append('        %r: %s,' % (p, value))
+
+    source = '\n'.join(['def get_item_info(item):'] + lines + ['    return {'] + values + ['    }'])
+    namespace = {'EMPTY': {}, 'to_date': to_date}
+    exec(compile(source, '<get_item_info>', 'exec'), namespace)
+    return namespace['get_item_info']
+
+def get_item_extractor(properties, dates=True):
+    return compile_item_extractor(tuple(properties), dates)
+
+def get_filter(params):
+
+    # the filter is a url query string (e.g. "part_type=note&author_type=admin");
+    # keys are property names and repeated keys match any of the values
+    filter_values = dict(params).get('filter') or ''
+    if isinstance(filter_values, dict):
+        filter_values = urllib.parse.urlencode(filter_values, doseq=True)
+    filter_values = urllib.parse.parse_qs(filter_values, keep_blank_values=True)
+
+    local_filter = OrderedDict()
+    for key, values in filter_values.items():
+        key = key.strip().lower()
+        if key not in PROPERTY_TYPES:
+            raise ValueError('Invalid filter property: ' + key)
+        values = get_filter_values(key, values)
+        local_filter[key] = set(to_filter_value(v) for v in values)
+    return local_filter
+
+def get_filter_values(key, values):
+    # surrounding whitespace is ignored, and true and false in any case
+    if PROPERTY_TYPES[key] == 'boolean':
+        return [v.strip().lower() for v in values]
+    return [v.strip() for v in values]
+
+def get_filter_matcher(local_filter):
+
+    # build a matcher that only computes the properties being filtered
+    get_item_info = get_item_extractor(list(local_filter.keys()))
+    predicates = list(local_filter.items())
+    if len(predicates) == 0:
+        return lambda item: True
+
+    def matches_filter(item):
+        info = get_item_info(item)
+        for p, values in predicates:
+            if to_filter_value(info[p]) not in values:
+                return False
+        return True
+
+    return matches_filter
+
+def to_filter_value(value):
+    # values match exactly, as they do with the search api, so a filter
+    # returns the same records whether it's applied by the api or locally
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
@@ -8,11 +8,59 @@
 # params:
 #   - name: properties
 #     type: array
-#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     description: The properties to return (defaults to all properties except the assignee and last_closed_by names, which are only returned when they're listed since they're looked up from the admins and teams). See "Returns" for a listing of the available properties.
 #     required: false
 #   - name: filter
 #     type: string
-#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
+#     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter. Values match exactly, including case, except for true and false.
+#     required: false
+#   - name: page_size
+#     type: integer
+#     description: The number of records to request from Intercom per page (defaults to 150, the maximum allowed)
+#     required: false
+#   - name: prefetch
+#     type: integer
+#     description: The number of pages to fetch from Intercom ahead of the page being returned (defaults to 2; 0 fetches each page only after the previous one is returned; up to 16)
+#     required: false
+#   - name: adaptive
+#     type: boolean
+#     description: Whether to shrink the page size after timeouts or large responses and grow it back after fast responses (defaults to false)
+#     required: false
+#   - name: incremental
+#     type: boolean
+#     description: Whether to only fetch the conversations updated since the last incremental run and merge them into a locally cached copy (defaults to false)
+#     required: false
+#   - name: stream
+#     type: boolean
+#     description: Whether to parse each page as it's read from Intercom and return its conversations one at a time rather than reading the whole page first, which uses less memory for large pages (defaults to false)
+#     required: false
+#   - name: partitions
+#     type: integer
+#     description: The number of created_at ranges to split the conversations into and fetch at the same time (defaults to 1, which fetches them in order; up to 16)
+#     required: false
+#   - name: cache_ttl
+#     type: integer
+#     description: The number of seconds to reuse cached responses from Intercom for, such as when a spreadsheet recalculates (defaults to 0, which doesn't use the cache)
+#     required: false
+#   - name: format
+#     type: string
+#     description: The output format; "ndjson" returns an object per record, "table" returns a header row of property names followed by an array of values per record, and "csv" returns the same as comma-separated values (defaults to "ndjson")
+#     required: false
+#   - name: write_rows
+#     type: boolean
+#     description: Whether to write each record as soon as it's serialized rather than a page of records at a time, which keeps memory flat at the cost of more writes (defaults to false)
+#     required: false
+#   - name: resume
+#     type: boolean
+#     description: Whether to save a checkpoint after each page of conversations is returned so that if the export fails, running it again with the same params within an hour continues after the last page returned rather than starting over (defaults to false)
+#     required: false
+#   - name: group_by
+#     type: array
+#     description: The properties to group the conversations by for the aggregate summaries; date properties can be grouped by day(), week() or month(), e.g. "week(created_at)"
+#     required: false
+#   - name: aggregate
+#     type: array
+#     description: The summaries to return for each group instead of the conversations themselves: count, or the count(), sum(), min(), max(), mean(), median() or p1() to p99() of a property, e.g. "count, median(time_to_admin_reply)" (defaults to count when group_by is given); quantiles are approximate for groups with more than 1024 values
 #     required: false
 # returns:
 #   - name: id
@@ -75,6 +123,15 @@
 #   - name: assignee_id
 #     type: string
 #     description: The id of the assignee to the conversation
+#   - name: assignee_name
+#     type: string
+#     description: The name of the admin or team the conversation is assigned to
+#   - name: assignee_email
+#     type: string
+#     description: The email address of the admin the conversation is assigned to
+#   - name: assignee_team_names
+#     type: string
+#     description: The names of the teams the admin the conversation is assigned to belongs to, or the name of the team the conversation is assigned to
 #   - name: open
 #     type: boolean
 #     description: Whether a conversation is open or closed
@@ -135,6 +192,9 @@
 #   - name: last_closed_by_id
 #     type: string
 #     description: The id of the admin who closed the conversation
+#   - name: last_closed_by_name
+#     type: string
+#     description: The name of the admin who closed the conversation
 #   - name: count_reopens
 #     type: integer
 #     description: The number of reopens after first_contact_reply_at
@@ -149,68 +209,1022 @@
 #   - '"id, source_subject, state, created_at"'
 # ---
 
+import io
+import os
+import sys
+import csv
+import gzip
+import zlib
 import json
 import urllib
+import hashlib
+import tempfile
+import time
+import random
+import queue
+import threading
+import functools
+import contextlib
+import concurrent.futures
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from datetime import *
+from datetime import date, datetime, timedelta
 from decimal import *
 from collections import OrderedDict
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# maximum number of records the api returns per page
+MAX_PAGE_SIZE = 150
+
+# adaptive paging halves the page after a timeout or a response larger than
+# ADAPTIVE_MAX_RESPONSE_BYTES and doubles it after responses faster than
+# ADAPTIVE_FAST_RESPONSE_SECONDS
+ADAPTIVE_MIN_PAGE_SIZE = 10
+ADAPTIVE_MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+ADAPTIVE_FAST_RESPONSE_SECONDS = 1.0
+
+# incremental syncs keep a snapshot of every record in SNAPSHOT_DIR; records
+# updated up to INCREMENTAL_OVERLAP seconds before the last sync are fetched
+# again in case they were updated in the same second as the last sync
+SNAPSHOT_DIR = tempfile.gettempdir()
+SNAPSHOT_VERSION = 2
+INCREMENTAL_OVERLAP = 60
+
+# number of pages to fetch ahead of the page being written by default and at
+# most; 0 fetches each page only after the previous one is written
+PREFETCH_DEPTH = 2
+MAX_PREFETCH_DEPTH = 16
+
+# partitioned exports search up to MAX_PARTITIONS created_at ranges at the
+# same time; the records are split into RANGES_PER_PARTITION ranges for each
+# partition so a partition that finishes early can take another range
+MAX_PARTITIONS = 16
+RANGES_PER_PARTITION = 2
+
+# whether to write each record as it's serialized rather than a page at a
+# time when the write_rows param isn't given; writing each record keeps
+# memory flat at the cost of more writes
+WRITE_ROWS = False
+
+# output formats and their content types; the tabular formats write the
+# property names once in a header row instead of repeating them as keys
+# on every record
+OUTPUT_FORMATS = OrderedDict([
+    ('ndjson', 'application/x-ndjson'),
+    ('table', 'application/x-ndjson'),
+    ('csv', 'text/csv')
+])
+
+# admin and team names are resolved from a directory of the workspace's
+# admins and teams, which is fetched once and kept in memory for
+# DIRECTORY_TTL seconds so warm invocations reuse it
+DIRECTORY_TTL = 300
+_directories = {}
+_directories_lock = threading.Lock()
+
+# aggregate mode groups date properties into DATE_BUCKETS and computes
+# quantiles from a sample of at most QUANTILE_SAMPLE_SIZE values per group
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'min', 'max', 'mean')
+DATE_BUCKETS = ('day', 'week', 'month')
+QUANTILE_SAMPLE_SIZE = 1024
+
+# resumable exports save a checkpoint in CHECKPOINT_DIR with the position of
+# the next page after each page is written; the checkpoint is removed once
+# the export completes, and one older than CHECKPOINT_TTL is ignored since
+# its position may no longer be valid and the records may have changed
+CHECKPOINT_DIR = tempfile.gettempdir()
+CHECKPOINT_TTL = 3600 # seconds
+
+# timestamps are converted with numpy when it's installed and there are at
+# least NUMPY_MIN_VALUES of them to convert; otherwise the formatted date for
+# each day is cached and reused
+NUMPY_MIN_VALUES = 256
+EPOCH = datetime(1970, 1, 1)
+_dates = {}
+
+# per-phase timing and counters are off by default; set INTERCOM_PROFILE=1
+# to write a summary to stderr after each run and INTERCOM_PROFILE_TRACE to
+# a path to also write a chrome trace (chrome://tracing) of the phases
+PROFILE = os.environ.get('INTERCOM_PROFILE', '').strip().lower() in ('1', 'true', 'yes')
+PROFILE_TRACE_PATH = os.environ.get('INTERCOM_PROFILE_TRACE') or None
+
+class Profiler:
+
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+        self.events = [] if trace else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0) + (end - start)
+                if self.events is not None:
+                    self.events.append({
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.started) * 1000000,
+                        "dur": (end - start) * 1000000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident()
+                    })
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        summary = OrderedDict()
+        summary['elapsed'] = round(time.perf_counter() - self.started, 6)
+        summary['phases'] = OrderedDict((k, round(v, 6)) for k, v in self.times.items())
+        summary['counters'] = self.counters
+        return summary
+
+    def write(self, name):
+        sys.stderr.write(json.dumps({name: self.summary()}) + "\n")
+        if self.events is not None and PROFILE_TRACE_PATH is not None:
+            with open(PROFILE_TRACE_PATH, 'w') as f:
+                json.dump({"traceEvents": self.events}, f)
+
+class NullProfiler:
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def count(self, name, value=1):
+        pass
+
+_null_phase = contextlib.nullcontext()
+
+# the profiler for the current run
+profiler = NullProfiler()
+
 # main function entry point
 def flexio_handler(flex):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
-        flex.output.write(data)
+    global profiler
+    profiler = Profiler(trace=PROFILE_TRACE_PATH is not None) if PROFILE else NullProfiler()
+
+    try:
+        flex.output.content_type = OUTPUT_FORMATS[get_output_format(flex.vars)]
+        for data in get_data(flex.vars):
+            with profiler.phase('write'):
+                flex.output.write(data)
+            profiler.count('bytes_written', len(data))
+    finally:
+        if profiler.enabled:
+            profiler.write('intercom-conversations')
 
 def get_data(params):
 
     # get the api key from the variable input
     auth_token = dict(params).get('intercom_connection',{}).get('access_token')
 
+    # get the properties to return
+    properties = get_properties(params)
+
+    # in aggregate mode only the properties that are grouped and summarized
+    # are extracted, and summary rows are returned instead of the records
+    aggregation = get_aggregation(params)
+    if aggregation is not None:
+        properties = get_aggregate_properties(*aggregation)
+
+    # get the filter; predicates the search api supports are sent with the
+    # request and the rest are applied locally as the records stream through
+    search_query, local_filter = get_filter(params)
+    matches_filter = get_filter_matcher(local_filter)
+
     # see here for more info:
     # https://developers.intercom.com/intercom-api-reference/reference#conversation-model
     # https://developers.intercom.com/intercom-api-reference/reference#pagination
+    # https://developers.intercom.com/intercom-api-reference/reference#search-for-conversations
 
     headers = {
         'Accept': 'application/json',
         'Authorization': 'Bearer ' + auth_token,
         'Intercom-Version': '2.0' # api version
     }
-    url = 'https://api.intercom.io/conversations'
 
-    page_size = 50
-    url_query_params = {"per_page": page_size}
-    url_query_str = urllib.parse.urlencode(url_query_params)
-    page_url = url + '?' + url_query_str
+    page_size = get_page_size(params)
+    prefetch_depth = get_prefetch_depth(params)
+    cache_ttl = max(to_int(dict(params).get('cache_ttl')) or 0, 0)
+    adaptive = to_bool(dict(params).get('adaptive', False))
+    incremental = to_bool(dict(params).get('incremental', False))
+    partitions = get_partition_count(params)
+
+    # streamed pages are parsed as they're read rather than held whole, so
+    # they aren't cached; without ijson, pages are decoded whole as usual
+    stream = to_bool(dict(params).get('stream', False)) and ijson is not None
+    if stream:
+        cache_ttl = 0
+
+    # a resumable export continues from the checkpoint left by a failed run
+    # with the same params; pages are checkpointed once they've been written
+    # whole, so they aren't streamed; partitioned exports have no single
+    # position to continue from, and summaries are only written at the end
+    checkpoint_path, position, rows_written = None, None, 0
+    if to_bool(dict(params).get('resume', False)) and not incremental and partitions == 1 and aggregation is None:
+        checkpoint_path = get_checkpoint_path(auth_token, params)
+        position, rows_written = load_checkpoint(checkpoint_path)
+        stream = False
+
+    # a single encoder is reused for every record
+    encoder = get_encoder()
+    output_format = get_output_format(params)
+    serialize = get_serializer(output_format, encoder)
+    write_rows = to_bool(dict(params).get('write_rows', WRITE_ROWS))
+
+    # the admin and team names are looked up in the directory
+    directory = None
+    if any(p in RESOLVED_PROPERTIES for p in properties):
+        directory = get_directory(headers)
+
+    # incremental syncs update a local snapshot with the records changed
+    # since the last sync and return the records from the snapshot
+    if incremental:
+        items = sync_snapshot(auth_token, headers, page_size, adaptive, prefetch_depth)
+        search_query, local_filter = get_filter(params, local_only=True)
+        pages = get_snapshot_pages(items, properties, local_filter, page_size, directory)
+    elif partitions > 1:
+        pages = get_partitioned_pages(headers, page_size, search_query, partitions, adaptive, cache_ttl, stream, prefetch_depth)
+        pages = get_item_pages(pages, properties, matches_filter, directory=directory)
+    else:
+        pages = get_pages(headers, page_size, search_query, adaptive, cache_ttl, stream, position)
+        pages = get_item_pages(prefetch(pages, prefetch_depth), properties, matches_filter, checkpoint_path, rows_written, directory)
+
+    if aggregation is not None:
+        groups, aggregates = aggregation
+        pages = get_aggregate_pages(pages, groups, aggregates)
+        properties = [label for label, p, bucket in groups] + [label for label, function, p, quantile in aggregates]
+
+    # the tabular formats start with a header row of the property names,
+    # which a resumed export has already written
+    if output_format != 'ndjson' and position is None:
+        yield serialize([OrderedDict(zip(properties, properties))])
 
-    while True:
+    for rows in pages:
+        if write_rows:
+            for row in rows:
+                with profiler.phase('encode'):
+                    line = serialize([row])
+                yield line
+        else:
+            with profiler.phase('encode'):
+                buffer = serialize(rows)
+            if len(buffer) > 0:
+                yield buffer
+
+    if checkpoint_path is not None:
+        remove_checkpoint(checkpoint_path)
+
+def get_item_pages(pages, properties, matches_filter, checkpoint_path=None, rows_written=0, directory=None):
+
+    # extract the properties for each page, converting the dates for the
+    # whole page at once
+    get_item_info = get_item_extractor(properties, dates=False)
+    date_properties = [p for p in properties if p in DATE_PROPERTIES]
+    resolved_properties = [p for p in properties if p in RESOLVED_PROPERTIES]
+
+    for content in pages:
 
-        response = requests_retry_session().get(page_url, headers=headers)
-        response.raise_for_status()
-        content = response.json()
         data = content.get('conversations',[])
 
         if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
-        buffer = ''
-        for item in data:
-            item = get_item_info(item)
-            buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
+        with profiler.phase('transform'):
+            items = [item for item in data if matches_filter(item)]
+            rows = [get_item_info(item) for item in items]
+            convert_dates(rows, date_properties)
+            if directory is not None:
+                resolve_properties(rows, items, resolved_properties, directory)
+        profiler.count('rows', len(rows))
+        yield rows
+
+        # the pages ahead of this one may already have been fetched, but
+        # this point is only reached once this page has been written, so
+        # save where to continue from in case the export fails after it
+        if checkpoint_path is not None:
+            rows_written += len(rows)
+            position = get_next_position(content)
+            if position is not None:
+                save_checkpoint(checkpoint_path, position, rows_written)
+
+def get_pages(headers, page_size, search_query=None, adaptive=False, cache_ttl=0, stream=False, position=None):
+
+    # the list api pages with a next page url, so the page size can't change
+    # partway through; when the page size is adaptive, list everything with a
+    # search that matches all conversations instead since the search api
+    # pages with a cursor
+    if search_query is None and adaptive:
+        search_query = {"field": "created_at", "operator": ">", "value": 0}
+
+    if search_query is None:
+
+        url_query_params = {"per_page": page_size}
+        url_query_str = urllib.parse.urlencode(url_query_params)
+        page_url = position or 'https://api.intercom.io/conversations' + '?' + url_query_str
+
+        while True:
+
+            response = send_request('GET', page_url, headers, cache_ttl, stream=stream)
+            response.raise_for_status()
+            content = yield from get_response_pages(response, 'conversations', stream)
+
+            page_url = get_next_position(content)
+            if page_url is None:
+                break
+
+    else:
+
+        # note: the search api uses a cursor rather than a next page url
+        # https://developers.intercom.com/intercom-api-reference/reference#pagination-search
+        page_cursor_id = position
+        max_page_size = page_size
+
+        while True:
+
+            pagination = {"per_page": page_size}
+            if page_cursor_id is not None:
+                pagination['starting_after'] = page_cursor_id
+            search = {"query": search_query, "pagination": pagination}
+            page_url = 'https://api.intercom.io/conversations/search'
+
+            try:
+                response = send_request('POST', page_url, headers, cache_ttl, json=search, stream=stream)
+            except requests.exceptions.Timeout:
+                # retry the same cursor with a smaller page
+                if not adaptive or page_size <= ADAPTIVE_MIN_PAGE_SIZE:
+                    raise
+                page_size = max(page_size // 2, ADAPTIVE_MIN_PAGE_SIZE)
+                continue
+
+            response.raise_for_status()
+            content = yield from get_response_pages(response, 'conversations', stream)
+            if adaptive:
+                page_size = get_adaptive_page_size(page_size, max_page_size, response)
+
+            page_cursor_id = get_next_position(content)
+            if page_cursor_id is None:
+                break
+
+def get_partitioned_pages(headers, page_size, search_query, partitions, adaptive=False, cache_ttl=0, stream=False, prefetch_depth=PREFETCH_DEPTH):
+
+    # search each created_at range with its own cursor, with a thread for
+    # each partition taking the next range when it finishes one, and merge
+    # the pages as they arrive; a record returned by more than one range is
+    # only kept the first time, and empty pages are dropped since an empty
+    # page ends the export; the partitions are always fetched on their own
+    # threads, so at least a page is held for each one
+    ranges = get_partition_ranges(headers, search_query, partitions, page_size)
+    pages = [get_pages(headers, page_size, get_range_query(search_query, start, end), adaptive, cache_ttl, stream) for start, end in ranges]
+
+    ids = set()
+    for content in merge(pages, max(prefetch_depth, 1) * partitions, partitions):
+        data = []
+        for item in content.get('conversations',[]):
+            if item.get('id') not in ids:
+                ids.add(item.get('id'))
+                data.append(item)
+        if len(data) > 0:
+            yield {'conversations': data}
+
+def get_partition_ranges(headers, search_query, partitions, page_size):
+
+    # start with a single range from the first record created to the last
+    # and split the ranges with the most records in half until there are
+    # RANGES_PER_PARTITION ranges for each partition or the largest range is
+    # down to a page; each split only needs the total_count of one half since
+    # the other half has the rest, and the halves for each round of splits
+    # are probed at the same time
+    now = int(time.time()) + 1
+    query = get_range_query(search_query, 0, now)
+    max_ranges = partitions * RANGES_PER_PARTITION
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=partitions) as executor:
+
+        first = executor.submit(get_search_probe, headers, query, 'ascending')
+        last = executor.submit(get_search_probe, headers, query, 'descending')
+        first, last = first.result(), last.result()
+        count = first.get('total_count') or 0
+        if count == 0 or len(first.get('conversations') or []) == 0 or len(last.get('conversations') or []) == 0:
+            return []
+
+        start = int(first.get('conversations')[0].get('created_at') or 0)
+        end = int(last.get('conversations')[0].get('created_at') or 0) + 1
+        ranges = [(-count, start, end)]
+
+        while len(ranges) < max_ranges:
+            ranges.sort()
+            largest, ranges = ranges[:max_ranges - len(ranges)], ranges[max_ranges - len(ranges):]
+            splits = [r for r in largest if -r[0] > page_size and r[2] - r[1] >= 2]
+            ranges.extend(r for r in largest if r not in splits)
+            if len(splits) == 0:
+                break
+            probes = [executor.submit(get_search_probe, headers, get_range_query(search_query, start, (start + end) // 2)) for count, start, end in splits]
+            for (count, start, end), probe in zip(splits, probes):
+                left = probe.result().get('total_count') or 0
+                ranges.append((-left, start, (start + end) // 2))
+                ranges.append((count + left, (start + end) // 2, end))
+
+    # the last range also gets any records created since it was probed
+    ranges = sorted((start, end) for count, start, end in ranges)
+    ranges[-1] = (ranges[-1][0], now)
+    return ranges
+
+def get_search_probe(headers, search_query, order=None):
+
+    # a single record is enough for the total_count and, sorted by
+    # created_at, for when the first or last record was created
+    search = {"query": search_query, "pagination": {"per_page": 1}}
+    if order is not None:
+        search['sort'] = {"field": "created_at", "order": order}
+    response = send_request('POST', 'https://api.intercom.io/conversations/search', headers, json=search)
+    response.raise_for_status()
+    return decode_response(response)
+
+def get_range_query(search_query, start, end):
+
+    # the records created from start up to but not including end; the search
+    # api only allows a couple of levels of nesting, so an AND query is
+    # extended rather than nested
+    clauses = [
+        {"field": "created_at", "operator": ">", "value": start - 1},
+        {"field": "created_at", "operator": "<", "value": end}
+    ]
+    if search_query is not None and search_query.get('operator') == 'AND':
+        clauses.extend(search_query.get('value'))
+    elif search_query is not None:
+        clauses.append(search_query)
+    return {"operator": "AND", "value": clauses}
+
+def sync_snapshot(auth_token, headers, page_size, adaptive, prefetch_depth=PREFETCH_DEPTH):
 
-        page_url = content.get('pages',{}).get('next')
-        if page_url is None:
+    # the snapshot stores the values of every property for each record by id
+    # along with the latest updated_at; records updated after it are fetched
+    # with the search api and merged in, and a full list is fetched when
+    # there's no snapshot yet; the admin and team names aren't stored since
+    # they can change without the conversation changing, so they're looked
+    # up from the ids when the snapshot is read
+    path = get_snapshot_path(auth_token)
+    updated_at, items = load_snapshot(path)
+    properties = SNAPSHOT_PROPERTIES
+    get_item_info = get_item_extractor(properties, dates=False)
+    date_properties = [p for p in properties if p in DATE_PROPERTIES]
+
+    search_query = None
+    if updated_at is not None:
+        search_query = {"field": "updated_at", "operator": ">", "value": updated_at - INCREMENTAL_OVERLAP}
+
+    pages = get_pages(headers, page_size, search_query, adaptive)
+    for content in prefetch(pages, prefetch_depth):
+
+        data = content.get('conversations',[])
+
+        if len(data) == 0: # sanity check in case there's an issue with cursor
             break
 
+        rows = convert_dates([get_item_info(item) for item in data], date_properties)
+        for item, row in zip(data, rows):
+            items[item.get('id')] = list(row.values())
+            item_updated_at = item.get('updated_at')
+            if item_updated_at is not None and item_updated_at != '':
+                updated_at = max(updated_at or 0, int(item_updated_at))
+
+    save_snapshot(path, updated_at, items)
+    return items
+
+def get_snapshot_pages(items, properties, local_filter, page_size, directory=None):
+
+    # project and filter the snapshot values, which are stored in the order
+    # of the property getters, and look up the admin and team names from the
+    # ids in the directory
+    columns = SNAPSHOT_PROPERTIES
+    projection = [(p, columns.index(p) if p in columns else None) for p in properties]
+    predicates = [(columns.index(p), values) for p, values in local_filter.items()]
+    resolved_properties = [p for p in properties if p in RESOLVED_PROPERTIES]
+    ids = [columns.index(p) for p in ('assignee_type', 'assignee_id', 'last_closed_by_id')]
+
+    rows = []
+    for values in items.values():
+        if all(to_filter_value(values[i]) in v for i, v in predicates):
+            row = OrderedDict((p, values[i] if i is not None else None) for p, i in projection)
+            if directory is not None and len(resolved_properties) > 0:
+                resolve_row(row, resolved_properties, directory, *[values[i] for i in ids])
+            rows.append(row)
+        if len(rows) == page_size:
+            yield rows
+            rows = []
+    if len(rows) > 0:
+        yield rows
+
+def get_snapshot_path(auth_token):
+    key = hashlib.sha256(('intercom-conversations:' + auth_token).encode('utf-8')).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, 'intercom-conversations-' + key[:32] + '.json.gz')
+
+def load_snapshot(path):
+
+    # a snapshot written with a different version or set of properties is
+    # ignored so the next sync fetches everything again
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None, OrderedDict()
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('properties') != SNAPSHOT_PROPERTIES:
+        return None, OrderedDict()
+    return snapshot.get('updated_at'), snapshot.get('items', OrderedDict())
+
+def save_snapshot(path, updated_at, items):
+
+    # write to a temporary file first so a concurrent sync never reads a
+    # partially written snapshot
+    snapshot = OrderedDict()
+    snapshot['version'] = SNAPSHOT_VERSION
+    snapshot['properties'] = SNAPSHOT_PROPERTIES
+    snapshot['updated_at'] = updated_at
+    snapshot['items'] = items
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f, default=to_string)
+    os.replace(temp_path, path)
+
+def get_next_position(content):
+    # the list apis return the url of the next page and the contacts and
+    # search apis return a cursor to start the next page after
+    next_page = (content.get('pages') or {}).get('next')
+    if isinstance(next_page, dict):
+        return next_page.get('starting_after')
+    return next_page
+
+def get_checkpoint_path(auth_token, params):
+    # a checkpoint is only used by a run with the same params
+    params = {k: v for k, v in dict(params).items() if k not in ('intercom_connection', 'resume')}
+    key = json.dumps([auth_token, params], sort_keys=True, default=to_string)
+    key = hashlib.sha256(('intercom-conversations:' + key).encode('utf-8')).hexdigest()
+    return os.path.join(CHECKPOINT_DIR, 'intercom-conversations-checkpoint-' + key[:32] + '.json')
+
+def load_checkpoint(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None, 0
+    if time.time() - (checkpoint.get('saved_at') or 0) > CHECKPOINT_TTL:
+        return None, 0
+    return checkpoint.get('position'), checkpoint.get('rows') or 0
+
+def save_checkpoint(path, position, rows):
+    # write to a temporary file first so a failure never leaves a partially
+    # written checkpoint
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'position': position, 'rows': rows, 'saved_at': time.time()}, f)
+    os.replace(temp_path, path)
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def get_directory(headers):
+
+    # the directory is fetched for each access token the first time it's
+    # needed and again once it's older than DIRECTORY_TTL
+    key = headers.get('Authorization', '')
+    with _directories_lock:
+        fetched_at, directory = _directories.get(key, (0, None))
+        if directory is None or time.time() - fetched_at > DIRECTORY_TTL:
+            directory = fetch_directory(headers)
+            _directories[key] = (time.time(), directory)
+        return directory
+
+def fetch_directory(headers):
+
+    # see here for more info:
+    # https://developers.intercom.com/intercom-api-reference/reference#list-admins
+    # https://developers.intercom.com/intercom-api-reference/reference#list-teams
+    admins = get_directory_items(headers, 'https://api.intercom.io/admins', 'admins')
+    teams = get_directory_items(headers, 'https://api.intercom.io/teams', 'teams')
+
+    # index the admins and teams by id; the team names of an admin are the
+    # names of the teams that list the admin
+    admin_teams = {}
+    for team in teams:
+        for admin_id in team.get('admin_ids') or []:
+            admin_teams.setdefault(str(admin_id), []).append(team.get('name') or '')
+
+    directory = {'admin': {}, 'team': {}}
+    for admin in admins:
+        admin_id = str(admin.get('id'))
+        directory['admin'][admin_id] = {
+            'name': admin.get('name'),
+            'email': admin.get('email'),
+            'team_names': ', '.join(admin_teams.get(admin_id, [])) or None
+        }
+    for team in teams:
+        directory['team'][str(team.get('id'))] = {
+            'name': team.get('name'),
+            'team_names': team.get('name')
+        }
+    return directory
+
+def get_directory_items(headers, url, key):
+
+    # an access token that can't read the admins or teams leaves the names
+    # empty rather than failing the export
+    response = send_request('GET', url, headers)
+    if response.status_code in (401, 403, 404):
+        return []
+    response.raise_for_status()
+    return decode_response(response).get(key) or []
+
+def resolve_properties(rows, items, properties, directory):
+
+    # look up the admin or team for the ids in each conversation and fill in
+    # the resolved properties from them
+    if len(properties) == 0:
+        return
+    for row, item in zip(rows, items):
+        assignee = item.get('assignee') or EMPTY
+        statistics = item.get('statistics') or EMPTY
+        resolve_row(row, properties, directory, assignee.get('type'), assignee.get('id'), statistics.get('last_closed_by_id'))
+
+def resolve_row(row, properties, directory, assignee_type, assignee_id, last_closed_by_id):
+    admins, teams = directory['admin'], directory['team']
+    records = {
+        'assignee': (teams if assignee_type == 'team' else admins).get(str(assignee_id), EMPTY),
+        'last_closed_by': admins.get(str(last_closed_by_id), EMPTY)
+    }
+    for p in properties:
+        record, field = RESOLVED_PROPERTIES[p]
+        row[p] = records[record].get(field)
+
+def get_aggregation(params):
+
+    # group_by is a list of properties, where a date property can be grouped
+    # by day(), week() or month(); aggregate is a list of count, sum(), min(),
+    # max(), mean(), median() and p1() to p99() of properties, where count on
+    # its own counts the records in each group; returns None when neither is
+    # given
+    group_by = get_list_param(params, 'group_by')
+    aggregate = get_list_param(params, 'aggregate')
+    if len(group_by) == 0 and len(aggregate) == 0:
+        return None
+
+    groups = []
+    for label in group_by:
+        function, p = parse_aggregate_expression(label)
+        if p is None:
+            function, p = None, function
+        if p not in PROPERTY_TYPES or (function is not None and (function not in DATE_BUCKETS or p not in DATE_PROPERTIES)):
+            raise ValueError('Invalid group_by: ' + label)
+        groups.append((label, p, function))
+
+    aggregates = []
+    for label in aggregate or ['count']:
+        function, p = parse_aggregate_expression(label)
+        quantile = get_quantile(function)
+        if function == 'count' and p is None:
+            pass
+        elif p not in PROPERTY_TYPES or (function not in AGGREGATE_FUNCTIONS and quantile is None):
+            raise ValueError('Invalid aggregate: ' + label)
+        aggregates.append((label, function, p, quantile))
+
+    return groups, aggregates
+
+def get_list_param(params, name):
+    values = dict(params).get(name) or []
+    if isinstance(values, str):
+        values = values.split(',')
+    return [v.strip().lower().replace(' ', '') for v in values if v.strip() != '']
+
+def parse_aggregate_expression(label):
+    # 'function(property)' returns the function and the property and a bare
+    # name returns the name and None
+    if label.endswith(')') and '(' in label:
+        function, p = label[:-1].split('(', 1)
+        return function, p
+    return label, None
+
+def get_quantile(function):
+    if function == 'median':
+        return 0.5
+    if function.startswith('p') and function[1:].isdigit() and 1 <= int(function[1:]) <= 99:
+        return int(function[1:]) / 100
+    return None
+
+def get_aggregate_properties(groups, aggregates):
+    # the properties to extract for the groups and aggregates
+    properties = [p for label, p, bucket in groups] + [p for label, function, p, quantile in aggregates if p is not None]
+    return list(OrderedDict.fromkeys(properties))
+
+def get_aggregate_pages(pages, groups, aggregates):
+
+    # summarize the rows in a single pass as the pages stream through,
+    # keeping a Summary of each aggregated property for each group, and
+    # return the summary rows as a single page once every page is read
+    sampled = set(p for label, function, p, quantile in aggregates if quantile is not None)
+    summarized = list(OrderedDict.fromkeys(p for label, function, p, quantile in aggregates if p is not None))
+    summaries = {}
+
+    for rows in pages:
+        with profiler.phase('aggregate'):
+            for row in rows:
+                key = tuple(to_group_value(row.get(p), bucket) for label, p, bucket in groups)
+                summary = summaries.get(key)
+                if summary is None:
+                    summary = summaries[key] = [0, {p: Summary(p in sampled) for p in summarized}]
+                summary[0] += 1
+                for p, values in summary[1].items():
+                    values.add(row.get(p))
+
+    rows = []
+    for key in sorted(summaries.keys(), key=lambda key: [(v is not None, v) for v in key]):
+        count, values = summaries[key]
+        row = OrderedDict(zip([label for label, p, bucket in groups], key))
+        for label, function, p, quantile in aggregates:
+            row[label] = count if p is None else values[p].get(function, quantile)
+        rows.append(row)
+    yield rows
+
+def to_group_value(value, bucket):
+
+    # dates are grouped by the first day of the day, week or month they're in
+    if value is None or value == '':
+        return None
+    if bucket == 'day':
+        return value[:10]
+    if bucket == 'week':
+        day = date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        return (day - timedelta(days=day.weekday())).isoformat()
+    if bucket == 'month':
+        return value[:7] + '-01'
+    return value
+
+class Summary:
+
+    # the running count, sum, min and max of the values of a property and,
+    # for quantiles, a uniform sample of QUANTILE_SAMPLE_SIZE of its numeric
+    # values (reservoir sampling) so memory stays the same however many
+    # values there are; the sample is seeded so a summary is repeatable
+
+    def __init__(self, sampled=False):
+        self.count = 0
+        self.numeric = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.sample = [] if sampled else None
+        self.random = random.Random(0) if sampled else None
+
+    def add(self, value):
+        if value is None or value == '':
+            return
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        self.numeric += 1
+        self.sum += value
+        if self.sample is None:
+            return
+        if len(self.sample) < QUANTILE_SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            i = self.random.randrange(self.numeric)
+            if i < QUANTILE_SAMPLE_SIZE:
+                self.sample[i] = value
+
+    def get(self, function, quantile=None):
+        if function == 'count':
+            return self.count
+        if function == 'min':
+            return self.min
+        if function == 'max':
+            return self.max
+        if self.numeric == 0:
+            return None
+        if function == 'sum':
+            return self.sum
+        if function == 'mean':
+            return self.sum / self.numeric
+        return self.quantile(quantile)
+
+    def quantile(self, q):
+        # linear interpolation between the closest ranks of the sample
+        values = sorted(self.sample)
+        position = q * (len(values) - 1)
+        i = int(position)
+        if i + 1 >= len(values):
+            return values[i]
+        return values[i] + (values[i + 1] - values[i]) * (position - i)
+
+def get_output_format(params):
+
+    output_format = str(dict(params).get('format') or 'ndjson').strip().lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Invalid format: must be one of ' + ', '.join(OUTPUT_FORMATS.keys()))
+    return output_format
+
+def get_page_size(params):
+
+    page_size = dict(params).get('page_size') or MAX_PAGE_SIZE
+    try:
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page_size: ' + str(page_size))
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ValueError('Invalid page_size: must be between 1 and ' + str(MAX_PAGE_SIZE))
+    return page_size
+
+def get_prefetch_depth(params):
+
+    prefetch_depth = dict(params).get('prefetch')
+    if prefetch_depth is None or prefetch_depth == '':
+        return PREFETCH_DEPTH
+    try:
+        prefetch_depth = int(prefetch_depth)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid prefetch: ' + str(prefetch_depth))
+    if prefetch_depth < 0 or prefetch_depth > MAX_PREFETCH_DEPTH:
+        raise ValueError('Invalid prefetch: must be between 0 and ' + str(MAX_PREFETCH_DEPTH))
+    return prefetch_depth
+
+def get_adaptive_page_size(page_size, max_page_size, response):
+
+    # shrink the page when the response is large and grow it back toward
+    # the requested page size when responses are fast
+    if get_response_size(response) > ADAPTIVE_MAX_RESPONSE_BYTES:
+        return max(page_size // 2, ADAPTIVE_MIN_PAGE_SIZE)
+    if response.elapsed.total_seconds() < ADAPTIVE_FAST_RESPONSE_SECONDS:
+        return min(page_size * 2, max_page_size)
+    return page_size
+
+def get_response_size(response):
+    # a streamed response has already been read from the socket as it was
+    # parsed, so use the number of bytes read rather than loading the body
+    if getattr(response, 'streamed', False):
+        return response.raw.tell()
+    return len(response.content)
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+def get_partition_count(params):
+
+    partitions = dict(params).get('partitions') or 1
+    try:
+        partitions = int(partitions)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid partitions: ' + str(partitions))
+    if partitions < 1 or partitions > MAX_PARTITIONS:
+        raise ValueError('Invalid partitions: must be between 1 and ' + str(MAX_PARTITIONS))
+    return partitions
+
+def prefetch(iterable, depth):
+
+    # iterate on a background thread so the next page is fetched while the
+    # current one is transformed and written; at most depth pages are held
+    # ahead of the consumer
+    if depth <= 0:
+        yield from iterable
+        return
+
+    yield from merge([iterable], depth)
+
+def merge(iterables, depth, workers=None):
+
+    # iterate the iterables on up to workers background threads, each taking
+    # the next iterable when it finishes one, and yield the pages in the
+    # order they arrive; at most depth pages are held ahead of the consumer
+    workers = min(workers or len(iterables), len(iterables))
+    pending = queue.Queue()
+    for iterable in iterables:
+        pending.put(iterable)
+
+    pages = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(value):
+        while not stopped.is_set():
+            try:
+                pages.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                try:
+                    iterable = pending.get_nowait()
+                except queue.Empty:
+                    break
+                for page in iterable:
+                    if not put((page, None)):
+                        return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    for _ in range(workers):
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+    try:
+        remaining = workers
+        while remaining > 0:
+            page, error = pages.get()
+            if page is done:
+                if error is not None:
+                    raise error
+                remaining -= 1
+                continue
+            yield page
+    finally:
+        stopped.set()
+
+# connection pool and retry policy for the shared session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = (500, 502, 503, 504) # 429s are handled by send_request
+REQUEST_TIMEOUT = (10, 60) # connect and read timeouts in seconds
+
+# successful responses are cached in CACHE_DIR when the cache_ttl param is
+# set; once the cache is larger than CACHE_MAX_BYTES, the least recently used
+# responses are evicted until it's down to CACHE_EVICT_TO of the cap, so a
+# full cache isn't scanned again on every write; the size of the cache is
+# kept as a running total that's checked against the directory every
+# CACHE_SCAN_SECONDS to pick up what other processes have cached
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'intercom-cache')
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_EVICT_TO = 0.9
+CACHE_SCAN_SECONDS = 60
+_cache_size = {'bytes': None, 'scanned_at': 0}
+_cache_size_lock = threading.Lock()
+
+# the session is created once per process and reused for every page and
+# every warm invocation so the connection to the api is kept alive
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests_retry_session()
+    return _session
+
 def requests_retry_session(
-    retries=3,
-    backoff_factor=0.3,
-    status_forcelist=(429, 500, 502, 503, 504),
+    retries=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_FORCELIST,
     session=None,
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -220,15 +1234,401 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
+# requests are paced using the rate limit headers the api returns; the budget
+# is kept in a state file per access token so concurrent invocations of any
+# of the intercom functions share it; once fewer than RATE_LIMIT_RESERVE
+# requests remain, the remaining requests are spread evenly until the reset
+RATE_LIMIT_DIR = tempfile.gettempdir()
+RATE_LIMIT_RESERVE = 0.2 # fraction of the limit
+RATE_LIMIT_RETRIES = 10 # number of times to wait for the reset after a 429
+RATE_LIMIT_DEFAULT_WAIT = 10 # seconds to wait after a 429 without a reset header
+
+# counters for the requests sent and the time spent waiting on the rate limit
+rate_limit_stats = {
+    'requests': 0,
+    'rate_limited': 0,
+    'throttled': 0,
+    'throttled_seconds': 0.0
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(auth_header):
+    with _rate_limiters_lock:
+        if auth_header not in _rate_limiters:
+            _rate_limiters[auth_header] = RateLimiter(auth_header)
+        return _rate_limiters[auth_header]
+
+class RateLimiter:
+
+    def __init__(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(RATE_LIMIT_DIR, 'intercom-rate-limit-' + digest[:32] + '.json')
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+
+        # the thread lock coordinates threads in this process and the file
+        # lock coordinates other processes
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.load(f)
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+            finally:
+                os.close(fd)
+
+    def acquire(self):
+
+        wait = 0
+        with self.state() as state:
+            now = time.time()
+            limit = state.get('limit')
+            remaining = state.get('remaining')
+            reset = state.get('reset') or 0
+            if remaining is None or limit is None or reset <= now:
+                # nothing is known about the current window until a response
+                # comes back with the rate limit headers
+                state['remaining'] = None
+            elif remaining <= 0:
+                # the budget stays used up until the reset so that every
+                # caller waits for it, not just the first
+                wait = reset - now
+            elif remaining <= limit * RATE_LIMIT_RESERVE:
+                next_at = max(state.get('next_at') or 0, now)
+                wait = next_at - now
+                state['next_at'] = next_at + (reset - next_at) / remaining
+                state['remaining'] = remaining - 1
+            else:
+                state['remaining'] = remaining - 1
+
+        with _rate_limiters_lock:
+            rate_limit_stats['requests'] += 1
+            if wait > 0:
+                rate_limit_stats['throttled'] += 1
+                rate_limit_stats['throttled_seconds'] += wait
+        if wait > 0:
+            with profiler.phase('throttle'):
+                time.sleep(wait)
+
+    def update(self, response):
+
+        limit = to_int(response.headers.get('X-RateLimit-Limit'))
+        remaining = to_int(response.headers.get('X-RateLimit-Remaining'))
+        reset = to_int(response.headers.get('X-RateLimit-Reset'))
+
+        if response.status_code == 429:
+            with _rate_limiters_lock:
+                rate_limit_stats['rate_limited'] += 1
+            remaining = 0
+            if reset is None or reset <= time.time():
+                reset = time.time() + RATE_LIMIT_DEFAULT_WAIT
+
+        if remaining is None or reset is None:
+            return
+
+        with self.state() as state:
+            # responses can arrive out of order, so within the same window
+            # only ever lower the remaining count
+            if reset == state.get('reset') and state.get('remaining') is not None:
+                remaining = min(remaining, state['remaining'])
+            state['limit'] = limit if limit is not None else state.get('limit')
+            state['remaining'] = remaining
+            state['reset'] = reset
+
+def send_request(method, url, headers, cache_ttl=0, **kwargs):
+
+    if cache_ttl > 0:
+        return send_cached_request(method, url, headers, cache_ttl, **kwargs)
+
+    # pace the request against the shared rate limit and, if the api still
+    # returns a 429, wait for the limit to reset and try again rather than
+    # failing the export
+    rate_limiter = get_rate_limiter(headers.get('Authorization', ''))
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        rate_limiter.acquire()
+        with profiler.phase('request'):
+            response = get_session().request(method, url, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs)
+        rate_limiter.update(response)
+        if profiler.enabled:
+            retries = getattr(response.raw, 'retries', None)
+            profiler.count('requests')
+            profiler.count('retries', len(retries.history) if retries is not None else 0)
+            profiler.count('rate_limited', 1 if response.status_code == 429 else 0)
+            if not kwargs.get('stream'):
+                profiler.count('bytes_received', len(response.content))
+        if response.status_code != 429:
+            break
+        response.close()
+    return response
+
+def send_cached_request(method, url, headers, cache_ttl, **kwargs):
+
+    # successful responses are cached by access token, method, url and body;
+    # concurrent requests for the same key wait on the key's lock so only the
+    # first one calls the api and the rest read what it cached; requests for
+    # other keys don't wait, even while the first one waits on the rate limit
+    key = json.dumps([headers.get('Authorization', ''), method, url, kwargs.get('json')], sort_keys=True)
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    path = os.path.join(CACHE_DIR, key + '.z')
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with cache_lock(path + '.lock'):
+        body = read_cache(path, cache_ttl)
+        if body is not None:
+            profiler.count('cache_hits')
+            return to_cached_response(url, body)
+        response = send_request(method, url, headers, **kwargs)
+        if response.status_code == 200:
+            write_cache(path, response.content)
+        return response
+
+@contextlib.contextmanager
+def cache_lock(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def read_cache(path, cache_ttl):
+
+    # the modified time is when the response was cached and the access time
+    # is when it was last used, which is what eviction goes by
+    try:
+        stat = os.stat(path)
+        if time.time() - stat.st_mtime > cache_ttl:
+            return None
+        with open(path, 'rb') as f:
+            body = zlib.decompress(f.read())
+        os.utime(path, (time.time(), stat.st_mtime))
+        return body
+    except (OSError, zlib.error):
+        return None
+
+def write_cache(path, body):
+
+    body = zlib.compress(body)
+    try:
+        replaced_size = os.stat(path).st_size
+    except OSError:
+        replaced_size = 0
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.replace(temp_path, path)
+
+    # only scan the cache when the running total is over the cap or hasn't
+    # been checked against the directory for a while
+    with _cache_size_lock:
+        if _cache_size['bytes'] is not None:
+            _cache_size['bytes'] += len(body) - replaced_size
+            if _cache_size['bytes'] <= CACHE_MAX_BYTES and time.time() - _cache_size['scanned_at'] < CACHE_SCAN_SECONDS:
+                return
+        _cache_size['bytes'] = evict_cache()
+        _cache_size['scanned_at'] = time.time()
+
+def evict_cache():
+
+    # evict the least recently used responses once the cache is over its cap
+    # and return the size of what's left
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.z'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= CACHE_MAX_BYTES:
+        return total_size
+    for _, size, entry_path in sorted(entries):
+        if total_size <= CACHE_MAX_BYTES * CACHE_EVICT_TO:
+            break
+        for evicted_path in (entry_path, entry_path + '.lock'):
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+        total_size -= size
+    return total_size
+
+def to_cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    response.elapsed = timedelta(0)
+    response._content = body
+    return response
+
+def decode_response(response):
+
+    # decode straight from the response bytes
+    with profiler.phase('decode'):
+        return json_loads(response.content)
+
+def get_response_pages(response, key, stream):
+
+    # yield the response as a single page, or when it's streamed, yield each
+    # record as its own page as soon as it's parsed; either way, return the
+    # content of the response without the records for the pages cursor
+    if not stream:
+        content = decode_response(response)
+        yield content
+        return content
+
+    content = {}
+    for item in decode_response_items(response, key, content):
+        yield {key: [item]}
+    return content
+
+def decode_response_items(response, key, content):
+
+    # parse the items in the key array one at a time with ijson so only one
+    # item is held in memory rather than the whole page; the rest of the
+    # response, such as the pages cursor, is added to content once the body
+    # has been read
+    item_prefix = key + '.item'
+    builder = ijson.ObjectBuilder()
+    item_builder = None
+
+    response.streamed = True
+    response.raw.decode_content = True
+    try:
+        for prefix, event, value in ijson.parse(response.raw, use_float=True):
+            if prefix != item_prefix and not prefix.startswith(item_prefix + '.'):
+                builder.event(event, value)
+                continue
+            if item_builder is None:
+                item_builder = ijson.ObjectBuilder()
+            item_builder.event(event, value)
+            if prefix == item_prefix and event not in ('start_map', 'start_array', 'map_key'):
+                yield item_builder.value
+                item_builder = None
+        content.update(builder.value or {})
+    finally:
+        profiler.count('bytes_received', response.raw.tell())
+        response.close()
+
+# json is decoded and encoded with orjson when it's installed and with the
+# stdlib json module otherwise
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def get_encoder():
+    if orjson is not None:
+        return OrjsonEncoder(default=to_string)
+    # the same output as orjson: no spaces after the separators, and utf-8
+    # rather than escaped unicode
+    return json.JSONEncoder(default=to_string, separators=(',', ':'), ensure_ascii=False)
+
+class OrjsonEncoder:
+
+    # the same encode() interface as json.JSONEncoder; orjson handles dates
+    # and datetimes itself and calls default for anything else (e.g. Decimal)
+    def __init__(self, default=None):
+        self.default = default
+
+    def encode(self, value):
+        return orjson.dumps(value, default=self.default).decode('utf-8')
+
+def to_ndjson(rows, encoder):
+    # join the page once rather than appending each row to it, which copies
+    # the page for every row
+    return ''.join([encoder.encode(row) + "\n" for row in rows])
+
+def to_table(rows, encoder):
+    # rows are built in property order, so only the values need writing
+    return ''.join([encoder.encode(list(row.values())) + "\n" for row in rows])
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows([to_csv_value(value) for value in row.values()] for row in rows)
+    return buffer.getvalue()
+
+def to_csv_value(value):
+    # None is written as an empty field by the csv writer
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=to_string)
+    return value
+
+def get_serializer(output_format, encoder):
+    if output_format == 'table':
+        return lambda rows: to_table(rows, encoder)
+    if output_format == 'csv':
+        return to_csv
+    return lambda rows: to_ndjson(rows, encoder)
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 def to_date(ts):
     if ts is None or ts == '':
         return ''
-    return datetime.utcfromtimestamp(int(ts)/1000).strftime('%Y-%m-%dT%H:%M:%S')
+    # timestamps are in seconds; the date part is formatted once per day
+    days, seconds = divmod(int(ts), 86400)
+    day = _dates.get(days)
+    if day is None:
+        day = (EPOCH + timedelta(days=days)).strftime('%Y-%m-%d')
+        _dates[days] = day
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%sT%02d:%02d:%02d' % (day, hours, minutes, seconds)
+
+def to_dates(values):
+
+    # convert a list of timestamps at once; uses numpy when it's available
+    # and there are enough values to make it worthwhile
+    if np is None or len(values) < NUMPY_MIN_VALUES:
+        return [to_date(v) for v in values]
+    missing = [v is None or v == '' for v in values]
+    timestamps = np.array([0 if m else int(v) for v, m in zip(values, missing)], dtype='int64')
+    dates = np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s').tolist()
+    return ['' if m else d for d, m in zip(dates, missing)]
+
+def convert_dates(rows, properties):
+
+    # convert the timestamps for all the date properties of a page at once
+    if len(rows) == 0 or len(properties) == 0:
+        return rows
+    values = [row[p] for p in properties for row in rows]
+    dates = iter(to_dates(values))
+    for p in properties:
+        for row in rows:
+            row[p] = next(dates)
+    return rows
 
 def to_string(value):
     if isinstance(value, (date, datetime)):
@@ -237,53 +1637,304 @@ def to_string(value):
         return str(value)
     return value
 
-def get_item_info(item):
-
-    # map this function's property names to the API's property names
-    info = OrderedDict()
-
-    info['id'] = item.get('id')
-    info['created_at'] = to_date(item.get('created_at'))
-    info['updated_at'] = to_date(item.get('updated_at'))
-    info['waiting_since'] = to_date(item.get('waiting_since'))
-    info['snoozed_until'] = to_date(item.get('waiting_since'))
-    info['source_type'] = item.get('source',{}).get('type')
-    info['source_id'] = item.get('source',{}).get('id')
-    info['source_delivered_as'] = item.get('source',{}).get('delivered_as')
-    info['source_subject'] = item.get('source',{}).get('subject')
-    info['source_body'] = item.get('source',{}).get('body')
-    info['source_author_type'] = item.get('source',{}).get('author',{}).get('type')
-    info['source_author_id'] = item.get('source',{}).get('author',{}).get('id')
-    info['source_author_name'] = item.get('source',{}).get('author',{}).get('name')
-    info['source_author_email'] = item.get('source',{}).get('author',{}).get('email')
-    info['source_url'] = item.get('source',{}).get('url')
-    info['first_contact_reply_created_at'] = to_date(item.get('first_contact_reply',{}).get('created_at'))
-    info['first_contact_reply_type'] = item.get('first_contact_reply',{}).get('type')
-    info['first_contact_reply_url'] = item.get('first_contact_reply',{}).get('url')
-    info['assignee_type'] = item.get('assignee',{}).get('type')
-    info['assignee_id'] = item.get('assignee',{}).get('id')
-    info['open'] = item.get('open')
-    info['state'] = item.get('state')
-    info['read'] = item.get('read')
-    info['priority'] = item.get('priority')
-    info['sla_applied'] = item.get('sla_applied')
-    info['time_to_assignment'] = item.get('statistics',{}).get('time_to_assignment')
-    info['time_to_admin_reply'] = item.get('statistics',{}).get('time_to_admin_reply')
-    info['time_to_first_close'] = item.get('statistics',{}).get('time_to_first_close')
-    info['time_to_last_close'] = item.get('statistics',{}).get('time_to_last_close')
-    info['median_time_to_reply'] = item.get('statistics',{}).get('median_time_to_reply')
-    info['first_contact_reply_at'] = to_date(item.get('statistics',{}).get('first_contact_reply_at'))
-    info['first_assignment_at'] = to_date(item.get('statistics',{}).get('first_assignment_at'))
-    info['first_admin_reply_at'] = to_date(item.get('statistics',{}).get('first_admin_reply_at'))
-    info['first_close_at'] = to_date(item.get('statistics',{}).get('first_close_at'))
-    info['last_assignment_at'] = to_date(item.get('statistics',{}).get('last_assignment_at'))
-    info['last_assignment_admin_reply_at'] = to_date(item.get('statistics',{}).get('last_assignment_admin_reply_at'))
-    info['last_contact_reply_at'] = to_date(item.get('statistics',{}).get('last_contact_reply_at'))
-    info['last_admin_reply_at'] = to_date(item.get('statistics',{}).get('last_admin_reply_at'))
-    info['last_close_at'] = to_date(item.get('statistics',{}).get('last_close_at'))
-    info['last_closed_by_id'] = item.get('statistics',{}).get('last_closed_by_id')
-    info['count_reopens'] = item.get('statistics',{}).get('count_reopens')
-    info['count_assignments'] = item.get('statistics',{}).get('count_assignments')
-    info['count_conversation_parts'] = item.get('statistics',{}).get('count_conversation_parts')
-
-    return info
+# map this function's property names to the API's property names where they
+# differ; nested properties are given as a path (e.g. 'location.country')
+PROPERTY_PATHS = {
+    'source_type': 'source.type',
+    'source_id': 'source.id',
+    'source_delivered_as': 'source.delivered_as',
+    'source_subject': 'source.subject',
+    'source_body': 'source.body',
+    'source_author_type': 'source.author.type',
+    'source_author_id': 'source.author.id',
+    'source_author_name': 'source.author.name',
+    'source_author_email': 'source.author.email',
+    'source_url': 'source.url',
+    'first_contact_reply_created_at': 'first_contact_reply.created_at',
+    'first_contact_reply_type': 'first_contact_reply.type',
+    'first_contact_reply_url': 'first_contact_reply.url',
+    'assignee_type': 'assignee.type',
+    'assignee_id': 'assignee.id',
+    'time_to_assignment': 'statistics.time_to_assignment',
+    'time_to_admin_reply': 'statistics.time_to_admin_reply',
+    'time_to_first_close': 'statistics.time_to_first_close',
+    'time_to_last_close': 'statistics.time_to_last_close',
+    'median_time_to_reply': 'statistics.median_time_to_reply',
+    'first_contact_reply_at': 'statistics.first_contact_reply_at',
+    'first_assignment_at': 'statistics.first_assignment_at',
+    'first_admin_reply_at': 'statistics.first_admin_reply_at',
+    'first_close_at': 'statistics.first_close_at',
+    'last_assignment_at': 'statistics.last_assignment_at',
+    'last_assignment_admin_reply_at': 'statistics.last_assignment_admin_reply_at',
+    'last_contact_reply_at': 'statistics.last_contact_reply_at',
+    'last_admin_reply_at': 'statistics.last_admin_reply_at',
+    'last_close_at': 'statistics.last_close_at',
+    'last_closed_by_id': 'statistics.last_closed_by_id',
+    'count_reopens': 'statistics.count_reopens',
+    'count_assignments': 'statistics.count_assignments',
+    'count_conversation_parts': 'statistics.count_conversation_parts',
+}
+
+# properties resolved from the directory rather than read from the
+# conversation, mapped to the record they're looked up for and its field
+RESOLVED_PROPERTIES = {
+    'assignee_name': ('assignee', 'name'),
+    'assignee_email': ('assignee', 'email'),
+    'assignee_team_names': ('assignee', 'team_names'),
+    'last_closed_by_name': ('last_closed_by', 'name'),
+}
+
+EMPTY = {}
+
+# properties with timestamps that are returned as dates
+DATE_PROPERTIES = (
+    'created_at',
+    'updated_at',
+    'waiting_since',
+    'snoozed_until',
+    'first_contact_reply_created_at',
+    'first_contact_reply_at',
+    'first_assignment_at',
+    'first_admin_reply_at',
+    'first_close_at',
+    'last_assignment_at',
+    'last_assignment_admin_reply_at',
+    'last_contact_reply_at',
+    'last_admin_reply_at',
+    'last_close_at',
+)
+
+# properties that can be filtered with the search api; other properties are
+# filtered locally
+SEARCH_PROPERTIES = (
+    'id',
+    'source_type',
+    'source_id',
+    'source_delivered_as',
+    'source_subject',
+    'source_body',
+    'source_author_type',
+    'source_author_id',
+    'source_author_name',
+    'source_author_email',
+    'source_url',
+    'open',
+    'state',
+    'read',
+    'priority',
+)
+
+# the properties in the "returns" list in the header, for when this file
+# can't be read
+RETURNS = (
+    ('id', 'string'),
+    ('created_at', 'string'),
+    ('updated_at', 'string'),
+    ('waiting_since', 'string'),
+    ('snoozed_until', 'string'),
+    ('source_type', 'string'),
+    ('source_id', 'string'),
+    ('source_delivered_as', 'string'),
+    ('source_subject', 'string'),
+    ('source_body', 'string'),
+    ('source_author_type', 'string'),
+    ('source_author_id', 'string'),
+    ('source_author_name', 'string'),
+    ('source_author_email', 'string'),
+    ('source_url', 'string'),
+    ('first_contact_reply_created_at', 'string'),
+    ('first_contact_reply_type', 'string'),
+    ('first_contact_reply_url', 'string'),
+    ('assignee_type', 'string'),
+    ('assignee_id', 'string'),
+    ('assignee_name', 'string'),
+    ('assignee_email', 'string'),
+    ('assignee_team_names', 'string'),
+    ('open', 'boolean'),
+    ('state', 'string'),
+    ('read', 'boolean'),
+    ('priority', 'string'),
+    ('sla_applied', 'string'),
+    ('time_to_assignment', 'integer'),
+    ('time_to_admin_reply', 'integer'),
+    ('time_to_first_close', 'integer'),
+    ('time_to_last_close', 'integer'),
+    ('median_time_to_reply', 'integer'),
+    ('first_contact_reply_at', 'string'),
+    ('first_assignment_at', 'string'),
+    ('first_admin_reply_at', 'string'),
+    ('first_close_at', 'string'),
+    ('last_assignment_at', 'string'),
+    ('last_assignment_admin_reply_at', 'string'),
+    ('last_contact_reply_at', 'string'),
+    ('last_admin_reply_at', 'string'),
+    ('last_close_at', 'string'),
+    ('last_closed_by_id', 'string'),
+    ('last_closed_by_name', 'string'),
+    ('count_reopens', 'integer'),
+    ('count_assignments', 'integer'),
+    ('count_conversation_parts', 'integer'),
+)
+
+def get_returns():
+
+    # read the property names and types from the "returns" list in the
+    # header at the top of this file; when the file can't be read, such as
+    # when the runtime runs the code without a __file__, use RETURNS
+    try:
+        f = open(__file__, 'r', encoding='utf-8')
+    except (NameError, OSError):
+        return OrderedDict(RETURNS)
+    returns = OrderedDict()
+    in_returns = False
+    name = None
+    with f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            line = line[1:].rstrip()
+            indent = len(line) - len(line.lstrip())
+            line = line.strip()
+            if line == '---':
+                if in_returns:
+                    break
+                continue
+            if indent <= 1:
+                in_returns = line == 'returns:'
+                continue
+            if not in_returns:
+                continue
+            key, _, value = line.lstrip('- ').partition(':')
+            if line.startswith('- '):
+                name = None
+            if key == 'name':
+                name = value.strip()
+                returns[name] = 'string'
+            elif key == 'type' and name is not None:
+                returns[name] = value.strip()
+    return returns
+
+# the property names and types from the header
+PROPERTY_TYPES = get_returns()
+
+# the properties returned by default and stored in the incremental snapshot;
+# the resolved properties need the admins and teams, so they're only returned
+# when they're listed
+SNAPSHOT_PROPERTIES = [p for p in PROPERTY_TYPES.keys() if p not in RESOLVED_PROPERTIES]
+
+def get_properties(params):
+
+    # properties can be passed as a list or as a comma-delimited string;
+    # an empty list or '*' returns all properties
+    properties = dict(params).get('properties') or '*'
+    if isinstance(properties, str):
+        properties = properties.split(',')
+    properties = [p.strip().lower() for p in properties if p.strip() != '']
+    if len(properties) == 0 or '*' in properties:
+        return list(SNAPSHOT_PROPERTIES)
+
+    for p in properties:
+        if p not in PROPERTY_TYPES:
+            raise ValueError('Invalid property: ' + p)
+    return properties
+
+@functools.lru_cache(maxsize=32)
+def compile_item_extractor(properties, dates=True):
+
+    # generate a function that returns the given properties for an item;
+    # each nested object a property is read from is looked up once per item
+    # and missing or null objects are treated as empty; timestamps are left
+    # as is when dates is false so they can be converted a page at a time
+    lines = []
+    objects = {(): 'item'}
+
+    def get_object(path):
+        if path not in objects:
+            parent = get_object(path[:-1])
+            objects[path] = 'obj_' + str(len(objects))
+            lines.append('    %s = %s.get(%r) or EMPTY' % (objects[path], parent, path[-1]))
+        return objects[path]
+
+    values = []
+    for p in properties:
+        path = tuple(PROPERTY_PATHS.get(p, p).split('.'))
+        value = '%s.get(%r)' % (get_object(path[:-1]), path[-1])
+        if dates and p in DATE_PROPERTIES:
+            value = 'to_date(%s)' % value
+        values.append('        %r: %s,' % (p, value))
+
+    source = '\n'.join(['def get_item_info(item):'] + lines + ['    return {'] + values + ['    }'])
+    namespace = {'EMPTY': {}, 'to_date': to_date}
+    exec(compile(source, '<get_item_info>', 'exec'), namespace)
+    return namespace['get_item_info']
+
+def get_item_extractor(properties, dates=True):
+    return compile_item_extractor(tuple(properties), dates)
+
+def get_filter(params, local_only=False):
+
+    # the filter is a url query string (e.g. "role=user&email=a@b.com"); keys
+    # are property names and repeated keys match any of the values; returns
+    # the search api query for the predicates the api supports along with
+    # the remaining predicates to apply locally
+    filter_values = dict(params).get('filter') or ''
+    if isinstance(filter_values, dict):
+        filter_values = urllib.parse.urlencode(filter_values, doseq=True)
+    filter_values = urllib.parse.parse_qs(filter_values, keep_blank_values=True)
+
+    predicates = []
+    local_filter = OrderedDict()
+    for key, values in filter_values.items():
+        key = key.strip().lower()
+        if key not in PROPERTY_TYPES or key in RESOLVED_PROPERTIES:
+            raise ValueError('Invalid filter property: ' + key)
+        values = get_filter_values(key, values)
+        if local_only or key not in SEARCH_PROPERTIES or '' in values:
+            local_filter[key] = set(to_filter_value(v) for v in values)
+            continue
+        field = PROPERTY_PATHS.get(key, key)
+        if PROPERTY_TYPES[key] == 'boolean':
+            values = [v == 'true' for v in values]
+        if len(values) == 1:
+            predicates.append({"field": field, "operator": "=", "value": values[0]})
+        else:
+            predicates.append({"field": field, "operator": "IN", "value": values})
+
+    search_query = None
+    if len(predicates) == 1:
+        search_query = predicates[0]
+    elif len(predicates) > 1:
+        search_query = {"operator": "AND", "value": predicates}
+    return search_query, local_filter
+
+def get_filter_values(key, values):
+    # surrounding whitespace is ignored, and true and false in any case
+    if PROPERTY_TYPES[key] == 'boolean':
+        return [v.strip().lower() for v in values]
+    return [v.strip() for v in values]
+
+def get_filter_matcher(local_filter):
+
+    # build a matcher that only computes the properties being filtered
+    get_item_info = get_item_extractor(list(local_filter.keys()))
+    predicates = list(local_filter.items())
+    if len(predicates) == 0:
+        return lambda item: True
+
+    def matches_filter(item):
+        info = get_item_info(item)
+        for p, values in predicates:
+            if to_filter_value(info[p]) not in values:
+                return False
+        return True
+
+    return matches_filter
+
+def to_filter_value(value):
+    # values match exactly, as they do with the search api, so a filter
+    # returns the same records whether it's applied by the api or locally
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
@@ -0,0 +1,820 @@
+
+# ---
+# name: intercom-enrich-contacts
+# deployed: true
+# config: index
+# title: Intercom Enrich Contacts
+# description: Returns Intercom contact information for a list of emails or external ids
+# params:
+#   - name: values
+#     type: array
+#     description: The emails or external ids of the contacts to look up
+#     required: true
+#   - name: properties
+#     type: array
+#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     required: false
+#   - name: lookup_key
+#     type: string
+#     description: The property to look up the values with; either "email" or "external_id" (defaults to "email")
+#     required: false
+# returns:
+#   - name: id
+#     type: string
+#     description: The unique identifier for the contact which is given by Intercom
+#   - name: workspace_id
+#     type: string
+#     description: The id of the workspace which the contact belongs to
+#   - name: external_id
+#     type: string
+#     description: A unique identifier for the contact which is given to Intercom
+#   - name: role
+#     type: string
+#     description: The role of the contact (either user or lead)
+#   - name: email
+#     type: string
+#     description: The email for the contact
+#   - name: phone
+#     type: string
+#     description: The phone for the contact
+#   - name: name
+#     type: string
+#     description: The name of the contact
+#   - name: avatar
+#     type: string
+#     description: An image URL containing the avatar of a contact
+#   - name: owner_id
+#     type: string
+#     description: The id of an administrator that has been assigned account ownership of the contact
+#   - name: has_hard_bounced
+#     type: boolean
+#     description: Whether the contact has had an email sent to them hard bounce
+#   - name: marked_email_as_spam
+#     type: boolean
+#     description: Whether the contact has marked an email sent to them as spam
+#   - name: unsubscribed_from_emails
+#     type: boolean
+#     description: Whether the contact is unsubscribed from emails
+#   - name: created_at
+#     type: string
+#     description: The time when the contact was created
+#   - name: updated_at
+#     type: string
+#     description: The time when the contact was last updated
+#   - name: signed_up_at
+#     type: string
+#     description: The time specified for when a contact signed up
+#   - name: last_seen_at
+#     type: string
+#     description: The time when the contact was last seen (either where the Intercom Messenger was installed or when specified manually)
+#   - name: last_replied_at
+#     type: string
+#     description: The time when the contact last messaged in
+#   - name: last_contacted_at
+#     type: string
+#     description: The time when the contact was last messaged
+#   - name: last_email_opened_at
+#     type: string
+#     description: The time when the contact last opened an email
+#   - name: last_email_clicked_at
+#     type: string
+#     description: The time when the contact last clicked a link in an email
+#   - name: language_override
+#     type: string
+#     description: A preferred language setting for the contact, used by the Intercom Messenger even if their browser settings change
+#   - name: browser
+#     type: string
+#     description: The name of the browser which the contact is using
+#   - name: browser_version
+#     type: string
+#     description: The version of the browser which the contact is using
+#   - name: browser_language
+#     type: string
+#     description: The language set by the browser which the contact is using
+#   - name: os
+#     type: string
+#     description: The operating system which the contact is using
+#   - name: location_country
+#     type: string
+#     description: The country location of the contact
+#   - name: location_region
+#     type: string
+#     description: The region location of the contact
+#   - name: location_city
+#     type: string
+#     description: The city location of the contact
+#   - name: android_app_name
+#     type: string
+#     description: The name of the Android app which the contact is using
+#   - name: android_app_version
+#     type: string
+#     description: The version of the Android app which the contact is using
+#   - name: android_device
+#     type: string
+#     description: The Android device which the contact is using
+#   - name: android_os_version
+#     type: string
+#     description: The version of the Android OS which the contact is using
+#   - name: android_sdk_version
+#     type: string
+#     description: The version of the Android SDK which the contact is using
+#   - name: android_last_seen_at
+#     type: string
+#     description: The last time the contact used the Android app
+#   - name: ios_app_name
+#     type: string
+#     description: The name of the iOS app which the contact is using
+#   - name: ios_app_version
+#     type: string
+#     description: The version of the iOS app which the contact is using
+#   - name: ios_device
+#     type: string
+#     description: The iOS device which the contact is using
+#   - name: ios_os_version
+#     type: string
+#     description: The version of iOS which the contact is using
+#   - name: ios_sdk_version
+#     type: string
+#     description: The version of the iOS SDK which the contact is using
+#   - name: ios_last_seen_at
+#     type: string
+#     description: The last time the contact used the iOS app
+# examples:
+#   - '"bbaggins@shire.com", "name, phone"'
+#   - 'A2:A100, "email, name, location_country"'
+# ---
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import time
+import threading
+import functools
+import contextlib
+import requests
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from datetime import date, datetime, timedelta
+from decimal import *
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# maximum number of records the search api returns per page
+MAX_PAGE_SIZE = 150
+
+# values are looked up with a search for up to SEARCH_MAX_CLAUSES IN clauses
+# of up to SEARCH_MAX_VALUES values each combined with OR, which keeps each
+# search within the api's limits on the number of filters in a group
+SEARCH_MAX_CLAUSES = 15
+SEARCH_MAX_VALUES = 20
+
+# number of searches to run at the same time; all of them share the rate limit
+MAX_WORKERS = 4
+
+# properties the values can be looked up with
+LOOKUP_KEYS = ('email', 'external_id')
+
+# timestamps are converted with numpy when it's installed and there are at
+# least NUMPY_MIN_VALUES of them to convert; otherwise the formatted date for
+# each day is cached and reused
+NUMPY_MIN_VALUES = 256
+EPOCH = datetime(1970, 1, 1)
+_dates = {}
+
+# per-phase timing and counters are off by default; set INTERCOM_PROFILE=1
+# to write a summary to stderr after each run and INTERCOM_PROFILE_TRACE to
+# a path to also write a chrome trace (chrome://tracing) of the phases
+PROFILE = os.environ.get('INTERCOM_PROFILE', '').strip().lower() in ('1', 'true', 'yes')
+PROFILE_TRACE_PATH = os.environ.get('INTERCOM_PROFILE_TRACE') or None
+
+class Profiler:
+
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+        self.events = [] if trace else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0) + (end - start)
+                if self.events is not None:
+                    self.events.append({
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.started) * 1000000,
+                        "dur": (end - start) * 1000000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident()
+                    })
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        summary = OrderedDict()
+        summary['elapsed'] = round(time.perf_counter() - self.started, 6)
+        summary['phases'] = OrderedDict((k, round(v, 6)) for k, v in self.times.items())
+        summary['counters'] = self.counters
+        return summary
+
+    def write(self, name):
+        sys.stderr.write(json.dumps({name: self.summary()}) + "\n")
+        if self.events is not None and PROFILE_TRACE_PATH is not None:
+            with open(PROFILE_TRACE_PATH, 'w') as f:
+                json.dump({"traceEvents": self.events}, f)
+
+class NullProfiler:
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def count(self, name, value=1):
+        pass
+
+_null_phase = contextlib.nullcontext()
+
+# the profiler for the current run
+profiler = NullProfiler()
+
+# main function entry point
+def flexio_handler(flex):
+
+    global profiler
+    profiler = Profiler(trace=PROFILE_TRACE_PATH is not None) if PROFILE else NullProfiler()
+
+    try:
+        flex.output.content_type = 'application/x-ndjson'
+        for data in get_data(flex.vars):
+            with profiler.phase('write'):
+                flex.output.write(data)
+            profiler.count('bytes_written', len(data))
+    finally:
+        if profiler.enabled:
+            profiler.write('intercom-enrich-contacts')
+
+def get_data(params):
+
+    # get the api key from the variable input
+    auth_token = dict(params).get('intercom_connection',{}).get('access_token')
+
+    # get the properties to return and an extractor for only those
+    # properties; the dates for all the rows are converted at once
+    properties = get_properties(params)
+    get_item_info = get_item_extractor(properties, dates=False)
+    date_properties = [p for p in properties if p in DATE_PROPERTIES]
+
+    # get the values to look up and the property to look them up with
+    lookup_key = (dict(params).get('lookup_key') or 'email').strip().lower()
+    if lookup_key not in LOOKUP_KEYS:
+        raise ValueError('Invalid lookup_key: ' + lookup_key)
+    values = [to_lookup_value(v) for v in get_values(params)]
+
+    # see here for more info:
+    # https://developers.intercom.com/intercom-api-reference/reference#contacts-model
+    # https://developers.intercom.com/intercom-api-reference/reference#search-for-contacts
+
+    headers = {
+        'Accept': 'application/json',
+        'Authorization': 'Bearer ' + auth_token,
+        'Intercom-Version': '2.0' # api version
+    }
+
+    # look up each distinct value once, running the searches concurrently;
+    # the values are sent as they were given, the same as a filter with
+    # intercom-contacts, and emails are only lowercased to match the contacts
+    # found back to the values
+    distinct_values = list(OrderedDict.fromkeys(v for v in values if v != ''))
+    chunk_size = SEARCH_MAX_CLAUSES * SEARCH_MAX_VALUES
+    chunks = [distinct_values[i:i+chunk_size] for i in range(0, len(distinct_values), chunk_size)]
+
+    contacts = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        searches = [executor.submit(search_contacts, headers, lookup_key, chunk) for chunk in chunks]
+        for search in searches:
+            for item in search.result():
+                key = to_match_key(item.get(lookup_key), lookup_key)
+                if key != '' and key not in contacts:
+                    contacts[key] = item
+
+    # return a row for every value in the order they were given so the
+    # output lines up with the input; values that aren't found return a row
+    # without any values
+    with profiler.phase('transform'):
+        rows = convert_dates([get_item_info(contacts.get(to_match_key(v, lookup_key), {})) for v in values], date_properties)
+    profiler.count('rows', len(rows))
+    with profiler.phase('encode'):
+        encoder = get_encoder()
+        buffer = to_ndjson(rows, encoder)
+    if len(buffer) > 0:
+        yield buffer
+
+def search_contacts(headers, lookup_key, values):
+
+    clauses = []
+    for i in range(0, len(values), SEARCH_MAX_VALUES):
+        clauses.append({"field": lookup_key, "operator": "IN", "value": values[i:i+SEARCH_MAX_VALUES]})
+    search_query = clauses[0] if len(clauses) == 1 else {"operator": "OR", "value": clauses}
+
+    items = []
+    page_cursor_id = None
+
+    while True:
+
+        pagination = {"per_page": MAX_PAGE_SIZE}
+        if page_cursor_id is not None:
+            pagination['starting_after'] = page_cursor_id
+        search = {"query": search_query, "pagination": pagination}
+        page_url = 'https://api.intercom.io/contacts/search'
+        response = send_request('POST', page_url, headers, json=search)
+        response.raise_for_status()
+        content = decode_response(response)
+
+        data = content.get('data',[])
+        if len(data) == 0:
+            break
+        items.extend(data)
+
+        page_cursor_id = (content.get('pages',{}).get('next') or {}).get('starting_after')
+        if page_cursor_id is None:
+            break
+
+    return items
+
+def get_values(params):
+
+    # values can be passed as a list, a list of lists (e.g. a range of
+    # cells) or a comma-delimited string
+    values = dict(params).get('values') or []
+    if isinstance(values, str):
+        values = values.split(',')
+
+    result = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            result.extend(get_values({'values': value}))
+        else:
+            result.append(value)
+    return result
+
+def to_lookup_value(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+def to_match_key(value, lookup_key):
+    # emails match whatever their case; external ids match exactly
+    value = to_lookup_value(value)
+    if lookup_key == 'email':
+        value = value.lower()
+    return value
+
+# connection pool and retry policy for the shared session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = (500, 502, 503, 504) # 429s are handled by send_request
+REQUEST_TIMEOUT = (10, 60) # connect and read timeouts in seconds
+
+# the session is created once per process and reused for every page and
+# every warm invocation so the connection to the api is kept alive
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests_retry_session()
+    return _session
+
+def requests_retry_session(
+    retries=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_FORCELIST,
+    session=None,
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+):
+    session = session or requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# requests are paced using the rate limit headers the api returns; the budget
+# is kept in a state file per access token so concurrent invocations of any
+# of the intercom functions share it; once fewer than RATE_LIMIT_RESERVE
+# requests remain, the remaining requests are spread evenly until the reset
+RATE_LIMIT_DIR = tempfile.gettempdir()
+RATE_LIMIT_RESERVE = 0.2 # fraction of the limit
+RATE_LIMIT_RETRIES = 10 # number of times to wait for the reset after a 429
+RATE_LIMIT_DEFAULT_WAIT = 10 # seconds to wait after a 429 without a reset header
+
+# counters for the requests sent and the time spent waiting on the rate limit
+rate_limit_stats = {
+    'requests': 0,
+    'rate_limited': 0,
+    'throttled': 0,
+    'throttled_seconds': 0.0
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(auth_header):
+    with _rate_limiters_lock:
+        if auth_header not in _rate_limiters:
+            _rate_limiters[auth_header] = RateLimiter(auth_header)
+        return _rate_limiters[auth_header]
+
+class RateLimiter:
+
+    def __init__(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(RATE_LIMIT_DIR, 'intercom-rate-limit-' + digest[:32] + '.json')
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+
+        # the thread lock coordinates threads in this process and the file
+        # lock coordinates other processes
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.load(f)
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+            finally:
+                os.close(fd)
+
+    def acquire(self):
+
+        wait = 0
+        with self.state() as state:
+            now = time.time()
+            limit = state.get('limit')
+            remaining = state.get('remaining')
+            reset = state.get('reset') or 0
+            if remaining is None or limit is None or reset <= now:
+                # nothing is known about the current window until a response
+                # comes back with the rate limit headers
+                state['remaining'] = None
+            elif remaining <= 0:
+                # the budget stays used up until the reset so that every
+                # caller waits for it, not just the first
+                wait = reset - now
+            elif remaining <= limit * RATE_LIMIT_RESERVE:
+                next_at = max(state.get('next_at') or 0, now)
+                wait = next_at - now
+                state['next_at'] = next_at + (reset - next_at) / remaining
+                state['remaining'] = remaining - 1
+            else:
+                state['remaining'] = remaining - 1
+
+        with _rate_limiters_lock:
+            rate_limit_stats['requests'] += 1
+            if wait > 0:
+                rate_limit_stats['throttled'] += 1
+                rate_limit_stats['throttled_seconds'] += wait
+        if wait > 0:
+            with profiler.phase('throttle'):
+                time.sleep(wait)
+
+    def update(self, response):
+
+        limit = to_int(response.headers.get('X-RateLimit-Limit'))
+        remaining = to_int(response.headers.get('X-RateLimit-Remaining'))
+        reset = to_int(response.headers.get('X-RateLimit-Reset'))
+
+        if response.status_code == 429:
+            with _rate_limiters_lock:
+                rate_limit_stats['rate_limited'] += 1
+            remaining = 0
+            if reset is None or reset <= time.time():
+                reset = time.time() + RATE_LIMIT_DEFAULT_WAIT
+
+        if remaining is None or reset is None:
+            return
+
+        with self.state() as state:
+            # responses can arrive out of order, so within the same window
+            # only ever lower the remaining count
+            if reset == state.get('reset') and state.get('remaining') is not None:
+                remaining = min(remaining, state['remaining'])
+            state['limit'] = limit if limit is not None else state.get('limit')
+            state['remaining'] = remaining
+            state['reset'] = reset
+
+def send_request(method, url, headers, **kwargs):
+
+    # pace the request against the shared rate limit and, if the api still
+    # returns a 429, wait for the limit to reset and try again rather than
+    # failing the export
+    rate_limiter = get_rate_limiter(headers.get('Authorization', ''))
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        rate_limiter.acquire()
+        with profiler.phase('request'):
+            response = get_session().request(method, url, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs)
+        rate_limiter.update(response)
+        if profiler.enabled:
+            retries = getattr(response.raw, 'retries', None)
+            profiler.count('requests')
+            profiler.count('retries', len(retries.history) if retries is not None else 0)
+            profiler.count('rate_limited', 1 if response.status_code == 429 else 0)
+            profiler.count('bytes_received', len(response.content))
+        if response.status_code != 429:
+            break
+    return response
+
+def decode_response(response):
+
+    # decode straight from the response bytes
+    with profiler.phase('decode'):
+        return json_loads(response.content)
+
+# json is decoded and encoded with orjson when it's installed and with the
+# stdlib json module otherwise
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def get_encoder():
+    if orjson is not None:
+        return OrjsonEncoder(default=to_string)
+    # the same output as orjson: no spaces after the separators, and utf-8
+    # rather than escaped unicode
+    return json.JSONEncoder(default=to_string, separators=(',', ':'), ensure_ascii=False)
+
+class OrjsonEncoder:
+
+    # the same encode() interface as json.JSONEncoder; orjson handles dates
+    # and datetimes itself and calls default for anything else (e.g. Decimal)
+    def __init__(self, default=None):
+        self.default = default
+
+    def encode(self, value):
+        return orjson.dumps(value, default=self.default).decode('utf-8')
+
+def to_ndjson(rows, encoder):
+    # join the page once rather than appending each row to it, which copies
+    # the page for every row
+    return ''.join([encoder.encode(row) + "\n" for row in rows])
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_date(ts):
+    if ts is None or ts == '':
+        return ''
+    # timestamps are in seconds; the date part is formatted once per day
+    days, seconds = divmod(int(ts), 86400)
+    day = _dates.get(days)
+    if day is None:
+        day = (EPOCH + timedelta(days=days)).strftime('%Y-%m-%d')
+        _dates[days] = day
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%sT%02d:%02d:%02d' % (day, hours, minutes, seconds)
+
+def to_dates(values):
+
+    # convert a list of timestamps at once; uses numpy when it's available
+    # and there are enough values to make it worthwhile
+    if np is None or len(values) < NUMPY_MIN_VALUES:
+        return [to_date(v) for v in values]
+    missing = [v is None or v == '' for v in values]
+    timestamps = np.array([0 if m else int(v) for v, m in zip(values, missing)], dtype='int64')
+    dates = np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s').tolist()
+    return ['' if m else d for d, m in zip(dates, missing)]
+
+def convert_dates(rows, properties):
+
+    # convert the timestamps for all the date properties of a page at once
+    if len(rows) == 0 or len(properties) == 0:
+        return rows
+    values = [row[p] for p in properties for row in rows]
+    dates = iter(to_dates(values))
+    for p in properties:
+        for row in rows:
+            row[p] = next(dates)
+    return rows
+
+def to_string(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (Decimal)):
+        return str(value)
+    return value
+
+# map this function's property names to the API's property names where they
+# differ; nested properties are given as a path (e.g. 'location.country')
+PROPERTY_PATHS = {
+    'location_country': 'location.country',
+    'location_region': 'location.region',
+    'location_city': 'location.city',
+}
+
+# properties with timestamps that are returned as dates
+DATE_PROPERTIES = (
+    'created_at',
+    'updated_at',
+    'signed_up_at',
+    'last_seen_at',
+    'last_replied_at',
+    'last_contacted_at',
+    'last_email_opened_at',
+    'last_email_clicked_at',
+    'android_last_seen_at',
+    'ios_last_seen_at',
+)
+
+# the properties in the "returns" list in the header, for when this file
+# can't be read
+RETURNS = (
+    ('id', 'string'),
+    ('workspace_id', 'string'),
+    ('external_id', 'string'),
+    ('role', 'string'),
+    ('email', 'string'),
+    ('phone', 'string'),
+    ('name', 'string'),
+    ('avatar', 'string'),
+    ('owner_id', 'string'),
+    ('has_hard_bounced', 'boolean'),
+    ('marked_email_as_spam', 'boolean'),
+    ('unsubscribed_from_emails', 'boolean'),
+    ('created_at', 'string'),
+    ('updated_at', 'string'),
+    ('signed_up_at', 'string'),
+    ('last_seen_at', 'string'),
+    ('last_replied_at', 'string'),
+    ('last_contacted_at', 'string'),
+    ('last_email_opened_at', 'string'),
+    ('last_email_clicked_at', 'string'),
+    ('language_override', 'string'),
+    ('browser', 'string'),
+    ('browser_version', 'string'),
+    ('browser_language', 'string'),
+    ('os', 'string'),
+    ('location_country', 'string'),
+    ('location_region', 'string'),
+    ('location_city', 'string'),
+    ('android_app_name', 'string'),
+    ('android_app_version', 'string'),
+    ('android_device', 'string'),
+    ('android_os_version', 'string'),
+    ('android_sdk_version', 'string'),
+    ('android_last_seen_at', 'string'),
+    ('ios_app_name', 'string'),
+    ('ios_app_version', 'string'),
+    ('ios_device', 'string'),
+    ('ios_os_version', 'string'),
+    ('ios_sdk_version', 'string'),
+    ('ios_last_seen_at', 'string'),
+)
+
+def get_returns():
+
+    # read the property names and types from the "returns" list in the
+    # header at the top of this file; when the file can't be read, such as
+    # when the runtime runs the code without a __file__, use RETURNS
+    try:
+        f = open(__file__, 'r', encoding='utf-8')
+    except (NameError, OSError):
+        return OrderedDict(RETURNS)
+    returns = OrderedDict()
+    in_returns = False
+    name = None
+    with f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            line = line[1:].rstrip()
+            indent = len(line) - len(line.lstrip())
+            line = line.strip()
+            if line == '---':
+                if in_returns:
+                    break
+                continue
+            if indent <= 1:
+                in_returns = line == 'returns:'
+                continue
+            if not in_returns:
+                continue
+            key, _, value = line.lstrip('- ').partition(':')
+            if line.startswith('- '):
+                name = None
+            if key == 'name':
+                name = value.strip()
+                returns[name] = 'string'
+            elif key == 'type' and name is not None:
+                returns[name] = value.strip()
+    return returns
+
+# the property names and types from the header
+PROPERTY_TYPES = get_returns()
+
+def get_properties(params):
+
+    # properties can be passed as a list or as a comma-delimited string;
+    # an empty list or '*' returns all properties
+    properties = dict(params).get('properties') or '*'
+    if isinstance(properties, str):
+        properties = properties.split(',')
+    properties = [p.strip().lower() for p in properties if p.strip() != '']
+    if len(properties) == 0 or '*' in properties:
+        return list(PROPERTY_TYPES.keys())
+
+    for p in properties:
+        if p not in PROPERTY_TYPES:
+            raise ValueError('Invalid property: ' + p)
+    return properties
+
+@functools.lru_cache(maxsize=32)
+def compile_item_extractor(properties, dates=True):
+
+    # generate a function that returns the given properties for an item;
+    # each nested object a property is read from is looked up once per item
+    # and missing or null objects are treated as empty; timestamps are left
+    # as is when dates is false so they can be converted a page at a time
+    lines = []
+    objects = {(): 'item'}
+
+    def get_object(path):
+        if path not in objects:
+            parent = get_object(path[:-1])
+            objects[path] = 'obj_' + str(len(objects))
+            lines.append('    %s = %s.get(%r) or EMPTY' % (objects[path], parent, path[-1]))
+        return objects[path]
+
+    values = []
+    for p in properties:
+        path = tuple(PROPERTY_PATHS.get(p, p).split('.'))
+        value = '%s.get(%r)' % (get_object(path[:-1]), path[-1])
+        if dates and p in DATE_PROPERTIES:
+            value = 'to_date(%s)' % value
+        values.append('        %r: %s,' % (p, value))
+
+    source = '\n'.join(['def get_item_info(item):'] + lines + ['    return {'] + values + ['    }'])
+    namespace = {'EMPTY': {}, 'to_date': to_date}
+    exec(compile(source, '<get_item_info>', 'exec'), namespace)
+    return namespace['get_item_info']
+
+def get_item_extractor(properties, dates=True):
+    return compile_item_extractor(tuple(properties), dates)
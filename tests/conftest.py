@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_intercom import MockIntercom, load_function
+
+@pytest.fixture(scope='session')
+def intercom():
+    with MockIntercom(contacts=1000, conversations=200, companies=100) as mock:
+        yield mock
+
+@pytest.fixture
+def load(intercom, tmp_path):
+
+    # load a function pointed at the mock api with its own temporary files
+    def load(name):
+        return load_function(name, intercom.url, tmp_path)
+
+    intercom.reset_stats()
+    return load
@@ -0,0 +1,551 @@
+"""
+A local stand-in for api.intercom.io for the tests and benchmarks.
+
+MockIntercom serves synthetic contacts, conversations and companies from the
+endpoints the functions use (the list, search, scroll, conversation, admin
+and team apis) with the same pagination as the 2.0 api: cursors for the
+contacts list and the search apis, and the url of the next page for the
+conversations and companies lists. Responses carry the rate limit headers
+and return 429s once a window's limit is used up, and can be slowed down
+with a fixed latency per request and a latency per record returned.
+
+load_function() loads a function from this repository with its api urls
+pointed at a MockIntercom, and FakeFlex stands in for the flex object the
+functions are called with.
+"""
+
+import os
+import json
+import math
+import time
+import random
+import threading
+import types
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_URL = 'https://api.intercom.io'
+
+# the time the first synthetic record was created; records are created
+# CREATED_INTERVAL seconds apart on average
+CREATED_START = 1577836800 # 2020-01-01
+CREATED_INTERVAL = 3600
+
+# the number of records returned by the list apis when per_page isn't given,
+# and by each page of the companies scroll api
+DEFAULT_PAGE_SIZE = 50
+SCROLL_PAGE_SIZE = 50
+
+ADMIN_COUNT = 5
+
+WORDS = ('account', 'billing', 'export', 'invoice', 'login', 'plan', 'report', 'team',
+         'trial', 'upgrade', 'the', 'a', 'to', 'and', 'is', 'for', 'with', 'our', 'please', 'thanks')
+
+class MockIntercom:
+
+    def __init__(self, contacts=1000, conversations=200, companies=100, latency=0.0,
+                 rate_limit=None, rate_window=10, custom_attribute_bytes=512, seed=0, record_latency=0.0):
+
+        # custom_attribute_bytes pads each contact and company with custom
+        # attributes so the payloads are about the size of a real workspace's
+        self.latency = latency
+        self.record_latency = record_latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.rate_remaining = rate_limit
+        self.rate_reset = 0
+
+        rng = random.Random(seed)
+        self.companies = [make_company(i, rng, custom_attribute_bytes) for i in range(companies)]
+        self.contacts = [make_contact(i, rng, custom_attribute_bytes, companies) for i in range(contacts)]
+        self.conversations = [make_conversation(i, rng, contacts) for i in range(conversations)]
+        self.admins = [make_admin(i) for i in range(ADMIN_COUNT)]
+        self.teams = [make_team(i) for i in range(2)]
+        self.reset_stats()
+
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        mock = self
+        class Handler(RequestHandler):
+            pass
+        Handler.mock = mock
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'rate_limited': 0, 'bytes_sent': 0, 'paths': {}}
+
+    def set_rate_limit(self, limit, remaining=None, window=None):
+        # start a new rate limit window with the given limit
+        with self.lock:
+            self.rate_limit = limit
+            if window is not None:
+                self.rate_window = window
+            self.rate_remaining = limit if remaining is None else remaining
+            self.rate_reset = time.time() + self.rate_window
+
+    def take_request(self, path):
+
+        # count the request and take it from the rate limit; returns the
+        # rate limit headers and whether the request is over the limit
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['paths'][path] = self.stats['paths'].get(path, 0) + 1
+            if self.rate_limit is None:
+                return {}, False
+            now = time.time()
+            if now >= self.rate_reset:
+                self.rate_remaining = self.rate_limit
+                self.rate_reset = now + self.rate_window
+            limited = self.rate_remaining <= 0
+            if limited:
+                self.stats['rate_limited'] += 1
+            else:
+                self.rate_remaining -= 1
+            headers = {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self.rate_remaining),
+                'X-RateLimit-Reset': str(int(math.ceil(self.rate_reset)))
+            }
+            return headers, limited
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.stats['bytes_sent'] += size
+
+    # the endpoints; each returns the status code and the body
+
+    def list_contacts(self, query):
+        per_page = int(query.get('per_page') or DEFAULT_PAGE_SIZE)
+        start = from_cursor(query.get('starting_after'))
+        return 200, cursor_page('list', 'data', self.contacts, start, per_page)
+
+    def search(self, collection, body):
+        items = getattr(self, collection)
+        items = [item for item in items if matches(item, body.get('query'))]
+        sort = body.get('sort')
+        if sort is not None:
+            descending = sort.get('order') == 'descending'
+            items = sorted(items, key=lambda item: get_path(item, sort.get('field')) or 0, reverse=descending)
+        pagination = body.get('pagination') or {}
+        per_page = int(pagination.get('per_page') or DEFAULT_PAGE_SIZE)
+        start = from_cursor(pagination.get('starting_after'))
+        key = 'conversations' if collection == 'conversations' else 'data'
+        return 200, cursor_page('list', key, items, start, per_page)
+
+    def list_pages(self, collection, query, base_url):
+        per_page = int(query.get('per_page') or DEFAULT_PAGE_SIZE)
+        page = int(query.get('page') or 1)
+        items = getattr(self, collection)
+        data = items[(page - 1) * per_page:page * per_page]
+        next_url = None
+        if page * per_page < len(items):
+            next_url = base_url + '/' + collection + '?' + urllib.parse.urlencode({'per_page': per_page, 'page': page + 1})
+        key = 'conversations' if collection == 'conversations' else 'data'
+        content = {'type': ('conversation.list' if collection == 'conversations' else 'list'), key: data,
+                   'total_count': len(items), 'pages': {'type': 'pages', 'page': page, 'per_page': per_page,
+                   'total_pages': int(math.ceil(len(items) / per_page)), 'next': next_url}}
+        return 200, content
+
+    def lookup_company(self, query):
+        for field in ('company_id', 'name'):
+            if field in query:
+                for company in self.companies:
+                    if company.get(field) == query[field]:
+                        return 200, company
+        return 404, error('company_not_found', 'Company Not Found')
+
+    def scroll_companies(self, query):
+        start = int(query.get('scroll_param') or 0)
+        data = self.companies[start:start + SCROLL_PAGE_SIZE]
+        return 200, {'type': 'list', 'data': data, 'pages': None, 'total_count': None,
+                     'scroll_param': str(start + SCROLL_PAGE_SIZE)}
+
+    def get_conversation(self, conversation_id):
+        for i, conversation in enumerate(self.conversations):
+            if conversation['id'] == conversation_id:
+                conversation = dict(conversation)
+                conversation['conversation_parts'] = make_parts(i)
+                return 200, conversation
+        return 404, error('not_found', 'Resource Not Found')
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+
+        url = urllib.parse.urlparse(self.path)
+        path = url.path.strip('/')
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}') if length > 0 else {}
+
+        headers, limited = self.mock.take_request(method + ' /' + path)
+        if limited:
+            return self.send(429, error('rate_limit_exceeded', 'Exceeded rate limit'), headers)
+        if self.mock.latency > 0:
+            time.sleep(self.mock.latency)
+
+        mock = self.mock
+        base_url = 'http://' + self.headers.get('Host')
+        if method == 'GET' and path == 'contacts':
+            status, content = mock.list_contacts(query)
+        elif method == 'POST' and path in ('contacts/search', 'conversations/search'):
+            status, content = mock.search(path.split('/')[0], body)
+        elif method == 'GET' and path == 'conversations':
+            status, content = mock.list_pages('conversations', query, base_url)
+        elif method == 'GET' and path.startswith('conversations/'):
+            status, content = mock.get_conversation(path.split('/', 1)[1])
+        elif method == 'GET' and path == 'companies' and ('company_id' in query or 'name' in query):
+            status, content = mock.lookup_company(query)
+        elif method == 'GET' and path == 'companies':
+            status, content = mock.list_pages('companies', query, base_url)
+        elif method == 'GET' and path == 'companies/scroll':
+            status, content = mock.scroll_companies(query)
+        elif method == 'GET' and path == 'admins':
+            status, content = 200, {'type': 'admin.list', 'admins': mock.admins}
+        elif method == 'GET' and path == 'teams':
+            status, content = 200, {'type': 'team.list', 'teams': mock.teams}
+        else:
+            status, content = 404, error('not_found', 'Resource Not Found')
+        if self.mock.record_latency > 0:
+            # larger pages take longer, as they do with the api
+            records = content.get('data') or content.get('conversations') or []
+            time.sleep(self.mock.record_latency * len(records))
+        self.send(status, content, headers)
+
+    def send(self, status, content, headers):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.mock.count_bytes(len(body))
+
+def cursor_page(content_type, key, items, start, per_page):
+    data = items[start:start + per_page]
+    pages = {'type': 'pages', 'per_page': per_page, 'total_pages': int(math.ceil(len(items) / per_page))}
+    if start + per_page < len(items):
+        pages['next'] = {'per_page': per_page, 'starting_after': to_cursor(start + per_page)}
+    return {'type': content_type, key: data, 'total_count': len(items), 'pages': pages}
+
+def to_cursor(position):
+    # cursors are opaque to the functions, so don't make them look like ids
+    return 'WzE2MDA' + format(position, 'x')
+
+def from_cursor(cursor):
+    if cursor is None or cursor == '':
+        return 0
+    return int(cursor[len('WzE2MDA'):], 16)
+
+def matches(item, query):
+
+    # a search query is a single predicate or an AND or OR of queries
+    if query is None:
+        return True
+    operator = query.get('operator')
+    if operator in ('AND', 'OR'):
+        results = [matches(item, q) for q in query.get('value')]
+        return all(results) if operator == 'AND' else any(results)
+    value = get_path(item, query.get('field'))
+    expected = query.get('value')
+    if operator == '=':
+        return value == expected
+    if operator == '!=':
+        return value != expected
+    if operator == 'IN':
+        return value in expected
+    if operator == 'NIN':
+        return value not in expected
+    if operator == '>':
+        return value is not None and value > expected
+    if operator == '<':
+        return value is not None and value < expected
+    raise ValueError('Unsupported operator: ' + str(operator))
+
+def get_path(item, path):
+    for key in path.split('.'):
+        item = item.get(key) if isinstance(item, dict) else None
+    return item
+
+def error(code, message):
+    return {'type': 'error.list', 'request_id': None, 'errors': [{'code': code, 'message': message}]}
+
+def make_text(rng, size):
+    words = []
+    while size > 0:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size -= len(word) + 1
+    return ' '.join(words)
+
+def make_custom_attributes(rng, size):
+    attributes = {}
+    i = 0
+    while size > 0:
+        value = make_text(rng, min(size, 64))
+        attributes['attribute_' + str(i)] = value
+        size -= len(value) + 20
+        i += 1
+    return attributes
+
+def make_contact(i, rng, custom_attribute_bytes, company_count):
+    created_at = CREATED_START + i * CREATED_INTERVAL + rng.randrange(CREATED_INTERVAL)
+    updated_at = created_at + rng.randrange(86400 * 30)
+    companies = []
+    if company_count > 0 and i % 4 != 0:
+        companies = [{'type': 'company', 'id': company_id(i % company_count), 'url': '/companies/' + company_id(i % company_count)}]
+    return {
+        'type': 'contact',
+        'id': '5f%022x' % i,
+        'workspace_id': 'ecahpwf5',
+        'external_id': 'user-' + str(i),
+        'role': 'user' if i % 5 else 'lead',
+        'email': 'user%d@example.com' % i,
+        'phone': '+1555%07d' % i if i % 3 == 0 else None,
+        'name': 'User ' + str(i),
+        'avatar': None,
+        'owner_id': None,
+        'social_profiles': {'type': 'list', 'data': []},
+        'has_hard_bounced': i % 97 == 0,
+        'marked_email_as_spam': False,
+        'unsubscribed_from_emails': i % 2 == 0,
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'signed_up_at': created_at,
+        'last_seen_at': updated_at if i % 3 else None,
+        'last_replied_at': None,
+        'last_contacted_at': updated_at - 3600,
+        'last_email_opened_at': None,
+        'last_email_clicked_at': None,
+        'language_override': None,
+        'browser': rng.choice(['chrome', 'firefox', 'safari']),
+        'browser_version': '86.0',
+        'browser_language': 'en',
+        'os': rng.choice(['OS X 10.15', 'Windows 10', 'Linux']),
+        'location': {'type': 'location', 'country': rng.choice(['United States', 'Germany', 'Japan']), 'region': None, 'city': None},
+        'android_app_name': None,
+        'android_app_version': None,
+        'android_device': None,
+        'android_os_version': None,
+        'android_sdk_version': None,
+        'android_last_seen_at': None,
+        'ios_app_name': None,
+        'ios_app_version': None,
+        'ios_device': None,
+        'ios_os_version': None,
+        'ios_sdk_version': None,
+        'ios_last_seen_at': None,
+        'custom_attributes': make_custom_attributes(rng, custom_attribute_bytes),
+        'tags': {'type': 'list', 'data': [], 'url': '/contacts/%d/tags' % i, 'total_count': 0, 'has_more': False},
+        'notes': {'type': 'list', 'data': [], 'url': '/contacts/%d/notes' % i, 'total_count': 0, 'has_more': False},
+        'companies': {'type': 'list', 'data': companies, 'url': '/contacts/%d/companies' % i, 'total_count': len(companies), 'has_more': False}
+    }
+
+def company_id(i):
+    return '6a%022x' % i
+
+def make_company(i, rng, custom_attribute_bytes):
+    created_at = CREATED_START + i * CREATED_INTERVAL
+    return {
+        'type': 'company',
+        'id': company_id(i),
+        'company_id': 'company-' + str(i),
+        'app_id': 'ecahpwf5',
+        'name': 'Company ' + str(i),
+        'created_at': created_at,
+        'remote_created_at': created_at - 86400 if i % 2 else None,
+        'updated_at': created_at + rng.randrange(86400 * 30),
+        'last_request_at': None,
+        'session_count': rng.randrange(1000),
+        'monthly_spend': rng.randrange(10000),
+        'user_count': rng.randrange(100),
+        'size': rng.randrange(5000),
+        'website': 'https://company%d.example.com' % i,
+        'industry': rng.choice(['software', 'retail', 'finance']),
+        'plan': {},
+        'custom_attributes': make_custom_attributes(rng, custom_attribute_bytes),
+        'tags': {'type': 'tag.list', 'tags': []},
+        'segments': {'type': 'segment.list', 'segments': []}
+    }
+
+def make_conversation(i, rng, contact_count):
+    created_at = CREATED_START + i * CREATED_INTERVAL + rng.randrange(CREATED_INTERVAL)
+    updated_at = created_at + rng.randrange(86400 * 7)
+    is_open = i % 3 == 0
+    admin = 'admin-' + str(i % ADMIN_COUNT)
+    return {
+        'type': 'conversation',
+        'id': str(1000000 + i),
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'waiting_since': updated_at if is_open else None,
+        'snoozed_until': None,
+        'source': {
+            'type': 'conversation',
+            'id': str(2000000 + i),
+            'delivered_as': 'customer_initiated',
+            'subject': '',
+            'body': '<p>' + make_text(rng, rng.randrange(100, 2000)) + '</p>',
+            'author': {'type': 'user', 'id': '5f%022x' % (i % max(contact_count, 1)), 'name': 'User', 'email': 'user@example.com'},
+            'attachments': [],
+            'url': None
+        },
+        'contacts': {'type': 'contact.list', 'contacts': [{'type': 'contact', 'id': '5f%022x' % (i % max(contact_count, 1))}]},
+        'first_contact_reply': {'created_at': created_at, 'type': 'conversation', 'url': None},
+        'admin_assignee_id': None,
+        'team_assignee_id': None,
+        'assignee': {'type': 'admin', 'id': admin},
+        'open': is_open,
+        'state': 'open' if is_open else 'closed',
+        'read': True,
+        'tags': {'type': 'tag.list', 'tags': []},
+        'priority': 'not_priority',
+        'sla_applied': None,
+        'statistics': {
+            'type': 'conversation_statistics',
+            'time_to_assignment': 0,
+            'time_to_admin_reply': rng.randrange(86400),
+            'time_to_first_close': rng.randrange(86400),
+            'time_to_last_close': rng.randrange(86400),
+            'median_time_to_reply': rng.randrange(3600),
+            'first_contact_reply_at': created_at,
+            'first_assignment_at': created_at,
+            'first_admin_reply_at': created_at + 600,
+            'first_close_at': None if is_open else updated_at,
+            'last_assignment_at': created_at,
+            'last_assignment_admin_reply_at': created_at + 600,
+            'last_contact_reply_at': updated_at,
+            'last_admin_reply_at': updated_at,
+            'last_close_at': None if is_open else updated_at,
+            'last_closed_by_id': None if is_open else admin,
+            'count_reopens': i % 4,
+            'count_assignments': 1,
+            'count_conversation_parts': i % 5
+        }
+    }
+
+def make_parts(i):
+    parts = [{
+        'type': 'conversation_part',
+        'id': str(3000000 + i * 10 + j),
+        'part_type': 'comment',
+        'body': '<p>Reply ' + str(j) + '</p>',
+        'created_at': CREATED_START + i * CREATED_INTERVAL + j * 60,
+        'updated_at': CREATED_START + i * CREATED_INTERVAL + j * 60,
+        'notified_at': CREATED_START + i * CREATED_INTERVAL + j * 60,
+        'assigned_to': None,
+        'author': {'type': 'admin', 'id': 'admin-' + str(j % ADMIN_COUNT), 'name': 'Admin ' + str(j % ADMIN_COUNT), 'email': 'admin%d@example.com' % (j % ADMIN_COUNT)},
+        'attachments': [],
+        'external_id': None
+    } for j in range(i % 5)]
+    return {'type': 'conversation_part.list', 'conversation_parts': parts, 'total_count': len(parts)}
+
+def make_admin(i):
+    return {'type': 'admin', 'id': 'admin-' + str(i), 'name': 'Admin ' + str(i), 'email': 'admin%d@example.com' % i,
+            'away_mode_enabled': False, 'away_mode_reassign': False, 'has_inbox_seat': True, 'team_ids': []}
+
+def make_team(i):
+    return {'type': 'team', 'id': 'team-' + str(i), 'name': 'Team ' + str(i),
+            'admin_ids': ['admin-' + str(a) for a in range(ADMIN_COUNT) if a % 2 == i % 2]}
+
+def load_function(name, base_url, temp_dir=None, with_file=True):
+
+    # load a function from this repository as a module with its api urls
+    # pointed at base_url; the function files aren't importable modules, and
+    # each load gets its own session, rate limiter and caches; temp_dir keeps
+    # the files a function writes (snapshots, checkpoints, the rate limit
+    # state and cached responses) apart from other runs; with_file=False
+    # runs it without a __file__, as a runtime that execs the code does
+    path = os.path.join(REPOSITORY_DIR, name + '.py')
+    with open(path, 'r', encoding='utf-8') as f:
+        source = f.read().replace(API_URL, base_url)
+    module = types.ModuleType(name.replace('-', '_'))
+    if with_file:
+        module.__file__ = path
+    exec(compile(source, path, 'exec'), module.__dict__)
+    if temp_dir is not None:
+        for setting in ('SNAPSHOT_DIR', 'CHECKPOINT_DIR', 'RATE_LIMIT_DIR'):
+            if hasattr(module, setting):
+                setattr(module, setting, str(temp_dir))
+        if hasattr(module, 'CACHE_DIR'):
+            module.CACHE_DIR = os.path.join(str(temp_dir), 'intercom-cache')
+    return module
+
+class FakeOutput:
+
+    def __init__(self, keep=True):
+        # keep=False only counts what's written, for long benchmark runs
+        self.keep = keep
+        self.parts = []
+        self.bytes_written = 0
+        self.lines = 0
+        self.content_type = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bytes_written += len(data)
+        self.lines += data.count(b'\n')
+        if self.keep:
+            self.parts.append(data)
+
+    def getvalue(self):
+        return b''.join(self.parts).decode('utf-8')
+
+class FakeFlex:
+
+    # the parts of the flex object the functions use: the params in vars and
+    # the output to write to
+    def __init__(self, params, token='test-token', keep=True):
+        self.vars = dict(params)
+        self.vars.setdefault('intercom_connection', {'access_token': token})
+        self.output = FakeOutput(keep)
+
+def run_function(module, params, token='test-token'):
+    # call a function's handler and return what it wrote
+    flex = FakeFlex(params, token)
+    module.flexio_handler(flex)
+    return flex.output.getvalue()
+
+def read_ndjson(text):
+    return [json.loads(line) for line in text.splitlines() if line.strip() != '']
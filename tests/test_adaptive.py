@@ -0,0 +1,40 @@
+import urllib.parse
+
+import pytest
+
+from mock_intercom import MockIntercom, load_function, run_function, read_ndjson
+
+@pytest.fixture
+def slow_intercom():
+    # each record adds to the time a page takes, so only large pages time out
+    with MockIntercom(contacts=200, conversations=0, companies=0, record_latency=0.005) as mock:
+        yield mock
+
+def test_adaptive_list_shrinks_a_page_that_times_out(slow_intercom, tmp_path):
+    contacts = load_function('intercom-contacts', slow_intercom.url, tmp_path)
+    contacts.REQUEST_TIMEOUT = (1, 0.3)
+    contacts._session = contacts.requests_retry_session(retries=1, backoff_factor=0)
+
+    page_sizes = []
+    send_request = contacts.send_request
+    def record_page_size(method, url, headers, cache_ttl=0, **kwargs):
+        page_sizes.append(int(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['per_page'][0]))
+        return send_request(method, url, headers, cache_ttl, **kwargs)
+    contacts.send_request = record_page_size
+
+    rows = read_ndjson(run_function(contacts, {'properties': 'id', 'adaptive': True, 'page_size': 150}))
+
+    # the read timeout of the list endpoint is retried by the session before
+    # the page is shrunk
+    assert page_sizes[0] == 150
+    assert min(page_sizes) < 150
+    ids = [row['id'] for row in rows]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == set(c['id'] for c in slow_intercom.contacts)
+
+def test_timeout_without_adaptive_is_raised(slow_intercom, tmp_path):
+    contacts = load_function('intercom-contacts', slow_intercom.url, tmp_path)
+    contacts.REQUEST_TIMEOUT = (1, 0.3)
+    contacts._session = contacts.requests_retry_session(retries=1, backoff_factor=0)
+    with pytest.raises(contacts.requests.exceptions.ConnectionError):
+        run_function(contacts, {'properties': 'id', 'page_size': 150})
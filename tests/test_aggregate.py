@@ -0,0 +1,62 @@
+import random
+import statistics
+
+from mock_intercom import run_function, read_ndjson
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    i = int(position)
+    if i + 1 >= len(values):
+        return values[i]
+    return values[i] + (values[i + 1] - values[i]) * (position - i)
+
+def test_summary_of_small_groups_is_exact(load):
+    contacts = load('intercom-contacts')
+    values = [random.Random(1).randrange(1000) for _ in range(500)]
+    summary = contacts.Summary(sampled=True)
+    for value in values + [None, '']:
+        summary.add(value)
+    assert summary.get('count') == 500
+    assert summary.get('sum') == sum(values)
+    assert summary.get('min') == min(values)
+    assert summary.get('max') == max(values)
+    assert summary.get('mean') == statistics.mean(values)
+    assert summary.get('median', 0.5) == statistics.median(values)
+    for q in (0.01, 0.25, 0.9, 0.99):
+        assert summary.get('p', q) == exact_quantile(values, q)
+
+def test_summary_sample_stays_bounded(load):
+    contacts = load('intercom-contacts')
+    rng = random.Random(2)
+    values = [rng.gauss(100, 15) for _ in range(50000)]
+    summary = contacts.Summary(sampled=True)
+    for value in values:
+        summary.add(value)
+    assert len(summary.sample) == contacts.QUANTILE_SAMPLE_SIZE
+    assert abs(summary.get('median', 0.5) - statistics.median(values)) < 2
+    assert abs(summary.get('p90', 0.9) - exact_quantile(values, 0.9)) < 3
+
+def test_summary_of_dates_and_strings(load):
+    contacts = load('intercom-contacts')
+    summary = contacts.Summary()
+    for value in ['2020-03-01T00:00:00', '2020-01-01T00:00:00', '2020-02-01T00:00:00']:
+        summary.add(value)
+    assert summary.get('count') == 3
+    assert summary.get('min') == '2020-01-01T00:00:00'
+    assert summary.get('max') == '2020-03-01T00:00:00'
+    assert summary.get('mean') is None
+
+def test_aggregate_export(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-companies'), {'group_by': 'industry', 'aggregate': 'count, median(monthly_spend), max(size)'}))
+    for row in rows:
+        companies = [c for c in intercom.companies if c['industry'] == row['industry']]
+        assert row['count'] == len(companies)
+        assert row['median(monthly_spend)'] == statistics.median(c['monthly_spend'] for c in companies)
+        assert row['max(size)'] == max(c['size'] for c in companies)
+    assert sum(row['count'] for row in rows) == len(intercom.companies)
+
+def test_aggregate_by_month(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-contacts'), {'group_by': 'month(created_at), role'}))
+    assert sum(row['count'] for row in rows) == len(intercom.contacts)
+    assert all(row['month(created_at)'].endswith('-01') for row in rows)
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+
+from mock_intercom import run_function
+
+def test_cached_export_doesnt_call_the_api_again(load, intercom):
+    params = {'properties': 'id', 'page_size': 100, 'cache_ttl': 60}
+    contacts = load('intercom-contacts')
+    first = run_function(contacts, params)
+    requests = intercom.stats['requests']
+    assert run_function(contacts, params) == first
+    assert intercom.stats['requests'] == requests
+
+def test_cache_is_only_scanned_when_over_its_cap(load):
+    contacts = load('intercom-contacts')
+    contacts.CACHE_MAX_BYTES = 50 * 1024
+    os.makedirs(contacts.CACHE_DIR)
+
+    scans = []
+    evict_cache = contacts.evict_cache
+    def count_scans():
+        scans.append(1)
+        return evict_cache()
+    contacts.evict_cache = count_scans
+
+    for i in range(200):
+        contacts.write_cache(os.path.join(contacts.CACHE_DIR, '%064x.z' % i), os.urandom(1024))
+    size = sum(entry.stat().st_size for entry in os.scandir(contacts.CACHE_DIR) if entry.name.endswith('.z'))
+    assert size <= contacts.CACHE_MAX_BYTES
+    assert len(scans) < 200 / 2
+
+def test_cache_evicts_the_least_recently_used(load):
+    contacts = load('intercom-contacts')
+    contacts.CACHE_MAX_BYTES = 6000
+    os.makedirs(contacts.CACHE_DIR)
+    paths = [os.path.join(contacts.CACHE_DIR, '%064x.z' % i) for i in range(5)]
+    for i, path in enumerate(paths):
+        contacts.write_cache(path, os.urandom(1024))
+        os.utime(path, (time.time() - 100 + i, time.time()))
+    os.utime(paths[0], (time.time(), time.time()))
+    contacts.write_cache(os.path.join(contacts.CACHE_DIR, '%064x.z' % 5), os.urandom(1024))
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+
+def test_requests_for_other_keys_dont_wait(load, intercom):
+    contacts = load('intercom-contacts')
+    headers = {'Authorization': 'Bearer test-token', 'Accept': 'application/json'}
+    send_request = contacts.send_request
+    started = threading.Event()
+
+    # the first request waits as if it were throttled
+    def slow_send_request(method, url, headers, cache_ttl=0, **kwargs):
+        if 'slow' in url:
+            started.set()
+            time.sleep(1)
+        return send_request(method, url, headers, cache_ttl, **kwargs)
+    contacts.send_request = slow_send_request
+
+    slow = threading.Thread(target=contacts.send_cached_request, args=('GET', intercom.url + '/contacts?slow=1', headers, 60))
+    slow.start()
+    started.wait()
+    start = time.time()
+    for i in range(20):
+        contacts.send_cached_request('GET', intercom.url + '/contacts?per_page=%d' % (i + 1), headers, 60)
+    assert time.time() - start < 0.5
+    slow.join()
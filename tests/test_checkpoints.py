@@ -0,0 +1,87 @@
+import os
+import pytest
+
+from mock_intercom import FakeFlex, run_function, read_ndjson
+
+def run_until_failure(module, params, pages):
+
+    # run an export that fails after the given number of pages have been
+    # requested, and return what it wrote before it failed
+    send_request = module.send_request
+    sent = []
+
+    def fail_after(method, url, headers, *args, **kwargs):
+        if len(sent) == pages:
+            raise module.requests.exceptions.ConnectionError('connection reset')
+        sent.append(url)
+        return send_request(method, url, headers, *args, **kwargs)
+
+    module.send_request = fail_after
+    flex = FakeFlex(params)
+    with pytest.raises(module.requests.exceptions.ConnectionError):
+        module.flexio_handler(flex)
+    module.send_request = send_request
+    return flex.output.getvalue()
+
+def test_checkpoint_round_trip(load, tmp_path):
+    contacts = load('intercom-contacts')
+    path = str(tmp_path / 'checkpoint.json')
+    assert contacts.load_checkpoint(path) == (None, 0)
+    contacts.save_checkpoint(path, 'WzE2MDAa', 150)
+    assert contacts.load_checkpoint(path) == ('WzE2MDAa', 150)
+    contacts.remove_checkpoint(path)
+    contacts.remove_checkpoint(path)
+    assert not os.path.exists(path)
+
+@pytest.mark.parametrize('name', ['intercom-contacts', 'intercom-conversations', 'intercom-companies'])
+def test_expired_checkpoint_is_ignored(load, tmp_path, name):
+    module = load(name)
+    path = str(tmp_path / 'checkpoint.json')
+    module.save_checkpoint(path, 'WzE2MDAa', 150)
+    module.CHECKPOINT_TTL = -1
+    assert module.load_checkpoint(path) == (None, 0)
+
+def test_expired_checkpoint_starts_over(load, intercom):
+    params = {'properties': 'id', 'page_size': 40, 'resume': True}
+    module = load('intercom-contacts')
+    first = read_ndjson(run_until_failure(module, params, 2))
+    assert 0 < len(first) < len(intercom.contacts)
+
+    module = load('intercom-contacts')
+    module.CHECKPOINT_TTL = -1
+    rows = read_ndjson(run_function(module, params))
+    assert [row['id'] for row in rows] == [c['id'] for c in intercom.contacts]
+
+def test_checkpoint_path_depends_on_params(load):
+    contacts = load('intercom-contacts')
+    path = contacts.get_checkpoint_path('token', {'properties': 'id', 'resume': True})
+    assert path == contacts.get_checkpoint_path('token', {'properties': 'id', 'resume': False})
+    assert path != contacts.get_checkpoint_path('token', {'properties': 'id,email', 'resume': True})
+    assert path != contacts.get_checkpoint_path('other-token', {'properties': 'id', 'resume': True})
+
+@pytest.mark.parametrize('name, key', [
+    ('intercom-contacts', 'id'),
+    ('intercom-conversations', 'id'),
+    ('intercom-companies', 'id'),
+])
+def test_resume_continues_after_the_last_page(load, name, key):
+    params = {'properties': key, 'page_size': 40, 'resume': True}
+    expected = read_ndjson(run_function(load(name), {'properties': key, 'page_size': 40}))
+
+    module = load(name)
+    first = read_ndjson(run_until_failure(module, params, 2))
+    assert 0 < len(first) < len(expected)
+    path = module.get_checkpoint_path('test-token', params)
+    assert os.path.exists(path)
+
+    second = read_ndjson(run_function(load(name), params))
+    assert first + second == expected
+    assert not os.path.exists(path)
+
+def test_resumed_table_skips_the_header(load):
+    params = {'properties': 'id,email', 'page_size': 100, 'resume': True, 'format': 'table'}
+    first = read_ndjson(run_until_failure(load('intercom-contacts'), params, 2))
+    second = read_ndjson(run_function(load('intercom-contacts'), params))
+    assert first[0] == ['id', 'email']
+    assert ['id', 'email'] not in second
+    assert len(first) - 1 + len(second) == 1000
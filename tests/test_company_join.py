@@ -0,0 +1,61 @@
+import pytest
+
+from mock_intercom import run_function, read_ndjson
+
+PARAMS = {'properties': 'id', 'company_properties': 'name,monthly_spend'}
+
+def get_companies(intercom):
+    return dict((company['id'], company) for company in intercom.companies)
+
+def check_join(intercom, rows):
+    companies = get_companies(intercom)
+    assert len(rows) == len(intercom.contacts)
+    for row, contact in zip(rows, intercom.contacts):
+        assert list(row.keys()) == ['id', 'company_name', 'company_monthly_spend']
+        data = contact['companies']['data']
+        company = companies[data[0]['id']] if len(data) > 0 else {}
+        assert row['company_name'] == company.get('name')
+        assert row['company_monthly_spend'] == company.get('monthly_spend')
+
+def test_join_adds_the_company_properties(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-contacts'), PARAMS))
+    check_join(intercom, rows)
+
+    # contacts without a company have empty values for the same columns
+    assert intercom.contacts[0]['companies']['data'] == []
+    assert rows[0]['company_name'] is None
+    assert 'GET /companies/scroll' not in intercom.stats['paths']
+
+def test_index_is_reused_within_the_ttl(load, intercom):
+    run_function(load('intercom-contacts'), PARAMS)
+    listed = intercom.stats['paths']['GET /companies']
+
+    rows = read_ndjson(run_function(load('intercom-contacts'), PARAMS))
+    check_join(intercom, rows)
+    assert intercom.stats['paths']['GET /companies'] == listed
+
+    contacts = load('intercom-contacts')
+    contacts.COMPANY_INDEX_TTL = -1
+    run_function(contacts, PARAMS)
+    assert intercom.stats['paths']['GET /companies'] == 2 * listed
+
+def test_index_switches_to_the_scroll_api(load, intercom):
+    contacts = load('intercom-contacts')
+    contacts.LIST_MAX_COMPANIES = 10
+    rows = read_ndjson(run_function(contacts, PARAMS))
+    check_join(intercom, rows)
+
+    # only the first page of the list api is read before switching
+    assert intercom.stats['paths']['GET /companies'] == 1
+    assert intercom.stats['paths']['GET /companies/scroll'] > 1
+
+@pytest.mark.parametrize('prefetch', [0, 5])
+def test_index_uses_the_prefetch_depth(load, prefetch):
+    contacts = load('intercom-contacts')
+    depths = []
+    def record_depth(iterable, depth):
+        depths.append((iterable.__name__, depth))
+        return contacts.merge([iterable], depth) if depth > 0 else iterable
+    contacts.prefetch = record_depth
+    run_function(contacts, dict(PARAMS, prefetch=prefetch))
+    assert ('get_company_pages', prefetch) in depths
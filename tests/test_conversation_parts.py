@@ -0,0 +1,47 @@
+import asyncio
+import logging
+
+import pytest
+
+from mock_intercom import run_function, read_ndjson
+
+def test_parts_are_returned_in_order(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-conversation-parts'), {'properties': 'conversation_id,id'}))
+    expected = [(c['id'], str(3000000 + i * 10 + j)) for i, c in enumerate(intercom.conversations) for j in range(i % 5)]
+    assert [(row['conversation_id'], row['id']) for row in rows] == expected
+
+def test_threads_dont_outgrow_the_connection_pool(load, intercom, caplog):
+
+    # without aiohttp, the conversations are fetched on a thread pool that
+    # shares the session's connections; with some latency, every thread has
+    # a request in flight at once
+    parts = load('intercom-conversation-parts')
+    parts.aiohttp = None
+    intercom.latency = 0.05
+    try:
+        with caplog.at_level(logging.WARNING, logger='urllib3.connectionpool'):
+            rows = read_ndjson(run_function(parts, {'properties': 'id', 'concurrency': 64, 'ordered': False}))
+    finally:
+        intercom.latency = 0
+    assert len(rows) == sum(i % 5 for i in range(len(intercom.conversations)))
+    assert 'Connection pool is full' not in caplog.text
+
+def test_rate_limiter_is_called_off_the_event_loop(load, intercom):
+
+    # the rate limiter blocks on a file lock, so with aiohttp it's called on
+    # the loop's executor rather than on the loop
+    parts = load('intercom-conversation-parts')
+    if parts.aiohttp is None:
+        pytest.skip('aiohttp is not installed')
+    on_loop = []
+    def record(method):
+        def wrapper(*args, **kwargs):
+            on_loop.append(asyncio._get_running_loop() is not None)
+            return method(*args, **kwargs)
+        return wrapper
+    limiter = parts.get_rate_limiter('Bearer test-token')
+    limiter.reserve = record(limiter.reserve)
+    limiter.update = record(limiter.update)
+    rows = read_ndjson(run_function(parts, {'properties': 'id'}))
+    assert len(rows) == sum(i % 5 for i in range(len(intercom.conversations)))
+    assert len(on_loop) > 0 and not any(on_loop)
@@ -0,0 +1,45 @@
+from mock_intercom import run_function, read_ndjson
+
+def test_names_are_only_looked_up_when_requested(load, intercom):
+    conversations = load('intercom-conversations')
+    run_function(conversations, {'properties': 'id,assignee_id'})
+    run_function(conversations, {'properties': 'id,assignee_id', 'incremental': True})
+    assert 'GET /admins' not in intercom.stats['paths']
+    assert 'GET /teams' not in intercom.stats['paths']
+
+def test_names_are_resolved_from_the_ids(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-conversations'), {'properties': 'id,assignee_id,assignee_name,assignee_team_names'}))
+    admins = dict((admin['id'], admin['name']) for admin in intercom.admins)
+    assert len(rows) == len(intercom.conversations)
+    for row in rows:
+        assert row['assignee_name'] == admins[row['assignee_id']]
+    assert rows[1]['assignee_team_names'] == 'Team 1'
+
+def test_incremental_names_follow_the_directory(load, intercom):
+    params = {'properties': 'id,last_closed_by_id,last_closed_by_name', 'incremental': True}
+    first = read_ndjson(run_function(load('intercom-conversations'), params))
+    assert any(row['last_closed_by_name'] == 'Admin 1' for row in first)
+
+    # a renamed admin is returned with the new name even though none of the
+    # conversations changed
+    name = intercom.admins[1]['name']
+    intercom.admins[1]['name'] = 'Renamed Admin'
+    try:
+        second = read_ndjson(run_function(load('intercom-conversations'), params))
+    finally:
+        intercom.admins[1]['name'] = name
+    assert [row['id'] for row in second] == [row['id'] for row in first]
+    for before, after in zip(first, second):
+        if before['last_closed_by_id'] == 'admin-1':
+            assert after['last_closed_by_name'] == 'Renamed Admin'
+        else:
+            assert after['last_closed_by_name'] == before['last_closed_by_name']
+
+def test_default_properties_leave_out_the_names(load, intercom):
+    conversations = load('intercom-conversations')
+    for params in ({}, {'properties': '*'}, {'properties': '*', 'incremental': True}):
+        rows = read_ndjson(run_function(conversations, params))
+        assert len(rows) == len(intercom.conversations)
+        assert list(rows[0].keys()) == conversations.SNAPSHOT_PROPERTIES
+    assert 'GET /admins' not in intercom.stats['paths']
+    assert 'GET /teams' not in intercom.stats['paths']
@@ -0,0 +1,41 @@
+from mock_intercom import run_function, read_ndjson
+
+def test_rows_follow_the_values(load, intercom):
+    enrich = load('intercom-enrich-contacts')
+    values = ['user5@example.com', 'nobody@example.com', 'user2@example.com', '', None, ' user5@example.com ']
+    rows = read_ndjson(run_function(enrich, {'values': values, 'properties': 'id,email'}))
+
+    # a row for every value in order, with duplicates repeated and missing
+    # values returned as empty rows
+    assert [row['email'] for row in rows] == ['user5@example.com', None, 'user2@example.com', None, None, 'user5@example.com']
+    assert rows[0]['id'] == intercom.contacts[5]['id']
+    assert intercom.stats['paths']['POST /contacts/search'] == 1
+
+def test_values_are_sent_with_their_case(load, intercom):
+    email = intercom.contacts[7]['email']
+    intercom.contacts[7]['email'] = 'Bob@Example.com'
+    try:
+        rows = read_ndjson(run_function(load('intercom-enrich-contacts'), {'values': ['Bob@Example.com', 'BOB@example.com'], 'properties': 'id,email'}))
+    finally:
+        intercom.contacts[7]['email'] = email
+
+    # the contact found for one spelling is returned for every spelling
+    assert [row['id'] for row in rows] == [intercom.contacts[7]['id']] * 2
+
+def test_values_are_searched_in_chunks(load, intercom):
+    enrich = load('intercom-enrich-contacts')
+    values = [c['email'] for c in reversed(intercom.contacts[:400])]
+    rows = read_ndjson(run_function(enrich, {'values': values, 'properties': 'id,email'}))
+    assert [row['email'] for row in rows] == values
+
+    # 300 values for the first search, which has two pages, and the other
+    # 100 for the second
+    assert enrich.SEARCH_MAX_CLAUSES * enrich.SEARCH_MAX_VALUES == 300
+    assert intercom.stats['paths']['POST /contacts/search'] == 3
+
+def test_lookup_by_external_id(load, intercom):
+    values = ['user-3', 'USER-3', 'user-9']
+    rows = read_ndjson(run_function(load('intercom-enrich-contacts'), {'values': values, 'lookup_key': 'external_id', 'properties': 'id,external_id'}))
+
+    # external ids match exactly
+    assert [row['id'] for row in rows] == [intercom.contacts[3]['id'], None, intercom.contacts[9]['id']]
@@ -0,0 +1,28 @@
+import pytest
+
+from mock_intercom import run_function, read_ndjson
+
+@pytest.mark.parametrize('filter, expected', [
+    ('role=lead', lambda c: c['role'] == 'lead'),
+    ('role= lead ', lambda c: c['role'] == 'lead'),
+    ('role=Lead', lambda c: False),
+    ('unsubscribed_from_emails=True', lambda c: c['unsubscribed_from_emails']),
+    ('location_country=Germany&role=user', lambda c: c['location']['country'] == 'Germany' and c['role'] == 'user'),
+])
+def test_filter_matches_the_same_records_in_every_mode(load, intercom, filter, expected):
+
+    # the search api applies the filter in the default mode, and it's
+    # applied locally in incremental mode
+    params = {'properties': 'id', 'filter': filter}
+    ids = sorted(c['id'] for c in intercom.contacts if expected(c))
+    searched = read_ndjson(run_function(load('intercom-contacts'), params))
+    incremental = read_ndjson(run_function(load('intercom-contacts'), dict(params, incremental=True)))
+    assert sorted(row['id'] for row in searched) == ids
+    assert sorted(row['id'] for row in incremental) == ids
+
+def test_company_lookup_matches_the_local_filter(load, intercom):
+    name = intercom.companies[3]['name']
+    looked_up = read_ndjson(run_function(load('intercom-companies'), {'properties': 'id', 'filter': 'name=' + name}))
+    filtered = read_ndjson(run_function(load('intercom-companies'), {'properties': 'id', 'filter': 'name=' + name + '&size=' + str(intercom.companies[3]['size'])}))
+    assert looked_up == filtered == [{'id': intercom.companies[3]['id']}]
+    assert read_ndjson(run_function(load('intercom-companies'), {'properties': 'id', 'filter': 'industry=Software'})) == []
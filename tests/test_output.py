@@ -0,0 +1,50 @@
+import csv
+import json
+
+import pytest
+
+from mock_intercom import FakeFlex, run_function, read_ndjson
+
+@pytest.mark.parametrize('name', ['intercom-contacts', 'intercom-conversations', 'intercom-companies'])
+def test_write_rows_writes_each_record(load, name):
+    params = {'properties': 'id', 'page_size': 50}
+    by_page = FakeFlex(params)
+    load(name).flexio_handler(by_page)
+    by_row = FakeFlex(dict(params, write_rows=True))
+    load(name).flexio_handler(by_row)
+    assert by_row.output.getvalue() == by_page.output.getvalue()
+    assert len(by_row.output.parts) == by_row.output.lines > len(by_page.output.parts)
+
+@pytest.mark.parametrize('output_format', ['ndjson', 'table', 'csv'])
+def test_formats_have_the_same_records(load, intercom, output_format):
+    text = run_function(load('intercom-contacts'), {'properties': 'id,email', 'format': output_format})
+    lines = text.splitlines()
+    if output_format == 'ndjson':
+        assert [row['id'] for row in read_ndjson(text)] == [c['id'] for c in intercom.contacts]
+    else:
+        # compare the values rather than the text, which depends on whether
+        # orjson is installed
+        assert len(lines) == len(intercom.contacts) + 1
+        rows = [json.loads(line) for line in lines] if output_format == 'table' else list(csv.reader(lines))
+        assert rows[0] == ['id', 'email']
+        assert rows[1:] == [[c['id'], c['email']] for c in intercom.contacts]
+
+@pytest.mark.parametrize('params', [{'prefetch': 0}, {'prefetch': 5}, {'prefetch': 0, 'partitions': 3}, {'prefetch': 0, 'incremental': True}])
+def test_prefetch_depth_returns_the_same_records(load, intercom, params):
+    rows = read_ndjson(run_function(load('intercom-contacts'), dict(params, properties='id', page_size=50)))
+    assert sorted(row['id'] for row in rows) == sorted(c['id'] for c in intercom.contacts)
+
+@pytest.mark.parametrize('prefetch', [-1, 17, 'many'])
+def test_invalid_prefetch_depth(load, prefetch):
+    with pytest.raises(ValueError):
+        run_function(load('intercom-companies'), {'prefetch': prefetch})
+
+@pytest.mark.parametrize('name', ['intercom-contacts', 'intercom-enrich-contacts'])
+def test_stdlib_encoder_matches_orjson(load, name):
+    module = load(name)
+    row = {'id': '1', 'name': 'Zoë', 'count': 3, 'open': True, 'spend': module.Decimal('1.50'), 'tags': None}
+    module.orjson = None
+    encoded = module.get_encoder().encode(row)
+    assert encoded == '{"id":"1","name":"Zoë","count":3,"open":true,"spend":"1.50","tags":null}'
+    module.orjson = pytest.importorskip('orjson')
+    assert encoded == module.OrjsonEncoder(default=module.to_string).encode(row)
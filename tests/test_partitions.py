@@ -0,0 +1,44 @@
+from mock_intercom import run_function, read_ndjson
+
+def test_partition_ranges_cover_every_record(load, intercom):
+    contacts = load('intercom-contacts')
+    headers = {'Authorization': 'Bearer test-token', 'Accept': 'application/json'}
+    ranges = contacts.get_partition_ranges(headers, None, 4, 50)
+
+    # the ranges are contiguous, start at the first record and end after now
+    assert 4 < len(ranges) <= 4 * contacts.RANGES_PER_PARTITION
+    assert ranges[0][0] == min(c['created_at'] for c in intercom.contacts)
+    for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+        assert start < end == next_start
+    for c in intercom.contacts:
+        assert any(start <= c['created_at'] < end for start, end in ranges)
+
+def test_partition_ranges_are_split_evenly(load, intercom):
+    contacts = load('intercom-contacts')
+    headers = {'Authorization': 'Bearer test-token', 'Accept': 'application/json'}
+    ranges = contacts.get_partition_ranges(headers, None, 2, 50)
+    counts = [len([c for c in intercom.contacts if start <= c['created_at'] < end]) for start, end in ranges]
+    assert max(counts) <= 2 * len(intercom.contacts) / len(ranges)
+
+def test_partition_ranges_without_records(load):
+    contacts = load('intercom-contacts')
+    headers = {'Authorization': 'Bearer test-token', 'Accept': 'application/json'}
+    query = {'field': 'email', 'operator': '=', 'value': 'nobody@example.com'}
+    assert contacts.get_partition_ranges(headers, query, 4, 50) == []
+
+def test_partitioned_export_returns_every_record_once(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-contacts'), {'properties': 'id', 'partitions': 4, 'page_size': 50}))
+    ids = [row['id'] for row in rows]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == set(c['id'] for c in intercom.contacts)
+
+def test_partitioned_export_with_filter(load, intercom):
+    params = {'properties': 'id', 'filter': 'role=lead', 'page_size': 20}
+    serial = read_ndjson(run_function(load('intercom-contacts'), params))
+    partitioned = read_ndjson(run_function(load('intercom-contacts'), dict(params, partitions=3)))
+    assert len(serial) == len([c for c in intercom.contacts if c['role'] == 'lead'])
+    assert sorted(row['id'] for row in partitioned) == sorted(row['id'] for row in serial)
+
+def test_partitioned_conversations(load, intercom):
+    rows = read_ndjson(run_function(load('intercom-conversations'), {'properties': 'id', 'partitions': 3, 'page_size': 20}))
+    assert sorted(row['id'] for row in rows) == sorted(c['id'] for c in intercom.conversations)
@@ -0,0 +1,81 @@
+import time
+import threading
+import types
+
+def response(status, limit, remaining, reset):
+    headers = {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(reset)}
+    return types.SimpleNamespace(status_code=status, headers=headers)
+
+def test_acquire_counts_down_the_window(load):
+    contacts = load('intercom-contacts')
+    limiter = contacts.get_rate_limiter('Bearer test-token')
+    limiter.update(response(200, 100, 90, int(time.time()) + 10))
+    for _ in range(5):
+        limiter.acquire()
+    with limiter.state() as state:
+        assert state['remaining'] == 85
+
+def test_acquire_paces_the_reserve(load):
+    contacts = load('intercom-contacts')
+    limiter = contacts.get_rate_limiter('Bearer test-token')
+    reset = int(time.time()) + 2
+    limiter.update(response(200, 100, 4, reset))
+    start = time.time()
+    for _ in range(4):
+        limiter.acquire()
+
+    # the last four requests are spread over the time left in the window
+    elapsed = time.time() - start
+    assert 0.5 * (reset - start) < elapsed <= reset - start + 0.1
+
+def test_responses_only_lower_the_remaining_count(load):
+    contacts = load('intercom-contacts')
+    limiter = contacts.get_rate_limiter('Bearer test-token')
+    reset = int(time.time()) + 10
+    limiter.update(response(200, 100, 50, reset))
+    limiter.update(response(200, 100, 60, reset))
+    with limiter.state() as state:
+        assert state['remaining'] == 50
+
+def test_429_waits_for_the_reset(load):
+
+    # a 429 with a reset that's already passed waits RATE_LIMIT_DEFAULT_WAIT
+    contacts = load('intercom-contacts')
+    contacts.RATE_LIMIT_DEFAULT_WAIT = 1
+    limiter = contacts.get_rate_limiter('Bearer test-token')
+    limiter.update(response(429, 100, 0, int(time.time()) - 1))
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start >= 0.9
+
+def test_export_recovers_from_429s(load, intercom):
+    intercom.set_rate_limit(5, window=1)
+    try:
+        contacts = load('intercom-contacts')
+        text = contacts.get_data({'intercom_connection': {'access_token': 'test-token'}, 'properties': 'id', 'page_size': 100})
+        assert sum(chunk.count('\n') for chunk in text) == len(intercom.contacts)
+    finally:
+        intercom.set_rate_limit(None)
+
+def test_concurrent_callers_wait_for_an_exhausted_window(load):
+
+    # every caller waits for the reset once the budget is used up, whether
+    # they share a limiter or each have their own like separate processes
+    contacts = load('intercom-contacts')
+    reset = int(time.time()) + 2
+    contacts.get_rate_limiter('Bearer test-token').update(response(429, 100, 0, reset))
+    limiters = [contacts.get_rate_limiter('Bearer test-token')] * 2 + [contacts.RateLimiter('Bearer test-token') for _ in range(2)]
+
+    waited = [None] * len(limiters)
+    def acquire(i):
+        start = time.time()
+        limiters[i].acquire()
+        waited[i] = time.time() - start
+
+    threads = [threading.Thread(target=acquire, args=(i,)) for i in range(len(limiters))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(wait >= reset - start - 0.05 for wait in waited)
@@ -0,0 +1,26 @@
+from collections import OrderedDict
+
+import pytest
+
+from mock_intercom import load_function, run_function, read_ndjson
+
+FUNCTIONS = ['intercom-contacts', 'intercom-conversations', 'intercom-companies',
+             'intercom-conversation-parts', 'intercom-enrich-contacts']
+
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_returns_match_the_header(intercom, name):
+    # RETURNS has to be kept up to date with the header
+    module = load_function(name, intercom.url)
+    assert module.PROPERTY_TYPES == OrderedDict(module.RETURNS)
+
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_runs_without_a_file(intercom, tmp_path, name):
+    module = load_function(name, intercom.url, tmp_path, with_file=False)
+    assert not hasattr(module, '__file__')
+    assert module.PROPERTY_TYPES == OrderedDict(module.RETURNS)
+
+def test_export_without_a_file(intercom, tmp_path):
+    module = load_function('intercom-companies', intercom.url, tmp_path, with_file=False)
+    rows = read_ndjson(run_function(module, {}))
+    assert len(rows) == len(intercom.companies)
+    assert list(rows[0].keys()) == [name for name, _ in module.RETURNS]
@@ -0,0 +1,21 @@
+from mock_intercom import SCROLL_PAGE_SIZE, run_function, read_ndjson
+
+def test_large_workspace_is_listed_with_the_scroll_api(load, intercom):
+    params = {'properties': 'id,name', 'cache_ttl': 60}
+    companies = load('intercom-companies')
+    companies.LIST_MAX_COMPANIES = 10
+    rows = read_ndjson(run_function(companies, params))
+
+    # every company once, in order, with only the first page of the list api
+    # read before switching
+    assert [row['id'] for row in rows] == [c['id'] for c in intercom.companies]
+    assert intercom.stats['paths']['GET /companies'] == 1
+    scrolled = intercom.stats['paths']['GET /companies/scroll']
+    assert scrolled == len(intercom.companies) // SCROLL_PAGE_SIZE + 1
+
+    # the first page of the list api is cached, but the scroll pages aren't
+    companies = load('intercom-companies')
+    companies.LIST_MAX_COMPANIES = 10
+    assert read_ndjson(run_function(companies, params)) == rows
+    assert intercom.stats['paths']['GET /companies'] == 1
+    assert intercom.stats['paths']['GET /companies/scroll'] == 2 * scrolled